@@ -1,22 +1,77 @@
+import atexit
+import json
+import uuid
 from http import HTTPStatus
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, Response, jsonify, request, send_from_directory
 from flask_cors import CORS
 
-from src.blockchain import Blockchain
+from src import codec
+from src.blockchain import Blockchain, MAX_TRANSACTION_BATCH, TX_ADDED
+from src.broadcast import Broadcaster
+from src.miner import Miner
+from src.proof_of_work import ProofOfWork
+from src.signature_schemes import SCHEMES
+from src.storage import serialize_block, serialize_transaction
+from src.transaction import DEFAULT_SCHEME
+from src.utils import metrics
+from src.utils.response_cache import ResponseCache
+from src.utils.verification import SignatureVerifier, valid_amount, valid_fee
 from src.wallet import Wallet
 
 app = Flask(__name__, static_folder="static")
 CORS(app=app)
 
+# Identifies this process in ETags (state versions start over with every process)
+BOOT_ID = uuid.uuid4().hex[:8]
+response_cache = ResponseCache()
+
+# Read from the node's blockchain when /metrics is scraped
+metrics.gauge("chain_height", "Number of blocks in the local chain.", function=lambda: len(blockchain.chain))
+metrics.gauge("mempool_size", "Number of open transactions.",
+              function=lambda: len(blockchain.get_open_transactions()))
+metrics.gauge("peer_nodes", "Number of peer nodes.", function=lambda: len(blockchain.get_peer_nodes()))
+metrics.gauge("difficulty", "Expected hashes to find the proof of the next block.",
+              function=lambda: blockchain.next_difficulty())
+
 
 @app.after_request
 def add_header(response):
+    if response.get_etag()[0] is not None:
+        # Versioned responses may be stored, but have to be revalidated with If-None-Match
+        response.headers["Cache-Control"] = "no-cache"
+        return response
     response.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
     response.headers["Pragma"] = "no-cache"
     response.headers["Expires"] = "0"
     return response
 
 
+def make_etag(versions: tuple) -> str:
+    return "-".join([BOOT_ID] + [str(version) for version in versions])
+
+
+def not_modified(etag: str):
+    """ Returns a 304 response if the client already has the given version, otherwise None. """
+    if request.if_none_match.contains(etag):
+        response = Response(status=HTTPStatus.NOT_MODIFIED)
+        response.set_etag(etag)
+        return response
+    return None
+
+
+def versioned_response(versions: tuple, build):
+    """ Answers a read request for a state identified by its versions: 304 if the client has it already,
+    otherwise the JSON body, which is built only once per request URL and versions.
+    """
+    etag = make_etag(versions=versions)
+    response = not_modified(etag=etag)
+    if response is None:
+        body = response_cache.get_or_build(key=(request.full_path, versions), build=lambda: jsonify(build()).get_data())
+        response = Response(body, mimetype="application/json")
+        response.set_etag(etag)
+    return response
+
+
 @app.route("/")
 def index():
     return send_from_directory("static", "index.html")
@@ -36,22 +91,54 @@ def mine():
             "message": "Resolve conflicts first, block not added.",
         }
         return jsonify(response), HTTPStatus.CONFLICT
-    block = blockchain.mine_block()
-    if block is not None:
-        dict_block = block.__dict__.copy()
-        dict_block["transactions"] = [tx.__dict__ for tx in dict_block["transactions"]]
-        response = {
-            "message": "Block added successfully",
-            "block": dict_block,
-            "funds": blockchain.get_balance()
-        }
-        return jsonify(response), HTTPStatus.OK
-    else:
+    if wallet.public_key is None:
         response = {
             "message": "Adding new block failed.",
-            "wallet_set_up": wallet.public_key is not None
+            "wallet_set_up": False
         }
         return jsonify(response), HTTPStatus.INTERNAL_SERVER_ERROR
+    values = request.get_json(silent=True) or {}
+    job = miner.submit(continuous=bool(values.get("continuous", False)))
+    if job is None:
+        response = {
+            "message": "Too many mining jobs are waiting, try again later."
+        }
+        return jsonify(response), HTTPStatus.SERVICE_UNAVAILABLE
+    response = {
+        "message": "Mining job started.",
+        "job": miner.get(job_id=job.id)
+    }
+    return jsonify(response), HTTPStatus.ACCEPTED, {"Location": f"/mine/{job.id}"}
+
+
+@app.route("/mine/<job_id>", methods=["GET"])
+def get_mining_job(job_id):
+    job = miner.get(job_id=job_id)
+    if job is None:
+        response = {
+            "message": "Mining job not found."
+        }
+        return jsonify(response), HTTPStatus.NOT_FOUND
+    response = {
+        "job": job,
+        "funds": blockchain.get_balance(),
+        "proof_of_work": blockchain.pow_engine.progress()
+    }
+    return jsonify(response), HTTPStatus.OK
+
+
+@app.route("/mine/<job_id>", methods=["DELETE"])
+def stop_mining_job(job_id):
+    if not miner.stop(job_id=job_id):
+        response = {
+            "message": "Mining job not found or already finished."
+        }
+        return jsonify(response), HTTPStatus.NOT_FOUND
+    response = {
+        "message": "Mining job stopped.",
+        "job": miner.get(job_id=job_id)
+    }
+    return jsonify(response), HTTPStatus.OK
 
 
 @app.route("/resolve-conflicts", methods=["POST"])
@@ -60,7 +147,7 @@ def resolve_conflicts():
     if replaced:
         response = {
             "message": "Chain was replaced.",
-            "chain": [block.__dict__ for block in blockchain.chain]
+            "chain": [serialize_block(block) for block in blockchain.chain]
         }
     else:
         response = {
@@ -69,19 +156,111 @@ def resolve_conflicts():
     return jsonify(response), HTTPStatus.OK
 
 
+def wants_binary() -> bool:
+    """ Checks if the client prefers the binary encoding over JSON (JSON wins a tie). """
+    return request.accept_mimetypes.best_match(["application/json", codec.MEDIA_TYPE]) == codec.MEDIA_TYPE
+
+
+def request_values(unpack):
+    """ Returns the body of a request, decoded with `unpack` if the peer sent the binary encoding. """
+    if request.mimetype == codec.MEDIA_TYPE:
+        return unpack(request.get_data())
+    return request.get_json()
+
+
+def stream_blocks(chain, start, end):
+    """ Serializes the blocks of a chain snapshot one by one into a JSON array. """
+    yield "["
+    for height in range(start, end):
+        if height > start:
+            yield ","
+        yield json.dumps(serialize_block(chain[height]), ensure_ascii=False)
+    yield "]"
+
+
+def stream_packed_blocks(chain, start, end):
+    """ Encodes the blocks of a chain snapshot one by one into a binary block list. """
+    yield codec.pack_blocks_prefix(count=end - start)
+    for height in range(start, end):
+        yield codec.pack_blocks_item(codec.pack_block(data=serialize_block(chain[height])))
+
+
 @app.route("/chain", methods=["GET"])
 def get_chain():
-    dict_chain = [block.__dict__.copy() for block in blockchain.chain]
-    for dict_block in dict_chain:
-        dict_block["transactions"] = [tx.__dict__ for tx in dict_block["transactions"]]
-    return jsonify(dict_chain), HTTPStatus.OK
+    binary = wants_binary()
+    mimetype = codec.MEDIA_TYPE if binary else "application/json"
+    # The version is read before the snapshot, so the snapshot is never older than its ETag
+    etag = make_etag(versions=(blockchain.chain_version, "bin") if binary else (blockchain.chain_version,))
+    response = not_modified(etag=etag)
+    if response is not None:
+        response.vary.add("Accept")
+        return response
+    chain = blockchain.chain
+    # Blocks [from, to), "offset" is an alias of "from"
+    start = request.args.get("from", default=request.args.get("offset", default=0, type=int), type=int)
+    end = request.args.get("to", default=len(chain), type=int)
+    limit = request.args.get("limit", default=None, type=int)
+    start = max(0, start)
+    end = max(start, min(end, len(chain)))
+    stream = stream_packed_blocks if binary else stream_blocks
+    if limit is not None:
+        end = min(end, start + max(0, limit))
+        body = response_cache.get_or_build(
+            key=(request.full_path, etag),
+            build=lambda: b"".join(item if isinstance(item, bytes) else item.encode("utf-8")
+                                   for item in stream(chain=chain, start=start, end=end)))
+        response = Response(body, mimetype=mimetype)
+    else:
+        # Unbounded dumps are streamed, the whole document is never built in memory
+        response = Response(stream(chain=chain, start=start, end=end), mimetype=mimetype)
+    response.set_etag(etag)
+    response.vary.add("Accept")
+    response.headers["X-Chain-Height"] = str(len(chain))
+    return response, HTTPStatus.OK
+
+
+@app.route("/chain/tip", methods=["GET"])
+def get_chain_tip():
+    return versioned_response(versions=(blockchain.chain_version,), build=blockchain.get_chain_tip)
+
+
+@app.route("/chain/headers", methods=["GET"])
+def get_headers():
+    start = request.args.get("from", default=0, type=int)
+    limit = request.args.get("limit", default=None, type=int)
+    return versioned_response(versions=(blockchain.chain_version,),
+                              build=lambda: blockchain.get_headers(start=start, limit=limit))
+
+
+@app.route("/proof/<tx_id>", methods=["GET"])
+def get_merkle_proof(tx_id):
+    height = request.args.get("height", default=None, type=int)
+    proof = blockchain.get_merkle_proof(transaction_id=tx_id, height=height)
+    if proof is None:
+        response = {
+            "message": "Transaction not found in the chain."
+        }
+        return jsonify(response), HTTPStatus.NOT_FOUND
+    if proof["path"] is None:
+        response = {
+            "message": "The block of the transaction has no Merkle root, download the block instead.",
+            "block_index": proof["header"]["index"]
+        }
+        return jsonify(response), HTTPStatus.CONFLICT
+    return versioned_response(versions=(blockchain.chain_version,), build=lambda: proof)
 
 
 ### Transactions ###
 
 @app.route("/broadcast-transaction", methods=["POST"])
 def broadcast_transaction():
-    values = request.get_json()
+    try:
+        values = request_values(unpack=codec.unpack_transaction)
+    except ValueError:
+        response = {
+            "message": "Malformed data."
+        }
+        return jsonify(response), HTTPStatus.BAD_REQUEST
     if not values:
         response = {
             "message": "No data found."
@@ -98,16 +277,23 @@ def broadcast_transaction():
         recipient=values["recipient"],
         signature=values["signature"],
         amount=values["amount"],
-        is_receiving=True)
+        is_receiving=True,
+        scheme=values.get("scheme", DEFAULT_SCHEME),
+        fee=values.get("fee", 0))
     if success:
+        transaction = {
+            "sender": values["sender"],
+            "recipient": values["recipient"],
+            "signature": values["signature"],
+            "amount": values["amount"]
+        }
+        if "scheme" in values:
+            transaction["scheme"] = values["scheme"]
+        if values.get("fee"):
+            transaction["fee"] = values["fee"]
         response = {
             "message": "Successfully added transaction.",
-            "transaction": {
-                "sender": values["sender"],
-                "recipient": values["recipient"],
-                "signature": values["signature"],
-                "amount": values["amount"]
-            }
+            "transaction": transaction
         }
         return jsonify(response), HTTPStatus.CREATED
     else:
@@ -119,7 +305,13 @@ def broadcast_transaction():
 
 @app.route("/broadcast-block", methods=["POST"])
 def broadcast_block():
-    values = request.get_json()
+    try:
+        values = request_values(unpack=lambda payload: {"block": codec.unpack_block(payload)})
+    except ValueError:
+        response = {
+            "message": "Malformed data."
+        }
+        return jsonify(response), HTTPStatus.BAD_REQUEST
     if not values:
         response = {
             "message": "No data found."
@@ -176,26 +368,44 @@ def add_transaction():
         return jsonify(response), HTTPStatus.BAD_REQUEST
     recipient = values["recipient"]
     amount = values["amount"]
-    if amount <= 0:
+    if not isinstance(recipient, str):
+        response = {
+            "message": "Recipient must be a string."
+        }
+        return jsonify(response), HTTPStatus.BAD_REQUEST
+    if not valid_amount(amount):
         response = {
             "message": "Amount must be positive."
         }
         return jsonify(response), HTTPStatus.BAD_REQUEST
-    signature = wallet.sign_transaction(sender=wallet.public_key, recipient=recipient, amount=amount)
+    fee = values.get("fee", 0)
+    if not valid_fee(fee):
+        response = {
+            "message": "Fee must be a non-negative number."
+        }
+        return jsonify(response), HTTPStatus.BAD_REQUEST
+    signature = wallet.sign_transaction(sender=wallet.public_key, recipient=recipient, amount=amount, fee=fee)
     success = blockchain.add_transaction(
         sender=wallet.public_key,
         recipient=recipient,
         signature=signature,
-        amount=amount)
+        amount=amount,
+        scheme=wallet.scheme,
+        fee=fee)
     if success:
+        transaction = {
+            "sender": wallet.public_key,
+            "recipient": recipient,
+            "signature": signature,
+            "amount": amount
+        }
+        if wallet.scheme != DEFAULT_SCHEME:
+            transaction["scheme"] = wallet.scheme
+        if fee:
+            transaction["fee"] = fee
         response = {
             "message": "Successfully added transaction.",
-            "transaction": {
-                "sender": wallet.public_key,
-                "recipient": recipient,
-                "signature": signature,
-                "amount": amount
-            },
+            "transaction": transaction,
             "funds": blockchain.get_balance()
         }
         return jsonify(response), HTTPStatus.CREATED
@@ -206,24 +416,99 @@ def add_transaction():
         return jsonify(response), HTTPStatus.INTERNAL_SERVER_ERROR
 
 
+def read_batch():
+    """ Returns the values of a batch request (with the transaction list) or an error response. """
+    try:
+        values = request_values(unpack=lambda payload: {"transactions": codec.unpack_transactions(payload)})
+    except ValueError:
+        return None, (jsonify({"message": "Malformed data."}), HTTPStatus.BAD_REQUEST)
+    if not values or not isinstance(values.get("transactions"), list):
+        return None, (jsonify({"message": "No transactions found."}), HTTPStatus.BAD_REQUEST)
+    if len(values["transactions"]) > MAX_TRANSACTION_BATCH:
+        response = {
+            "message": f"At most {MAX_TRANSACTION_BATCH} transactions can be submitted at once."
+        }
+        return None, (jsonify(response), HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+    return values, None
+
+
+@app.route("/transactions/batch", methods=["POST"])
+def add_transactions():
+    values, error = read_batch()
+    if error is not None:
+        return error
+    transactions = values["transactions"]
+    sign_with_wallet = values.get("sign_with_wallet", False) is True
+    if sign_with_wallet and wallet.public_key is None:
+        response = {
+            "message": "No wallet set up."
+        }
+        return jsonify(response), HTTPStatus.NOT_ACCEPTABLE
+    # Only on request, transactions without signature are signed with the wallet of the node. Without the flag and
+    # with another sender they stay unsigned and are reported as malformed.
+    for position, tx in enumerate(transactions if sign_with_wallet else ()):
+        if isinstance(tx, dict) and "signature" not in tx and tx.get("sender", wallet.public_key) == wallet.public_key:
+            transactions[position] = {
+                "sender": wallet.public_key,
+                "recipient": tx.get("recipient"),
+                "amount": tx.get("amount"),
+                "signature": wallet.sign_transaction(sender=wallet.public_key, recipient=tx.get("recipient"),
+                                                     amount=tx.get("amount"), fee=tx.get("fee", 0))
+            }
+            if wallet.scheme != DEFAULT_SCHEME:
+                transactions[position]["scheme"] = wallet.scheme
+            if tx.get("fee"):
+                transactions[position]["fee"] = tx["fee"]
+    results = blockchain.add_transactions(transactions=transactions)
+    added = results.count(TX_ADDED)
+    response = {
+        "message": f"Added {added} of {len(results)} transactions.",
+        "results": results
+    }
+    if wallet.public_key is not None:
+        response["funds"] = blockchain.get_balance()
+    return jsonify(response), HTTPStatus.CREATED if added else HTTPStatus.BAD_REQUEST
+
+
+@app.route("/broadcast-transactions", methods=["POST"])
+def broadcast_transactions():
+    values, error = read_batch()
+    if error is not None:
+        return error
+    results = blockchain.add_transactions(transactions=values["transactions"], is_receiving=True)
+    response = {
+        "message": f"Added {results.count(TX_ADDED)} of {len(results)} transactions.",
+        "results": results
+    }
+    return jsonify(response), HTTPStatus.OK
+
+
 @app.route("/transactions", methods=["GET"])
 def get_open_transactions():
-    transactions = blockchain.get_open_transactions()
-    dict_transactions = [tx.__dict__ for tx in transactions]
-    return jsonify(dict_transactions), HTTPStatus.OK
+    return versioned_response(
+        versions=(blockchain.mempool_version,),
+        build=lambda: [serialize_transaction(tx) for tx in blockchain.get_open_transactions()])
 
 
 ### Wallet ###
 
 @app.route("/wallet", methods=["POST"])
 def create_wallet():
-    wallet.create_keys()
+    values = request.get_json(silent=True) or {}
+    scheme = values.get("scheme", wallet.scheme)
+    if scheme not in SCHEMES:
+        response = {
+            "message": f"Unknown signature scheme, expected one of {sorted(SCHEMES)}."
+        }
+        return jsonify(response), HTTPStatus.BAD_REQUEST
+    wallet.create_keys(scheme=scheme)
     if wallet.save_keys():
-        global blockchain
-        blockchain = Blockchain(public_key=wallet.public_key, node_id=port)
+        # The node keeps its blockchain, only the miner of new blocks changes
+        blockchain.public_key = wallet.public_key
         response = {
             "public_key": wallet.public_key,
             "private_key": wallet.private_key,
+            "scheme": wallet.scheme,
             "funds": blockchain.get_balance()
         }
         return jsonify(response), HTTPStatus.CREATED
@@ -237,11 +522,12 @@ def create_wallet():
 @app.route("/wallet", methods=["GET"])
 def load_wallet():
     if wallet.load_keys():
-        global blockchain
-        blockchain = Blockchain(public_key=wallet.public_key, node_id=port)
+        # The node keeps its blockchain, only the miner of new blocks changes
+        blockchain.public_key = wallet.public_key
         response = {
             "public_key": wallet.public_key,
             "private_key": wallet.private_key,
+            "scheme": wallet.scheme,
             "funds": blockchain.get_balance()
         }
         return jsonify(response), HTTPStatus.OK
@@ -254,18 +540,17 @@ def load_wallet():
 
 @app.route("/balance", methods=["GET"])
 def get_balance():
-    balance = blockchain.get_balance()
-    if wallet.public_key is None:
+    if wallet.public_key is None or blockchain.public_key is None:
         response = {
             "message": "No wallet set up. Please create a wallet first."
         }
         return jsonify(response), HTTPStatus.NOT_ACCEPTABLE
-    if balance is not None:
-        response = {
+    return versioned_response(
+        versions=(blockchain.chain_version, blockchain.mempool_version, blockchain.key_version),
+        build=lambda: {
             "message": "Fetched balance successfully.",
-            "funds": balance
-        }
-        return jsonify(response), HTTPStatus.OK
+            "funds": blockchain.get_balance()
+        })
 
 
 ### Nodes ###
@@ -309,10 +594,18 @@ def remove_node(node_url):
 
 @app.route("/node", methods=["GET"])
 def get_nodes():
-    response = {
-        "all_nodes": blockchain.get_peer_nodes()
-    }
-    return jsonify(response), HTTPStatus.OK
+    return versioned_response(
+        versions=(blockchain.peers_version,),
+        build=lambda: {
+            "all_nodes": blockchain.get_peer_nodes()
+        })
+
+
+### Metrics ###
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return Response(metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4")
 
 
 if __name__ == "__main__":
@@ -320,8 +613,18 @@ if __name__ == "__main__":
 
     parser = ArgumentParser()
     parser.add_argument("-p", "--port", type=int, default=5000)
+    parser.add_argument("-w", "--pow-workers", type=int, default=None)
+    parser.add_argument("-v", "--verify-workers", type=int, default=None)
+    parser.add_argument("-t", "--peer-timeout", type=float, default=5.0)
     args = parser.parse_args()
     port = args.port
+    pow_engine = ProofOfWork(workers=args.pow_workers)
+    verifier = SignatureVerifier(workers=args.verify_workers)
+    broadcaster = Broadcaster(timeout=args.peer_timeout)
     wallet = Wallet(node_id=port)
-    blockchain = Blockchain(public_key=wallet.public_key, node_id=port)
+    blockchain = Blockchain(public_key=wallet.public_key, node_id=port, pow_engine=pow_engine,
+                            verifier=verifier, broadcaster=broadcaster)
+    miner = Miner(pow_engine=pow_engine)
+    miner.attach(blockchain=blockchain)
+    atexit.register(blockchain.close)
     app.run(host="0.0.0.0", port=port, debug=True)
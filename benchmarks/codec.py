@@ -0,0 +1,85 @@
+""" Compares the binary block encoding with the JSON path (size, encode and decode time).
+Run from the repository root: `python -m benchmarks.codec [--blocks 50] [--transactions 20] [--wallets 4]`
+"""
+import json
+import time
+from argparse import ArgumentParser
+
+from src import codec
+from src.block import Block
+from src.storage import serialize_block
+from src.transaction import Transaction
+from src.wallet import Wallet
+
+
+def make_blocks(blocks: int, transactions: int, wallets: int) -> list:
+    """ Builds blocks of signed transactions between a few RSA-3072 wallets (keys repeat like on a real chain). """
+    senders = []
+    for number in range(wallets):
+        wallet = Wallet(node_id=number)
+        wallet.create_keys()
+        senders.append(wallet)
+    chain = []
+    previous_hash = ""
+    for index in range(blocks):
+        block_transactions = []
+        for number in range(transactions):
+            sender = senders[number % wallets]
+            recipient = senders[(number + 1) % wallets].public_key
+            amount = round(0.5 + number * 0.25, 2)
+            signature = sender.sign_transaction(sender=sender.public_key, recipient=recipient, amount=amount)
+            block_transactions.append(Transaction(sender=sender.public_key, recipient=recipient,
+                                                  signature=signature, amount=amount))
+        block_transactions.append(Transaction(sender="MINING", recipient=senders[0].public_key,
+                                              signature="", amount=2))
+        block = Block(index=index, previous_hash=previous_hash, transactions=block_transactions, proof=index * 7)
+        chain.append(serialize_block(block))
+        previous_hash = block.hash
+    return chain
+
+
+def measure(function, repeat: int) -> float:
+    """ Returns the best time of `repeat` runs in milliseconds. """
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--blocks", type=int, default=50)
+    parser.add_argument("--transactions", type=int, default=20)
+    parser.add_argument("--wallets", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    chain = make_blocks(blocks=args.blocks, transactions=args.transactions, wallets=args.wallets)
+    encoded_json = json.dumps(chain).encode("utf-8")
+    encoded_plain = codec.pack_blocks(chain, intern=False)
+    encoded_interned = codec.pack_blocks(chain, intern=True)
+    assert json.loads(encoded_json) == chain
+    assert codec.unpack_blocks(encoded_plain) == chain
+    assert codec.unpack_blocks(encoded_interned) == chain
+
+    rows = [
+        ("json", len(encoded_json),
+         measure(lambda: json.dumps(chain).encode("utf-8"), args.repeat),
+         measure(lambda: json.loads(encoded_json), args.repeat)),
+        ("binary", len(encoded_plain),
+         measure(lambda: codec.pack_blocks(chain, intern=False), args.repeat),
+         measure(lambda: codec.unpack_blocks(encoded_plain), args.repeat)),
+        ("binary+keys", len(encoded_interned),
+         measure(lambda: codec.pack_blocks(chain, intern=True), args.repeat),
+         measure(lambda: codec.unpack_blocks(encoded_interned), args.repeat)),
+    ]
+    print(f"{args.blocks} blocks x {args.transactions + 1} transactions, {args.wallets} wallets")
+    print(f"{'encoding':<12} {'bytes':>10} {'ratio':>6} {'encode ms':>10} {'decode ms':>10}")
+    for name, size, encode_ms, decode_ms in rows:
+        print(f"{name:<12} {size:>10} {size / len(encoded_json):>6.2f} {encode_ms:>10.2f} {decode_ms:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+""" Simulates the difficulty adjustment under a changing hash rate and shows how the block interval converges.
+Block times are drawn from the exponential distribution of a proof of work search (mean difficulty / hash rate),
+the difficulties come from the real `DifficultyRule`.
+Run from the repository root:
+    python -m benchmarks.difficulty
+    python -m benchmarks.difficulty --phases 1e6:300,1e7:300,2e5:300 --target 10 --interval 10 --windows
+"""
+import random
+import statistics
+from argparse import ArgumentParser
+
+from src.difficulty import LEGACY_DIFFICULTY, MAX_ADJUSTMENT, RETARGET_INTERVAL, TARGET_BLOCK_SECONDS, \
+    DifficultyRule
+
+# A window whose mean block interval is within this share of the target counts as converged
+TOLERANCE = 0.25
+
+
+def parse_phases(text: str) -> list[tuple[float, int]]:
+    """ Parses `rate:blocks,rate:blocks,...` into (hashes per second, number of blocks) pairs. """
+    phases = []
+    for item in text.split(","):
+        rate, blocks = item.split(":")
+        phases.append((float(rate), int(blocks)))
+    return phases
+
+
+def simulate(rule: DifficultyRule, phases: list, seed: int) -> list[dict]:
+    """ Mines the blocks of every phase.
+    :return: One entry per block (height, hash rate, difficulty, interval).
+    """
+    generator = random.Random(seed)
+    # The genesis block
+    timestamps = [0.0]
+    blocks = []
+    parent_difficulty = None
+    for rate, count in phases:
+        for _ in range(count):
+            height = len(timestamps)
+            difficulty = rule.next_difficulty(height=height, parent_difficulty=parent_difficulty,
+                                              timestamp_at=timestamps.__getitem__)
+            interval = generator.expovariate(rate / difficulty)
+            timestamps.append(timestamps[-1] + interval)
+            blocks.append({"height": height, "rate": rate, "difficulty": difficulty, "interval": interval})
+            parent_difficulty = difficulty
+    return blocks
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--phases", default="1e6:300,1e7:300,2e5:300",
+                        help="Hash rate (hashes per second) and number of blocks of every phase.")
+    parser.add_argument("--target", type=float, default=TARGET_BLOCK_SECONDS, help="Target block interval (s).")
+    parser.add_argument("--interval", type=int, default=RETARGET_INTERVAL, help="Blocks between adjustments.")
+    parser.add_argument("--max-adjustment", type=float, default=MAX_ADJUSTMENT)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--windows", action="store_true", help="Print every retarget window.")
+    args = parser.parse_args()
+
+    # No lower bound, so the simulation also shows the adjustment to slow miners
+    rule = DifficultyRule(target_seconds=args.target, retarget_interval=args.interval,
+                          max_adjustment=args.max_adjustment, min_difficulty=1)
+    phases = parse_phases(args.phases)
+    blocks = simulate(rule=rule, phases=phases, seed=args.seed)
+
+    if args.windows:
+        print(f"{'height':>7} {'hash rate':>10} {'difficulty':>12} {'mean interval s':>16}")
+        windows = {}
+        for block in blocks:
+            windows.setdefault(block["height"] // args.interval, []).append(block)
+        for window in windows.values():
+            print(f"{window[0]['height']:>7} {window[0]['rate']:>10.3g} {window[0]['difficulty']:>12}"
+                  f" {statistics.fmean(block['interval'] for block in window):>16.2f}")
+        print()
+
+    print(f"target {args.target:g} s, retarget every {args.interval} blocks, at most x{args.max_adjustment:g}")
+    print(f"{'phase':>5} {'hash rate':>10} {'blocks':>7} {'fixed interval s':>17} {'converged after':>16}"
+          f" {'interval s (2nd half)':>22}")
+    position = 0
+    for number, (rate, count) in enumerate(phases, start=1):
+        phase = blocks[position:position + count]
+        position += count
+        converged = None
+        for start in range(0, len(phase), args.interval):
+            window = phase[start:start + args.interval]
+            mean = statistics.fmean(block["interval"] for block in window)
+            if abs(mean / args.target - 1) <= TOLERANCE:
+                converged = start + len(window)
+                break
+        second_half = phase[len(phase) // 2:]
+        mean = statistics.fmean(block["interval"] for block in second_half)
+        converged_text = f"{converged} blocks" if converged is not None else "-"
+        print(f"{number:>5} {rate:>10.3g} {count:>7} {LEGACY_DIFFICULTY / rate:>17.3g} {converged_text:>16}"
+              f" {mean:>22.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+""" Synthetic chains and transactions for the benchmarks. """
+import random
+
+from src.block import Block
+from src.blockchain import MINING_REWARD
+from src.difficulty import DEFAULT_RULE
+from src.proof_of_work import ProofOfWork
+from src.storage import BlockLog, encode_block, serialize_transaction
+from src.transaction import Transaction
+from src.wallet import Wallet
+
+
+class Fixtures:
+    """ Creates wallets once and hands out signed transactions between them.
+    Signing RSA-3072 is slow, so signed transactions are created on demand and reused.
+    :argument wallets: The number of wallets which send and receive coins.
+    :argument seed: The seed of the amounts and the recipients.
+    """
+
+    def __init__(self, wallets: int = 4, seed: int = 1):
+        self.random = random.Random(seed)
+        self.wallets = []
+        for number in range(wallets):
+            wallet = Wallet(node_id=f"benchmark-{number}")
+            wallet.create_keys()
+            self.wallets.append(wallet)
+        self.__signed = []
+
+    def signed_transactions(self, count: int) -> list[Transaction]:
+        """ Returns `count` distinct transactions with valid signatures. """
+        while len(self.__signed) < count:
+            number = len(self.__signed)
+            sender = self.wallets[number % len(self.wallets)]
+            recipient = self.wallets[(number + 1) % len(self.wallets)].public_key
+            # Distinct amounts make distinct transactions
+            amount = round(0.001 * (number + 1), 3)
+            signature = sender.sign_transaction(sender=sender.public_key, recipient=recipient, amount=amount)
+            self.__signed.append(Transaction(sender=sender.public_key, recipient=recipient,
+                                             signature=signature, amount=amount))
+        return self.__signed[:count]
+
+    def reward(self, height: int) -> Transaction:
+        """ Returns the mining reward of a block (the miners take turns). """
+        miner = self.wallets[height % len(self.wallets)]
+        return Transaction(sender="MINING", recipient=miner.public_key, signature="", amount=MINING_REWARD)
+
+    def blocks(self, count: int, transactions_per_block: int, genesis: Block):
+        """ Yields `count` linked blocks after the genesis block, with arbitrary (not mined) proofs.
+        The transactions are taken round-robin from a pool of signed transactions.
+        """
+        pool = self.signed_transactions(count=max(transactions_per_block * 4, 1))
+        previous_hash = genesis.hash
+        for height in range(1, count + 1):
+            start = (height * transactions_per_block) % len(pool)
+            transactions = [pool[(start + offset) % len(pool)] for offset in range(transactions_per_block)]
+            transactions.append(self.reward(height=height))
+            block = Block(index=height, previous_hash=previous_hash, transactions=transactions,
+                          proof=self.random.randrange(1 << 20), timestamp=1_700_000_000.0 + height,
+                          merkle_root=Block.calculate_merkle_root(transactions))
+            previous_hash = block.hash
+            yield block
+
+    def mined_blocks(self, count: int, transactions_per_block: int, genesis: Block) -> list[Block]:
+        """ Returns `count` linked blocks with valid proofs of work (slow, keep `count` small). """
+        pool = self.signed_transactions(count=max(transactions_per_block * 4, 1))
+        engine = ProofOfWork(workers=1)
+        chain = [genesis]
+        for height in range(1, count + 1):
+            start = (height * transactions_per_block) % len(pool)
+            transactions = [pool[(start + offset) % len(pool)] for offset in range(transactions_per_block)]
+            difficulty = DEFAULT_RULE.next_difficulty(height=height, parent_difficulty=chain[-1].difficulty,
+                                                      timestamp_at=lambda index: chain[index].timestamp)
+            proof = engine.search(transactions=transactions, last_hash=chain[-1].hash, difficulty=difficulty)
+            transactions.append(self.reward(height=height))
+            chain.append(Block(index=height, previous_hash=chain[-1].hash, transactions=transactions, proof=proof,
+                               timestamp=1_700_000_000.0 + height,
+                               merkle_root=Block.calculate_merkle_root(transactions), difficulty=difficulty))
+        engine.shutdown()
+        return chain
+
+    def write_chain(self, node_id, blocks: int, transactions_per_block: int, genesis: Block) -> str:
+        """ Writes a synthetic chain into the block log of a node (in the current directory).
+        :return: The storage directory of the node.
+        """
+        directory = f"blockchain-{node_id}"
+        block_log = BlockLog(directory=directory)
+        block_log.append(payload=encode_block(genesis))
+        for block in self.blocks(count=blocks - 1, transactions_per_block=transactions_per_block, genesis=genesis):
+            block_log.append(payload=encode_block(block))
+        block_log.close()
+        return directory
+
+    def mempool(self, count: int) -> list[dict]:
+        """ Returns `count` serialized signed transactions for the open transactions. """
+        return [serialize_transaction(tx) for tx in self.signed_transactions(count=count)]
@@ -0,0 +1,65 @@
+""" Reports the resident memory of a chain loaded into Block and Transaction objects.
+Run from the repository root: `python -m benchmarks.memory [--transactions 100000] [--per-block 100]`
+Signatures are random bytes of the RSA-3072 signature size, keys are real RSA-3072 public keys.
+"""
+import gc
+import json
+import os
+import resource
+from argparse import ArgumentParser
+
+from src.storage import deserialize_block
+from src.wallet import Wallet
+
+
+def rss() -> int:
+    """ Returns the current resident set size in bytes (the peak size where /proc is not available). """
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def make_records(transactions: int, per_block: int, wallets: int) -> list:
+    """ Creates the blocks as JSON records, the way they come from the block log or a peer. """
+    keys = [Wallet.generate_keys()[1] for _ in range(wallets)]
+    records = []
+    for index in range((transactions + per_block - 1) // per_block):
+        block_transactions = [{
+            "sender": keys[number % wallets],
+            "recipient": keys[(number + 1) % wallets],
+            "amount": round(0.5 + number * 0.25, 2),
+            "signature": os.urandom(384).hex()
+        } for number in range(min(per_block, transactions - index * per_block))]
+        records.append(json.dumps({
+            "index": index,
+            "previous_hash": os.urandom(32).hex(),
+            "transactions": block_transactions,
+            "proof": index,
+            "timestamp": 1700000000.0 + index
+        }))
+    return records
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--transactions", type=int, default=100_000)
+    parser.add_argument("--per-block", type=int, default=100)
+    parser.add_argument("--wallets", type=int, default=4)
+    args = parser.parse_args()
+
+    records = make_records(transactions=args.transactions, per_block=args.per_block, wallets=args.wallets)
+    gc.collect()
+    before = rss()
+    chain = [deserialize_block(json.loads(record)) for record in records]
+    gc.collect()
+    after = rss()
+    loaded = sum(len(block.transactions) for block in chain)
+    print(f"{len(chain)} blocks, {loaded} transactions, {args.wallets} wallets")
+    print(f"chain RSS: {(after - before) / 2 ** 20:.1f} MiB ({(after - before) / loaded:.0f} bytes per transaction)")
+    print(f"process RSS: {after / 2 ** 20:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+""" Compares the signature schemes: key generation, signing and verification speed, key, signature and
+transaction sizes.
+Run from the repository root: `python -m benchmarks.signatures [--transactions 200] [--keys 5]`
+"""
+import binascii
+import json
+import time
+from argparse import ArgumentParser
+
+from src import codec
+from src.signature_schemes import SCHEMES, signed_data
+from src.storage import serialize_transaction
+from src.transaction import Transaction
+from src.wallet import Wallet
+
+
+def timed(function, count: int) -> float:
+    """ Returns the seconds per call of `count` calls. """
+    started = time.perf_counter()
+    for number in range(count):
+        function(number)
+    return (time.perf_counter() - started) / count
+
+
+def run_scheme(name: str, transactions: int, keys: int) -> dict:
+    scheme = SCHEMES[name]
+    key_seconds = timed(lambda _: scheme.generate_keys(), keys)
+    wallet = Wallet(node_id=name, scheme=name)
+    wallet.create_keys()
+    recipient = wallet.public_key
+    amounts = [round(0.5 + number * 0.25, 2) for number in range(transactions)]
+    signatures = []
+    sign_seconds = timed(lambda number: signatures.append(
+        wallet.sign_transaction(sender=wallet.public_key, recipient=recipient, amount=amounts[number])),
+        transactions)
+    signed = [Transaction(sender=wallet.public_key, recipient=recipient, signature=signature, amount=amount,
+                          scheme=name) for signature, amount in zip(signatures, amounts)]
+
+    def verify(number):
+        # Straight through the scheme, so the caches of the wallet don't hide the cost
+        tx = signed[number]
+        data = signed_data(sender=tx.sender, recipient=tx.recipient, amount=tx.amount, scheme=tx.scheme)
+        assert scheme.verify(public_key=tx.sender, data=data, signature=binascii.unhexlify(tx.signature))
+
+    scheme.clear_cache()
+    verify_seconds = timed(verify, transactions)
+    payload = [serialize_transaction(tx) for tx in signed]
+    return {
+        "scheme": name,
+        "keygen_ms": key_seconds * 1000,
+        "sign_per_s": 1 / sign_seconds,
+        "verify_per_s": 1 / verify_seconds,
+        "public_key_hex": len(wallet.public_key),
+        "signature_hex": len(signatures[0]),
+        "json_bytes": len(json.dumps(payload).encode("utf-8")) / transactions,
+        "binary_bytes": len(codec.pack_transactions(transactions=payload, intern=False)) / transactions
+    }
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--transactions", type=int, default=200)
+    parser.add_argument("--keys", type=int, default=5, help="Key pairs generated for the key generation time.")
+    args = parser.parse_args()
+
+    rows = [run_scheme(name=name, transactions=args.transactions, keys=args.keys) for name in SCHEMES]
+    print(f"{args.transactions} transactions per scheme, {args.keys} key pairs")
+    print(f"{'scheme':<8} {'keygen ms':>10} {'sign/s':>9} {'verify/s':>9} {'key hex':>8} {'sig hex':>8}"
+          f" {'json B/tx':>10} {'binary B/tx':>12}")
+    for row in rows:
+        print(f"{row['scheme']:<8} {row['keygen_ms']:>10.2f} {row['sign_per_s']:>9.0f} {row['verify_per_s']:>9.0f}"
+              f" {row['public_key_hex']:>8} {row['signature_hex']:>8} {row['json_bytes']:>10.0f}"
+              f" {row['binary_bytes']:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+""" Drives one node from many threads at once and checks that its state stays consistent.
+Submitter threads send every transaction twice (singly with a broadcast, or in batches as if received from
+a peer), a miner thread mines blocks, a peer thread mines competing blocks and hands them to `add_block`,
+and reader threads read chain snapshots, open transactions and balances the whole time.
+"replays" counts transactions which were confirmed and then accepted again: only open transactions are checked
+for duplicates, which is a known gap and not a race.
+Run from the repository root: `python -m benchmarks.stress [--threads 1,2,4,8] [--transactions 300]`
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+
+from benchmarks.fixtures import Fixtures
+from src.block import Block
+from src.blockchain import Blockchain, TX_ADDED
+from src.broadcast import Broadcaster, BroadcastResult
+from src.ledger import Ledger
+from src.proof_of_work import ProofOfWork
+from src.storage import serialize_block, serialize_transaction
+from src.transaction import Transaction
+from src.utils.verification import SignatureVerifier
+from src.wallet import Wallet
+
+PEERS = ["peer-1", "peer-2", "peer-3"]
+# Transactions per batch of the submitters which act as a receiving node
+BATCH = 10
+
+
+class LatencyBroadcaster(Broadcaster):
+    """ Answers every message after a fixed delay instead of contacting the peers. """
+
+    def __init__(self, latency: float):
+        super().__init__(workers=1)
+        self.latency = latency
+        self.messages = 0
+        self.__lock = threading.Lock()
+
+    def post(self, nodes, path: str, payload: dict, packed: bytes = None) -> BroadcastResult:
+        time.sleep(self.latency)
+        with self.__lock:
+            self.messages += 1
+        result = BroadcastResult()
+        result.status_codes = {node: 201 for node in nodes}
+        return result
+
+
+class StressRun:
+    """ One run with a given number of submitter threads on a fresh node.
+    :argument fixtures: The wallets and signed transactions.
+    :argument genesis: The genesis block of the node.
+    :argument threads: The number of submitter threads.
+    :argument transactions: The number of distinct transactions (each is submitted twice).
+    :argument funding_blocks: The number of reward blocks which fund the wallets.
+    :argument latency: The seconds a broadcast takes.
+    """
+
+    def __init__(self, fixtures: Fixtures, genesis: Block, threads: int, transactions: int, funding_blocks: int,
+                 latency: float):
+        self.fixtures = fixtures
+        self.threads = threads
+        self.node_id = f"stress-{threads}"
+        fixtures.write_chain(node_id=self.node_id, blocks=funding_blocks, transactions_per_block=0, genesis=genesis)
+        self.transactions = fixtures.signed_transactions(count=transactions)
+        self.broadcaster = LatencyBroadcaster(latency=latency)
+        self.pow_engine = ProofOfWork(workers=1)
+        self.verifier = SignatureVerifier(workers=1)
+        self.blockchain = self.node()
+        for peer in PEERS:
+            self.blockchain.add_peer_node(node=peer)
+        self.accepted = {}
+        self.results_lock = threading.Lock()
+        self.errors = []
+        self.reads = 0
+        self.replays = 0
+        self.mined = {"node": 0, "peer": 0}
+        self.running = threading.Event()
+
+    def node(self) -> Blockchain:
+        return Blockchain(public_key=self.fixtures.wallets[0].public_key, node_id=self.node_id,
+                          pow_engine=self.pow_engine, verifier=self.verifier, broadcaster=self.broadcaster)
+
+    def record(self, transaction: Transaction, accepted: bool) -> None:
+        if accepted:
+            with self.results_lock:
+                self.accepted[transaction.id] = self.accepted.get(transaction.id, 0) + 1
+
+    def guarded(self, work):
+        def run():
+            try:
+                work()
+            except Exception as ex:
+                self.errors.append(f"{threading.current_thread().name}: {ex!r}")
+        return run
+
+    def submit(self, transactions: list, batched: bool) -> None:
+        if batched:
+            for start in range(0, len(transactions), BATCH):
+                batch = transactions[start:start + BATCH]
+                results = self.blockchain.add_transactions(
+                    transactions=[serialize_transaction(tx) for tx in batch], is_receiving=True)
+                for tx, result in zip(batch, results):
+                    self.record(transaction=tx, accepted=result == TX_ADDED)
+        else:
+            for tx in transactions:
+                accepted = self.blockchain.add_transaction(recipient=tx.recipient, sender=tx.sender,
+                                                           signature=tx.signature, amount=tx.amount)
+                self.record(transaction=tx, accepted=accepted)
+
+    def submit_twice(self, share: list, twin: list, batched: bool) -> None:
+        """ Submits the own share, then the share of the next submitter the other way. """
+        self.submit(transactions=share, batched=batched)
+        self.submit(transactions=twin, batched=not batched)
+
+    def mine(self) -> None:
+        while self.running.is_set():
+            if not self.blockchain.get_open_transactions():
+                time.sleep(0.01)
+            elif self.blockchain.mine_block() is not None:
+                self.mined["node"] += 1
+
+    def mine_as_peer(self) -> None:
+        """ Mines blocks with some open transactions on its own engine and delivers them like a peer would. """
+        engine = ProofOfWork(workers=1)
+        reward = self.fixtures.reward(height=1)
+        try:
+            while self.running.is_set():
+                tip = self.blockchain.get_last_blockchain_value()
+                transactions = list(self.blockchain.get_open_transactions()[:5])
+                if not transactions:
+                    time.sleep(0.01)
+                    continue
+                # The difficulty the node requires after this tip, like a peer on the same chain would compute it
+                difficulty = self.blockchain.next_difficulty(parent=tip)
+                proof = engine.search(transactions=transactions, last_hash=tip.hash, difficulty=difficulty)
+                transactions.append(reward)
+                block = Block(index=tip.index + 1, previous_hash=tip.hash, transactions=transactions,
+                              proof=proof, merkle_root=Block.calculate_merkle_root(transactions),
+                              difficulty=difficulty)
+                if self.blockchain.add_block(block=serialize_block(block)):
+                    self.mined["peer"] += 1
+        finally:
+            engine.shutdown()
+
+    def read(self) -> None:
+        participants = [wallet.public_key for wallet in self.fixtures.wallets]
+        while self.running.is_set():
+            chain = self.blockchain.chain
+            blocks = chain[max(0, len(chain) - 10):]
+            for previous, block in zip(blocks, blocks[1:]):
+                if block.previous_hash != previous.hash:
+                    raise AssertionError(f"Block {block.index} doesn't follow block {previous.index} in a snapshot.")
+            self.blockchain.get_open_transactions()
+            for participant in participants:
+                self.blockchain.get_balance(sender=participant)
+            self.reads += 1
+
+    def run(self) -> dict:
+        Wallet.clear_caches()
+        # Every transaction is sent by two different submitters, so duplicates race each other
+        shares = [self.transactions[number::self.threads] for number in range(self.threads)]
+        submitters = []
+        for number in range(self.threads):
+            twin = shares[(number + 1) % self.threads]
+            submitters.append(threading.Thread(
+                target=self.guarded(lambda share=shares[number], twin=twin, batched=number % 2 == 1:
+                                    self.submit_twice(share=share, twin=twin, batched=batched)),
+                name=f"submitter-{number}"))
+        background = [threading.Thread(target=self.guarded(self.mine), name="miner"),
+                      threading.Thread(target=self.guarded(self.mine_as_peer), name="peer")]
+        background += [threading.Thread(target=self.guarded(self.read), name=f"reader-{number}")
+                       for number in range(2)]
+        self.running.set()
+        for thread in background:
+            thread.start()
+        started = time.perf_counter()
+        for thread in submitters:
+            thread.start()
+        for thread in submitters:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        self.running.clear()
+        self.pow_engine.cancel()
+        for thread in background:
+            thread.join()
+        # One more block confirms whatever is still open
+        self.blockchain.mine_block()
+        self.check()
+        return {
+            "threads": self.threads,
+            "submissions": 2 * len(self.transactions),
+            "accepted": sum(self.accepted.values()),
+            "seconds": elapsed,
+            "rate": sum(self.accepted.values()) / elapsed,
+            "blocks": f"{self.mined['node']}/{self.mined['peer']}",
+            "broadcasts": self.broadcaster.messages,
+            "reads": self.reads,
+            "replays": self.replays
+        }
+
+    def check(self) -> None:
+        """ Collects the violated invariants in `errors`. """
+        chain = list(self.blockchain.chain)
+        open_transactions = self.blockchain.get_open_transactions()
+        for height, block in enumerate(chain):
+            if block.index != height:
+                self.errors.append(f"Block at height {height} has index {block.index}.")
+            if height and block.previous_hash != chain[height - 1].hash:
+                self.errors.append(f"Block {height} doesn't follow block {height - 1}.")
+        # Every acceptance leaves exactly one copy in the chain or the open transactions. A transaction which was
+        # confirmed can be accepted again (only open transactions are checked for duplicates), two submissions
+        # which both pass the check for the same open transaction would leave one copy for two acceptances
+        seen = {}
+        for tx in [tx for block in chain for tx in block.transactions[:-1]] + list(open_transactions):
+            seen[tx.id] = seen.get(tx.id, 0) + 1
+        lost = [tx.id for tx in self.transactions if self.accepted.get(tx.id, 0) > seen.get(tx.id, 0)]
+        phantom = [tx.id for tx in self.transactions if self.accepted.get(tx.id, 0) < seen.get(tx.id, 0)]
+        if lost:
+            self.errors.append(f"{len(lost)} transactions were accepted more often than they are confirmed or open.")
+        if phantom:
+            self.errors.append(f"{len(phantom)} transactions are confirmed or open more often than they were accepted.")
+        self.replays = sum(1 for tx in self.transactions if self.accepted.get(tx.id, 0) > 1)
+        ledger = Ledger()
+        ledger.rebuild(chain=chain, open_transactions=open_transactions)
+        reloaded = self.node()
+        if reloaded.get_tip_hash() != self.blockchain.get_tip_hash():
+            self.errors.append("The reloaded node has a different chain tip.")
+        if {tx.id for tx in reloaded.get_open_transactions()} != {tx.id for tx in open_transactions}:
+            self.errors.append("The reloaded node has different open transactions.")
+        for wallet in self.fixtures.wallets:
+            balance = self.blockchain.get_balance(sender=wallet.public_key)
+            if abs(balance - ledger.balance(participant=wallet.public_key)) > 1e-6:
+                self.errors.append(f"The balance of {wallet.node_id} differs from a rebuilt ledger.")
+            if abs(balance - reloaded.get_balance(sender=wallet.public_key)) > 1e-6:
+                self.errors.append(f"The balance of {wallet.node_id} differs after reloading.")
+            if balance < -1e-9:
+                self.errors.append(f"{wallet.node_id} has a negative balance.")
+
+    def shutdown(self) -> None:
+        self.pow_engine.shutdown()
+        self.verifier.shutdown()
+        self.broadcaster.shutdown()
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--threads", default="1,2,4,8", help="Submitter thread counts, comma separated.")
+    parser.add_argument("--transactions", type=int, default=300, help="Distinct transactions per run.")
+    parser.add_argument("--funding-blocks", type=int, default=40, help="Reward blocks which fund the wallets.")
+    parser.add_argument("--latency", type=float, default=0.002, help="Seconds a broadcast takes.")
+    args = parser.parse_args()
+
+    working_directory = os.getcwd()
+    temporary_directory = tempfile.mkdtemp(prefix="blockchain-stress-")
+    os.chdir(temporary_directory)
+    failed = False
+    try:
+        fixtures = Fixtures()
+        genesis_node = Blockchain(public_key=None, node_id="genesis", pow_engine=ProofOfWork(workers=1),
+                                  verifier=SignatureVerifier(workers=1), broadcaster=Broadcaster(workers=1))
+        fixtures.signed_transactions(count=args.transactions)
+        print(f"{os.cpu_count()} CPUs, {args.transactions} transactions submitted twice per run\n")
+        print(f"{'threads':>7} {'accepted':>9} {'seconds':>8} {'tx/s':>8} {'blocks (node/peer)':>19} "
+              f"{'broadcasts':>10} {'reads':>7} {'replays':>7}  state")
+        for threads in [int(count) for count in args.threads.split(",") if count]:
+            run = StressRun(fixtures=fixtures, genesis=genesis_node.genesis_block, threads=threads,
+                            transactions=args.transactions, funding_blocks=args.funding_blocks,
+                            latency=args.latency)
+            try:
+                result = run.run()
+            finally:
+                run.shutdown()
+            print(f"{result['threads']:>7} {result['accepted']:>9} {result['seconds']:>8.2f} {result['rate']:>8.1f} "
+                  f"{result['blocks']:>19} {result['broadcasts']:>10} {result['reads']:>7} {result['replays']:>7}  "
+                  f"{'ok' if not run.errors else 'BROKEN'}", flush=True)
+            for error in run.errors:
+                print(f"    {error}")
+            failed = failed or bool(run.errors)
+    finally:
+        os.chdir(working_directory)
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+""" Benchmarks of the core hot paths on synthetic chains, with JSON results and a regression check.
+Run from the repository root:
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.suite --sizes 1000 --compare baseline.json --threshold 0.2
+"""
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from benchmarks.fixtures import Fixtures
+from src.blockchain import Blockchain, TX_ADDED
+from src.broadcast import Broadcaster
+from src.proof_of_work import ProofOfWork
+from src.storage import deserialize_block, serialize_block
+from src.utils.hash_util import hash_block
+from src.utils.merkle import verify_merkle_path
+from src.utils.verification import SignatureVerifier, Verification
+from src.wallet import Wallet
+
+# Previous hashes of the proof of work searches
+POW_SEEDS = ["00" * 32, "11" * 32, "22" * 32]
+
+
+def measure(run, setup=None, repeat: int = 5, number: int = 1) -> dict:
+    """ Times a function.
+    :argument run: The measured function (gets the result of `setup`).
+    :argument setup: Prepares every repetition, outside of the measured time.
+    :argument repeat: The number of samples.
+    :argument number: The calls per sample (the sample is the time per call).
+    :return: Statistics of the samples in seconds.
+    """
+    samples = []
+    for _ in range(repeat):
+        state = setup() if setup is not None else None
+        started = time.perf_counter()
+        for _ in range(number):
+            run(state)
+        samples.append((time.perf_counter() - started) / number)
+    return {
+        "min": min(samples),
+        "median": statistics.median(samples),
+        "mean": statistics.fmean(samples),
+        "stdev": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        "repeat": repeat,
+        "number": number
+    }
+
+
+class Suite:
+    """ Runs the benchmark cases and collects their results.
+    :argument fixtures: The wallets and signed transactions.
+    :argument repeat: The samples per case.
+    """
+
+    def __init__(self, fixtures: Fixtures, repeat: int):
+        self.fixtures = fixtures
+        self.repeat = repeat
+        self.results = []
+        self.pow_engine = ProofOfWork(workers=1)
+        self.verifier = SignatureVerifier(workers=1)
+        self.broadcaster = Broadcaster()
+
+    def record(self, name: str, params: dict, stats: dict) -> None:
+        self.results.append({"name": name, "params": params, "unit": "s", "stats": stats})
+        print(f"{name:<28} {json.dumps(params):<52} median {stats['median'] * 1000:>10.4g} ms", flush=True)
+
+    def blockchain(self, node_id) -> Blockchain:
+        return Blockchain(public_key=self.fixtures.wallets[0].public_key, node_id=node_id, pow_engine=self.pow_engine,
+                          verifier=self.verifier, broadcaster=self.broadcaster)
+
+    def shutdown(self) -> None:
+        self.pow_engine.shutdown()
+        self.verifier.shutdown()
+        self.broadcaster.shutdown()
+
+    def run_block_cases(self, transactions: int) -> None:
+        """ hash_block and valid_of_proof for a block of `transactions` transactions. """
+        genesis = self.blockchain(node_id="genesis").genesis_block
+        block = next(self.fixtures.blocks(count=1, transactions_per_block=transactions, genesis=genesis))
+        legacy_data = serialize_block(block)
+        legacy_data["merkle_root"] = None
+        legacy_data["hash"] = None
+        legacy_block = deserialize_block(legacy_data)
+        params = {"transactions": transactions}
+        self.record("hash_block", params, measure(lambda _: hash_block(block=block), repeat=self.repeat,
+                                                  number=200))
+        self.record("hash_block_legacy", params, measure(lambda _: hash_block(block=legacy_block),
+                                                         repeat=self.repeat, number=200))
+        self.record("valid_of_proof", params, measure(
+            lambda _: Verification.valid_of_proof(transactions=block.transactions[:-1], last_hash=genesis.hash,
+                                                  proof=block.proof), repeat=self.repeat, number=200))
+
+    def run_proof_of_work(self, transactions: int) -> None:
+        """ The time per hash of proof of work searches. The wallet keys differ between runs, so the number of
+        hashes until a proof is found does too, the time per hash doesn't depend on it.
+        """
+        genesis = self.blockchain(node_id="genesis").genesis_block
+        block = next(self.fixtures.blocks(count=1, transactions_per_block=transactions, genesis=genesis))
+        samples = []
+        for seed in POW_SEEDS * self.repeat:
+            self.pow_engine.search(transactions=block.transactions[:-1], last_hash=seed)
+            samples.append(self.pow_engine.last_elapsed / max(1, self.pow_engine.last_hashes))
+        self.record("proof_of_work_per_hash", {"transactions": transactions, "workers": 1}, {
+            "min": min(samples),
+            "median": statistics.median(samples),
+            "mean": statistics.fmean(samples),
+            "stdev": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+            "repeat": len(samples),
+            "number": 1
+        })
+
+    def run_wallet_cases(self) -> None:
+        """ Signature verification, without and with the caches. """
+        transactions = self.fixtures.signed_transactions(count=20)
+
+        def verify_all(_):
+            for tx in transactions:
+                Wallet.verify_transaction(transaction=tx)
+
+        self.record("verify_transaction_cold", {"transactions": len(transactions)},
+                    measure(verify_all, setup=Wallet.clear_caches, repeat=self.repeat))
+        self.record("verify_transaction_warm", {"transactions": len(transactions)},
+                    measure(verify_all, repeat=self.repeat))
+
+    def run_verify_chain(self, blocks: int, transactions: int) -> None:
+        """ verify_chain on a mined chain (fresh block objects every time, so hashes are really checked). """
+        genesis = self.blockchain(node_id="genesis").genesis_block
+        chain = [serialize_block(block) for block in
+                 self.fixtures.mined_blocks(count=blocks - 1, transactions_per_block=transactions, genesis=genesis)]
+        self.record("verify_chain", {"blocks": blocks, "transactions": transactions}, measure(
+            Verification.verify_chain, setup=lambda: [deserialize_block(data) for data in chain],
+            repeat=self.repeat))
+
+    def run_storage_cases(self, blocks: int, mempool: int, transactions: int) -> None:
+        """ load_data, save_data, get_balance and get_merkle_proof on a chain of `blocks` blocks with `mempool` open
+        transactions.
+        """
+        node_id = f"{blocks}-{mempool}"
+        genesis = self.blockchain(node_id="genesis").genesis_block
+        directory = self.fixtures.write_chain(node_id=node_id, blocks=blocks, transactions_per_block=transactions,
+                                              genesis=genesis)
+        blockchain = self.blockchain(node_id=node_id)
+        # Every wallet received enough rewards to pay for its share of the open transactions
+        results = blockchain.add_transactions(transactions=self.fixtures.mempool(count=mempool), is_receiving=True)
+        if results.count(TX_ADDED) != mempool:
+            raise RuntimeError(f"Only {results.count(TX_ADDED)} of {mempool} open transactions were accepted.")
+        blockchain.save_data()
+        params = {"blocks": blocks, "mempool": mempool, "transactions": transactions}
+        ledger_path = os.path.join(directory, "ledger.json")
+        with open(ledger_path) as file:
+            checkpoint = file.read()
+
+        def without_checkpoint():
+            os.remove(ledger_path)
+
+        def with_checkpoint():
+            with open(ledger_path, mode="w") as file:
+                file.write(checkpoint)
+
+        self.record("load_data_rebuild", params, measure(lambda _: self.blockchain(node_id=node_id),
+                                                         setup=without_checkpoint, repeat=self.repeat))
+        with_checkpoint()
+        self.record("load_data_checkpoint", params, measure(lambda _: self.blockchain(node_id=node_id),
+                                                            setup=with_checkpoint, repeat=self.repeat))
+        self.record("save_data", params, measure(lambda _: blockchain.save_data(), repeat=self.repeat))
+        participants = [wallet.public_key for wallet in self.fixtures.wallets]
+        self.record("get_balance", params, measure(
+            lambda _: [blockchain.get_balance(sender=participant) for participant in participants],
+            repeat=self.repeat, number=100))
+        # Transactions spread over the chain, every proof is checked once (which also builds the transaction index)
+        proven = [blockchain.chain[height].transactions[0].id for height in range(1, blocks, max(1, blocks // 100))]
+        for transaction_id in proven:
+            proof = blockchain.get_merkle_proof(transaction_id=transaction_id)
+            if proof is None or not verify_merkle_path(leaf=transaction_id, path=proof["path"],
+                                                       root=proof["header"]["merkle_root"]):
+                raise RuntimeError(f"The inclusion proof of transaction {transaction_id} doesn't verify.")
+        self.record("merkle_proof", dict(params, proofs=len(proven)), measure(
+            lambda _: [blockchain.get_merkle_proof(transaction_id=transaction_id) for transaction_id in proven],
+            repeat=self.repeat))
+        shutil.rmtree(directory)
+
+
+def metadata(args) -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "arguments": vars(args)
+    }
+
+
+def compare(results: list, baseline: dict, threshold: float) -> list:
+    """ Compares the best times of the results with a baseline run (the minimum is the least noisy statistic,
+    the noise of a busy machine only ever adds time).
+    :argument results: The results of this run.
+    :argument baseline: A document written by `--output`.
+    :argument threshold: The relative slowdown which counts as a regression (0.2 = 20 %).
+    :return: The cases which regressed.
+    """
+    baseline_results = {(entry["name"], json.dumps(entry["params"], sort_keys=True)): entry
+                        for entry in baseline["results"]}
+    regressions = []
+    print(f"\n{'case':<28} {'params':<52} {'baseline ms':>12} {'current ms':>12} {'change':>8}")
+    for entry in results:
+        key = (entry["name"], json.dumps(entry["params"], sort_keys=True))
+        previous = baseline_results.get(key)
+        if previous is None:
+            continue
+        before, after = previous["stats"]["min"], entry["stats"]["min"]
+        change = after / before - 1 if before else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append({"name": entry["name"], "params": entry["params"], "change": change})
+        print(f"{entry['name']:<28} {json.dumps(entry['params']):<52} {before * 1000:>12.4g} {after * 1000:>12.4g}"
+              f" {change:>+8.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="1000,10000,100000", help="Chain lengths (blocks), comma separated.")
+    parser.add_argument("--mempool", default="0,1000", help="Open transaction counts, comma separated.")
+    parser.add_argument("--block-transactions", type=int, default=4, help="Transactions per synthetic block.")
+    parser.add_argument("--verify-blocks", type=int, default=20, help="Length of the mined chain for verify_chain.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", help="Compare with the results of an earlier run (a JSON file).")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Slowdown which counts as a regression.")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    mempools = [int(count) for count in args.mempool.split(",") if count]
+
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    document = {"meta": metadata(args), "results": []}
+
+    working_directory = os.getcwd()
+    temporary_directory = tempfile.mkdtemp(prefix="blockchain-benchmarks-")
+    os.chdir(temporary_directory)
+    suite = Suite(fixtures=Fixtures(), repeat=args.repeat)
+    try:
+        suite.run_block_cases(transactions=100)
+        suite.run_proof_of_work(transactions=args.block_transactions)
+        suite.run_wallet_cases()
+        suite.run_verify_chain(blocks=args.verify_blocks, transactions=args.block_transactions)
+        for blocks in sizes:
+            for mempool in mempools:
+                suite.run_storage_cases(blocks=blocks, mempool=mempool, transactions=args.block_transactions)
+    finally:
+        suite.shutdown()
+        os.chdir(working_directory)
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+    document["results"] = suite.results
+
+    if output:
+        with open(output, mode="w") as file:
+            json.dump(document, file, indent=2)
+    if baseline is not None:
+        regressions = compare(results=suite.results, baseline=baseline, threshold=args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regressions above {args.threshold:.0%}.")
+            sys.exit(1)
+        print("\nNo regressions.")
+
+
+if __name__ == "__main__":
+    main()
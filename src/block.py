@@ -1,20 +1,73 @@
 from time import time
+from typing import Optional
 
+from src.utils.hash_util import hash_block
+from src.utils.immutable import Immutable
+from src.utils.merkle import merkle_path, merkle_root
 from src.utils.printable import Printable
 
 
-class Block(Printable):
-    """ A single block of blockchain.
+class Block(Printable, Immutable):
+    """ A single, immutable block of blockchain.
     :argument index: The index of this block.
     :argument previous_hash: The hash of the previous block in the blockchain.
     :argument transactions: A list of transaction which are included in the block.
     :argument proof: The proof of work number that yielded this block.
     :argument timestamp: The timestamp of the block (automatically generated by default).
+    :argument block_hash: The stored hash of the block (calculated on first use by default).
+    :argument merkle_root: The Merkle root over the transaction ids (None for blocks created before Merkle roots,
+        whose hash commits to the transactions directly).
+    :argument difficulty: The expected number of hashes to find the proof (None for blocks created before
+        difficulties were stored, which have the legacy difficulty, see `src.difficulty`).
     """
 
-    def __init__(self, index, previous_hash, transactions, proof, timestamp=None):
-        self.index = index
-        self.previous_hash = previous_hash
-        self.transactions = transactions
-        self.proof = proof
-        self.timestamp = time() if timestamp is None else timestamp
+    __slots__ = ("index", "previous_hash", "transactions", "proof", "timestamp", "merkle_root", "difficulty",
+                 "__hash", "__hash_checked")
+
+    def __init__(self, index, previous_hash, transactions, proof, timestamp=None, block_hash=None,
+                 merkle_root=None, difficulty=None):
+        object.__setattr__(self, "index", index)
+        object.__setattr__(self, "previous_hash", previous_hash)
+        object.__setattr__(self, "transactions", tuple(transactions))
+        object.__setattr__(self, "proof", proof)
+        object.__setattr__(self, "timestamp", time() if timestamp is None else timestamp)
+        object.__setattr__(self, "merkle_root", merkle_root)
+        object.__setattr__(self, "difficulty", difficulty)
+        object.__setattr__(self, "_Block__hash", block_hash)
+        # A hash calculated here is correct, a stored hash or root has to be checked against the block contents
+        object.__setattr__(self, "_Block__hash_checked", block_hash is None and merkle_root is None)
+
+    @staticmethod
+    def calculate_merkle_root(transactions) -> str:
+        """ Calculates the Merkle root over the ids of transactions (for a new block). """
+        return merkle_root(leaves=[tx.id for tx in transactions])
+
+    def merkle_path(self, transaction_id: str) -> Optional[list]:
+        """ Returns the inclusion proof of a transaction of the block.
+        :argument transaction_id: The id of the transaction.
+        :return: The Merkle path (see `merkle_path`) or None if the transaction isn't part of the block.
+        """
+        leaves = [tx.id for tx in self.transactions]
+        if transaction_id not in leaves:
+            return None
+        return merkle_path(leaves=leaves, index=leaves.index(transaction_id))
+
+    @property
+    def hash(self) -> str:
+        """ Returns the hash of the block. It is calculated once and cached, since blocks are immutable. """
+        if self.__hash is None:
+            object.__setattr__(self, "_Block__hash", hash_block(block=self))
+        return self.__hash
+
+    def check_hash(self) -> bool:
+        """ Checks the stored hash and Merkle root (loaded from disk or received from a peer) against the block
+        contents. A block is only rehashed by its first successful check.
+        :return: True if the hash and the root match the block, otherwise False.
+        """
+        if not self.__hash_checked:
+            if self.merkle_root is not None and self.merkle_root != Block.calculate_merkle_root(self.transactions):
+                return False
+            if self.__hash is not None and hash_block(block=self) != self.__hash:
+                return False
+            object.__setattr__(self, "_Block__hash_checked", True)
+        return True
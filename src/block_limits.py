@@ -0,0 +1,44 @@
+from src import codec
+from src.storage import serialize_transaction
+
+# The maximum number of transactions of a block (including the mining reward)
+MAX_BLOCK_TRANSACTIONS = 2000
+# The maximum size of the transactions of a block in the binary encoding (bytes)
+MAX_BLOCK_BYTES = 1024 * 1024
+
+
+def transaction_size(transaction) -> int:
+    """ Returns the size of a transaction in the binary encoding (on its own, without a shared key table),
+    so every node measures the same size whatever format it received the transaction in.
+    """
+    return len(codec.pack_transaction(data=serialize_transaction(transaction)))
+
+
+class BlockLimits:
+    """ Bounds the number and the size of the transactions of a block, so hashing and validating a block takes
+    bounded time however many transactions are open. Open transactions beyond the limits wait for later blocks.
+    :argument max_transactions: The maximum number of transactions (including the mining reward).
+    :argument max_bytes: The maximum sum of the transaction sizes (see `transaction_size`).
+    """
+
+    def __init__(self, max_transactions: int = MAX_BLOCK_TRANSACTIONS, max_bytes: int = MAX_BLOCK_BYTES):
+        self.max_transactions = max_transactions
+        self.max_bytes = max_bytes
+
+    def check(self, block) -> bool:
+        """ Checks whether a block stays within the limits.
+        :argument block: The block.
+        :return: True if the block has at most `max_transactions` transactions of at most `max_bytes` bytes.
+        """
+        if len(block.transactions) > self.max_transactions:
+            return False
+        size = 0
+        for tx in block.transactions:
+            size += transaction_size(transaction=tx)
+            if size > self.max_bytes:
+                return False
+        return True
+
+
+# The limits of the network (all nodes have to agree on them)
+DEFAULT_LIMITS = BlockLimits()
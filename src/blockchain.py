@@ -1,122 +1,316 @@
+import itertools
 import json
+import os
+import threading
+from http import HTTPStatus
+from time import time
 from typing import Optional, Dict
 
 import requests
 import logging
-import copy
 
+from src import codec
 from src.block import Block
-from src.wallet import Wallet
-from src.transaction import Transaction
-from src.utils.hash_util import hash_block
-from src.utils.verification import Verification
+from src.block_limits import DEFAULT_LIMITS, BlockLimits, transaction_size
+from src.broadcast import Broadcaster
+from src.difficulty import DEFAULT_RULE, MAX_FUTURE_SECONDS, DifficultyRule
+from src.ledger import Ledger
+from src.mempool import Mempool
+from src.proof_of_work import ProofOfWork
+from src.storage import BlockLog, ChainSnapshot, Journal, LazyChain, StateFile, serialize_block, deserialize_block, \
+    serialize_transaction, deserialize_transaction
+from src.transaction import DEFAULT_SCHEME, MINING_REWARD, Transaction
+from src.utils import metrics
+from src.utils.verification import SignatureVerifier, Verification, valid_amount, valid_fee
 
-# The reward we give to miners for creating a new block
-MINING_REWARD = 2
+# The number of headers requested first when looking for the fork point with a peer
+HEADERS_WINDOW = 64
+# The maximum number of transactions submitted at once
+MAX_TRANSACTION_BATCH = 5000
+# The ledger checkpoint is written once this many blocks were appended after it (and when the node stops),
+# the blocks after the checkpoint are booked again on start
+LEDGER_CHECKPOINT_INTERVAL = 100
+
+# Per-transaction results of a batch submission
+TX_ADDED = "added"
+TX_DUPLICATE = "duplicate"
+TX_MALFORMED = "malformed"
+TX_INVALID_SIGNATURE = "invalid_signature"
+TX_INSUFFICIENT_FUNDS = "insufficient_funds"
+
+STORAGE_SECONDS = metrics.histogram("storage_operation_seconds", "Duration of save_data, load_data and journal appends.",
+                                    ["operation"])
+RESOLVE_SECONDS = metrics.histogram("resolve_conflicts_seconds", "Duration of resolving conflicts with the peers.")
+CHAIN_REPLACEMENTS = metrics.counter("chain_replacements_total",
+                                     "Times the local chain was replaced by a longer chain of a peer.")
+
+# Versions are unique within the process, so a replaced Blockchain never repeats the versions of the old one
+_versions = itertools.count(1)
 
 
 class Blockchain:
     """ The class manages the chain of blocks as well as open transactions and the node on which it's running.
+    Changes of the state are serialized by a writer lock, which is never held while signatures are verified,
+    a proof of work is searched or peers are contacted. Reads (chain snapshots, open transactions, balances)
+    don't take the lock.
     :argument public_key: The connected node (witch runs the blockchain).
     :argument node_id: The port witch runs the node.
+    :argument pow_engine: The engine used to search proofs of work (a multi-core one by default).
+    :argument verifier: The batch signature verifier (a multi-core one by default).
+    :argument broadcaster: Sends messages to the peer nodes (a new one by default).
+    :argument difficulty_rule: Decides the difficulty of new blocks (the rule of the network by default).
+    :argument block_limits: Bounds the transactions of a block (the limits of the network by default).
     """
 
-    def __init__(self, public_key, node_id):
+    def __init__(self, public_key, node_id, pow_engine: ProofOfWork = None, verifier: SignatureVerifier = None,
+                 broadcaster: Broadcaster = None, difficulty_rule: DifficultyRule = None,
+                 block_limits: BlockLimits = None):
         self.genesis_block = Block(index=0, previous_hash="", transactions=[], proof=77, timestamp=0)
-        self.chain = [self.genesis_block]
-        self.__open_transactions = []
-        self.public_key = public_key
+        self.__open_transactions = Mempool()
+        self.__public_key = public_key
+        # Replaced instead of changed in place, so it can be iterated without the lock
         self.__peer_nodes = set()
+        self.__lock = threading.RLock()
+        # Bumped by every change of the chain, the open transactions, the peer set and the public key
+        self.chain_version = next(_versions)
+        self.mempool_version = next(_versions)
+        self.peers_version = next(_versions)
+        self.key_version = next(_versions)
         self.node_id = node_id
         self.is_resolve_conflicts = False
+        # Called with the changed parts (chain, mempool) after every change, e.g. to restart mining
+        self.listeners = []
+        self.pow_engine = ProofOfWork() if pow_engine is None else pow_engine
+        self.verifier = SignatureVerifier() if verifier is None else verifier
+        self.broadcaster = Broadcaster() if broadcaster is None else broadcaster
+        self.difficulty_rule = DEFAULT_RULE if difficulty_rule is None else difficulty_rule
+        self.block_limits = DEFAULT_LIMITS if block_limits is None else block_limits
+        self.__ledger = Ledger()
+        self.__storage_directory = f"blockchain-{node_id}"
+        self.__state_file = StateFile(path=os.path.join(self.__storage_directory, "state.json"))
+        self.__ledger_file = StateFile(path=os.path.join(self.__storage_directory, "ledger.json"))
+        # New open transactions are appended here, save_data writes them into the state file and starts over
+        self.__journal = Journal(path=os.path.join(self.__storage_directory, "state.journal"))
+        # The version of the state file the journal belongs to (None if the next change has to save the state)
+        self.__journal_version = None
+        # Bumped whenever the transaction index is dropped, so an index built from an older chain isn't installed
+        self.__index_generation = 0
         self.load_data()
 
     @property
-    def chain(self):
-        return copy.deepcopy(self.__chain)
+    def chain(self) -> ChainSnapshot:
+        """ Returns a read-only snapshot of the chain (blocks are immutable and shared, not copied). """
+        return self.__chain.snapshot()
 
     @chain.setter
     def chain(self, val):
-        self.__chain = val
+        with self.__lock:
+            self.__chain.truncate(height=0)
+            self.__chain.extend(blocks=val)
+            self.__reset_transaction_index()
+            self.__touch(chain=True)
+
+    @property
+    def public_key(self):
+        """ Returns the public key of the node's wallet (receives the mining rewards). """
+        return self.__public_key
+
+    @public_key.setter
+    def public_key(self, val):
+        with self.__lock:
+            self.__public_key = val
+            self.__touch(key=True)
+
+    def __touch(self, chain: bool = False, mempool: bool = False, peers: bool = False, key: bool = False) -> None:
+        """ Bumps the versions of the changed parts of the state and notifies the listeners. """
+        if chain:
+            self.chain_version = next(_versions)
+        if mempool:
+            self.mempool_version = next(_versions)
+        if peers:
+            self.peers_version = next(_versions)
+        if key:
+            self.key_version = next(_versions)
+        if chain or mempool:
+            for listener in self.listeners:
+                listener(chain=chain, mempool=mempool)
 
-    def get_open_transactions(self) -> list:
-        """ Returns a copy of open transactions list. """
-        return copy.deepcopy(self.__open_transactions)
+    def get_open_transactions(self) -> tuple:
+        """ Returns a snapshot of open transactions (transactions are immutable and shared, not copied). """
+        return self.__open_transactions.snapshot()
 
     def load_data(self) -> None:
-        """ Downloads blockchain data, open transactions, and node list from a local file. """
+        """ Opens the block log, and loads open transactions and node list from the state file.
+        Blocks are materialized lazily, only the offset index of the log is read here.
+        A node which still has a `blockchain-<port>.txt` file is migrated to the new storage.
+        """
+        with STORAGE_SECONDS.time(operation="load_data"):
+            self.__chain = LazyChain(block_log=BlockLog(directory=self.__storage_directory))
+            self.__reset_transaction_index()
+            # The chain height of the last ledger checkpoint (None if it has to be written on the next save)
+            self.__checkpoint_height = None
+            is_new = False
+            try:
+                if len(self.__chain) == 0:
+                    if not self.__load_legacy_file() and len(self.__chain) == 0:
+                        self.__chain.append(block=self.genesis_block)
+                    is_new = True
+                else:
+                    state = self.__state_file.load()
+                    if state is not None:
+                        version = state.get("journal", 0)
+                        journaled = self.__journal.load(version=version)
+                        self.__open_transactions = Mempool(transactions=[
+                            deserialize_transaction(tx) for tx in state["open_transactions"] + journaled])
+                        self.__peer_nodes = set(state["peer_nodes"])
+                        self.__journal_version = version
+            except (IOError, KeyError, ValueError) as ex:
+                logging.error(f"Error loading data: {ex}")
+            self.__load_ledger()
+            if is_new:
+                # Saved after the ledger was rebuilt from the new (or migrated) chain, so the ledger checkpoint
+                # written with the blocks has the right balances
+                self.save_data()
+            self.__touch(chain=True, mempool=True, peers=True)
+
+    def __load_ledger(self) -> None:
+        """ Restores the balances from the ledger checkpoint and books the blocks appended after it.
+        The ledger is rebuilt from the whole chain if the checkpoint is missing or doesn't match the chain.
+        """
+        try:
+            checkpoint = self.__ledger_file.load()
+            if checkpoint is not None:
+                height = checkpoint["height"]
+                if 0 < height <= len(self.__chain) and checkpoint["tip_hash"] == self.__chain[height - 1].hash:
+                    self.__ledger.restore(snapshot=checkpoint["balances"])
+                    for block in self.__chain[height:]:
+                        self.__ledger.apply_block(block=block)
+                    for tx in self.__open_transactions:
+                        self.__ledger.add_pending(transaction=tx)
+                    self.__checkpoint_height = height
+                    return
+        except (IOError, KeyError, ValueError) as ex:
+            logging.error(f"Error loading the ledger checkpoint: {ex}")
+        self.__ledger.rebuild(chain=self.__chain, open_transactions=self.__open_transactions)
+        # The next start doesn't have to rebuild again
+        try:
+            self.__save_ledger_checkpoint()
+        except IOError as ex:
+            logging.error(f"Error saving the ledger checkpoint: {ex}")
+
+    def __load_legacy_file(self) -> bool:
+        """ Loads blockchain data, open transactions, and node list from a `blockchain-<port>.txt` file.
+        :return: True if the file was loaded, otherwise False.
+        """
         try:
             with open(f"blockchain-{self.node_id}.txt", mode="r") as file:
                 file_content = file.readlines()
                 # Loading blockchain
                 blockchain = json.loads(file_content[0][:-1])
-                self.chain = [
-                    Block(
-                        index=block["index"],
-                        previous_hash=block["previous_hash"],
-                        transactions=[
-                            Transaction(
-                                sender=tx["sender"],
-                                recipient=tx["recipient"],
-                                signature=tx["signature"],
-                                amount=tx["amount"]
-                            ) for tx in block["transactions"]
-                        ],
-                        proof=block["proof"],
-                        timestamp=block["timestamp"]) for block in blockchain
-                ]
+                self.chain = [deserialize_block(block) for block in blockchain]
                 # Loading open transactions
                 open_transactions = json.loads(file_content[1][:-1])
-                self.__open_transactions = [
-                    Transaction(
-                        sender=tx["sender"],
-                        recipient=tx["recipient"],
-                        signature=tx["signature"],
-                        amount=tx["amount"]
-                    ) for tx in open_transactions
-                ]
+                self.__open_transactions = Mempool(
+                    transactions=[deserialize_transaction(tx) for tx in open_transactions])
                 # Loading node list
                 self.__peer_nodes = set(json.loads(file_content[2]))
+            logging.info(f"Migrating blockchain-{self.node_id}.txt to the block log.")
+            return True
+        except FileNotFoundError:
+            return False
         except (IOError, IndexError) as ex:
             logging.error(f"Error loading data: {ex}")
+            return False
 
     def save_data(self) -> None:
-        """ Saves the current blockchain, open transactions and node list to a file. """
-        try:
-            serialized_chain = [
-                {
-                    "index": block.index,
-                    "previous_hash": block.previous_hash,
-                    "transactions": [tx.__dict__ for tx in block.transactions],
-                    "proof": block.proof,
-                    "timestamp": block.timestamp
-                } for block in self.chain
-            ]
-            serialized_tx = [tx.__dict__ for tx in self.__open_transactions]
-            peer_nodes_list = list(self.__peer_nodes)
-            with open(f"blockchain-{self.node_id}.txt", mode="w") as file:
-                file.write("\n".join([
-                    json.dumps(serialized_chain, ensure_ascii=False),
-                    json.dumps(serialized_tx, ensure_ascii=False),
-                    json.dumps(peer_nodes_list, ensure_ascii=False)
-                ]))
-        except IOError as ex:
-            logging.error(f"Error saving data: {ex}")
+        """ Appends new blocks to the block log and saves open transactions and node list to the state file.
+        The ledger checkpoint is saved every LEDGER_CHECKPOINT_INTERVAL blocks, the journal starts over.
+        """
+        with self.__lock, STORAGE_SECONDS.time(operation="save_data"):
+            try:
+                if self.__chain.flush() and (self.__checkpoint_height is None or len(self.__chain) -
+                                             self.__checkpoint_height >= LEDGER_CHECKPOINT_INTERVAL):
+                    self.__save_ledger_checkpoint()
+                version = (self.__journal_version or 0) + 1
+                self.__state_file.save(data={
+                    "open_transactions": [serialize_transaction(tx) for tx in self.__open_transactions],
+                    "peer_nodes": list(self.__peer_nodes),
+                    "journal": version
+                })
+                # The journal of the former version is ignored from now on, until the new one is started
+                self.__journal_version = None
+                self.__journal.reset(version=version)
+                self.__journal_version = version
+            except IOError as ex:
+                logging.error(f"Error saving data: {ex}")
+
+    def __save_open_transactions(self, transactions: list) -> None:
+        """ Saves new open transactions by appending them to the journal, which doesn't depend on the number of open
+        transactions (the caller holds the lock). Falls back to save_data if the journal can't be used.
+        """
+        if self.__journal_version is not None:
+            try:
+                with STORAGE_SECONDS.time(operation="journal"):
+                    self.__journal.append(records=[serialize_transaction(tx) for tx in transactions])
+                return
+            except IOError as ex:
+                logging.error(f"Error appending to the journal: {ex}")
+                self.__journal_version = None
+        self.save_data()
 
-    def proof_of_work(self) -> int:
+    def __save_ledger_checkpoint(self) -> None:
+        """ Saves the confirmed balances together with the chain height and tip they belong to. """
+        self.__ledger_file.save(data={
+            "height": len(self.__chain),
+            "tip_hash": self.__chain[-1].hash,
+            "balances": self.__ledger.snapshot()
+        })
+        self.__checkpoint_height = len(self.__chain)
+
+    def close(self) -> None:
+        """ Saves the state and a ledger checkpoint for the current tip (called when the node stops). """
+        with self.__lock:
+            self.save_data()
+            if self.__checkpoint_height != len(self.__chain):
+                try:
+                    self.__save_ledger_checkpoint()
+                except IOError as ex:
+                    logging.error(f"Error saving the ledger checkpoint: {ex}")
+
+    def proof_of_work(self, transactions: list = None) -> Optional[int]:
         """ Performs the Proof of Work mechanism by finding a proof value
         that makes the hash meet the difficulty requirements.
-        :return: The value found proof.
+        :argument transactions: The transactions of the new block (the open transactions which fit into it by default).
+        :return: The value found proof or None if the search was cancelled.
         """
-        last_block = self.__chain[-1]
-        last_hash = hash_block(block=last_block)
-        proof = 0
-        while not Verification.valid_of_proof(
-                transactions=self.__open_transactions,
-                last_hash=last_hash,
-                proof=proof):
-            proof += 1
-        return proof
+        with self.__lock:
+            generation = self.pow_engine.generation
+            last_block = self.__chain[-1]
+            if transactions is None:
+                transactions = self.__select_transactions()
+        return self.pow_engine.search(transactions=transactions, last_hash=last_block.hash,
+                                      difficulty=self.next_difficulty(parent=last_block), generation=generation)
+
+    def next_difficulty(self, parent: Block = None) -> int:
+        """ Returns the difficulty of the block after `parent` (the chain tip by default). """
+        if parent is None:
+            parent = self.__chain[-1]
+        return self.difficulty_rule.next_difficulty(height=parent.index + 1, parent_difficulty=parent.difficulty,
+                                                    timestamp_at=self.__timestamp_at)
+
+    def __select_transactions(self) -> list:
+        """ Returns the open transactions of the next block: the best fee per byte first, up to the block limits
+        minus the room of the mining reward.
+        """
+        # The largest reward the block can get (integer amounts up to 2 ** 56 don't encode longer than a float)
+        reward = Transaction(sender="MINING", recipient=self.public_key or "", signature="",
+                             amount=float(MINING_REWARD))
+        return self.__open_transactions.select(max_count=self.block_limits.max_transactions - 1,
+                                               max_bytes=self.block_limits.max_bytes - transaction_size(reward))
+
+    def __timestamp_at(self, height: int) -> float:
+        """ Returns the timestamp of a local block without materializing it. """
+        return self.__chain.header(height=height)["timestamp"]
 
     def get_balance(self, sender: str = None) -> float | None:
         """ Calculates the balance of a blockchain participant.
@@ -129,17 +323,100 @@ class Blockchain:
             participant = self.public_key
         else:
             participant = sender
-        # All sent transactions (in blocks + open)
-        amount_sent = sum(
-            tx.amount for block in self.__chain for tx in block.transactions if tx.sender == participant
-        ) + sum(
-            tx.amount for tx in self.__open_transactions if tx.sender == participant
-        )
-        # All received transactions (in blocks only)
-        amount_received = sum(
-            tx.amount for block in self.__chain for tx in block.transactions if tx.recipient == participant
-        )
-        return amount_received - amount_sent
+        return self.__ledger.balance(participant=participant)
+
+    def get_tip_hash(self) -> str:
+        """ Returns the hash of the last block (cached by the block, so no rehashing). """
+        return self.__chain[-1].hash
+
+    def get_block_hash(self, height: int) -> str:
+        """ Returns the hash of a block without materializing it (block k + 1 stores the hash of block k).
+        :argument height: The index of the block.
+        """
+        if height == len(self.__chain) - 1:
+            return self.get_tip_hash()
+        return self.__chain.header(height=height + 1)["previous_hash"]
+
+    def get_chain_tip(self) -> dict:
+        """ Returns the height of the chain and the hash of its last block. """
+        return {"height": len(self.__chain), "hash": self.get_tip_hash()}
+
+    def get_headers(self, start: int = 0, limit: int = None) -> list:
+        """ Returns block headers (all fields but the transactions, plus the block hash).
+        :argument start: The index of the first block.
+        :argument limit: The maximum number of headers (all up to the tip by default).
+        """
+        end = len(self.__chain) if limit is None else min(len(self.__chain), start + limit)
+        headers = []
+        for height in range(max(0, start), end):
+            header = dict(self.__chain.header(height=height))
+            header["hash"] = self.get_block_hash(height=height)
+            headers.append(header)
+        return headers
+
+    def get_merkle_proof(self, transaction_id: str, height: int = None) -> Optional[dict]:
+        """ Returns the inclusion proof of a confirmed transaction: the header of its block and the Merkle path
+        from the transaction id to the root the block hash commits to.
+        :argument transaction_id: The id of the transaction.
+        :argument height: The index of the block of the transaction (looked up in the transaction index by default).
+        :return: The proof or None if the transaction isn't in the chain (the path is None for blocks without root).
+        """
+        if height is None:
+            height = self.__transaction_index().get(transaction_id)
+        # The block is read from a snapshot, so a replacement of the chain meanwhile can't remove it
+        chain = self.__chain.snapshot()
+        if height is None or not 0 <= height < len(chain):
+            return None
+        block = chain[height]
+        path = block.merkle_path(transaction_id=transaction_id)
+        if path is None:
+            return None
+        header = {
+            "index": block.index,
+            "previous_hash": block.previous_hash,
+            "merkle_root": block.merkle_root,
+            "proof": block.proof,
+            "timestamp": block.timestamp
+        }
+        if block.difficulty is not None:
+            header["difficulty"] = block.difficulty
+        return {
+            "transaction_id": transaction_id,
+            "block_hash": block.hash,
+            "header": header,
+            "path": path if block.merkle_root is not None else None
+        }
+
+    def __transaction_index(self) -> dict:
+        """ Returns the block height of every confirmed transaction id (built on first use, then kept up to date).
+        The index is built from a chain snapshot without the writer lock, so materializing a long chain doesn't stall
+        mining and new blocks. The blocks appended meanwhile are indexed under the lock, a replaced chain starts over.
+        """
+        while True:
+            heights = self.__transaction_heights
+            if heights is not None:
+                return heights
+            generation = self.__index_generation
+            snapshot = self.__chain.snapshot()
+            heights = {}
+            for block in snapshot:
+                for tx in block.transactions:
+                    heights.setdefault(tx.id, block.index)
+            with self.__lock:
+                if self.__transaction_heights is None and generation == self.__index_generation:
+                    self.__transaction_heights = heights
+                    for block in self.__chain[len(snapshot):]:
+                        self.__index_transactions(block=block)
+
+    def __reset_transaction_index(self) -> None:
+        """ Drops the transaction index after the chain was replaced (the caller holds the lock or is loading). """
+        self.__transaction_heights = None
+        self.__index_generation += 1
+
+    def __index_transactions(self, block: Block) -> None:
+        if self.__transaction_heights is not None:
+            for tx in block.transactions:
+                self.__transaction_heights.setdefault(tx.id, block.index)
 
     def get_last_blockchain_value(self):
         """ Returns the last item of the current blockchain. """
@@ -148,88 +425,175 @@ class Blockchain:
         return self.__chain[-1]
 
     def add_transaction(self, recipient: str, sender: str, signature: str, amount=1.0,
-                        is_receiving: bool = False) -> bool:
+                        is_receiving: bool = False, scheme: str = DEFAULT_SCHEME, fee=0) -> bool:
         """ Append a new transaction to the list of open transactions.
         :argument recipient: The recipient of the transaction.
         :argument sender: The sender of the transaction.
         :argument signature: The digital signature of the transaction.
         :argument amount: The amount to transfer (default 1.0).
         :argument is_receiving: A flag to prevent resending when receiving the transaction.
+        :argument scheme: The signature scheme of the sender's key.
+        :argument fee: The fee paid to the miner (higher fees per byte are mined first).
         :return: True if the transaction was added successfully, otherwise False.
         """
-        transaction = Transaction(sender=sender, recipient=recipient, signature=signature, amount=amount)
-        if not Verification.verify_transaction(transaction=transaction, get_balance=self.get_balance):
+        try:
+            transaction = deserialize_transaction({"sender": sender, "recipient": recipient, "signature": signature,
+                                                   "amount": amount, "scheme": scheme, "fee": fee})
+            size = transaction_size(transaction=transaction)
+        except ValueError as ex:
+            logging.warning(f"The transaction is malformed ({ex}).")
             return False
-        self.__open_transactions.append(transaction)
-        self.save_data()
+        if transaction.id in self.__open_transactions:
+            logging.warning("The transaction is already open.")
+            return False
+        # The signature is verified before taking the lock, the check under the lock finds it in the cache
+        if not self.verifier.verify(transactions=[transaction])[0]:
+            return False
+        with self.__lock:
+            if not Verification.verify_transaction(transaction=transaction, get_balance=self.get_balance):
+                return False
+            if not self.__open_transactions.add(transaction=transaction, size=size):
+                logging.warning("The transaction is already open.")
+                return False
+            self.__ledger.add_pending(transaction=transaction)
+            self.__touch(mempool=True)
+            self.__save_open_transactions(transactions=[transaction])
+            peer_nodes = self.__peer_nodes
         if not is_receiving:
-            for node in self.__peer_nodes:
-                url = f"http://{node}:5000/broadcast-transaction"
-                try:
-                    response = requests.post(url=url, json={
-                        "sender": sender,
-                        "recipient": recipient,
-                        "signature": signature,
-                        "amount": amount
-                    })
-                    if response.status_code >= 400:
-                        logging.warning(f"Transaction rejected by node {node}, conflict resolution required.")
-                        return False
-                except requests.exceptions.ConnectionError:
-                    logging.error(f"Failed to connect to node {node}. Skipping it.")
-                    continue
+            payload = serialize_transaction(transaction)
+            result = self.broadcaster.post(nodes=peer_nodes, path="/broadcast-transaction", payload=payload,
+                                           packed=codec.pack_transaction(data=payload))
+            for node in result.rejected:
+                logging.warning(f"Transaction rejected by node {node}, conflict resolution required.")
+            if result.rejected:
+                return False
         return True
 
+    def add_transactions(self, transactions: list, is_receiving: bool = False) -> list[str]:
+        """ Appends a batch of transactions to the open transactions.
+        Signatures are verified as one batch, balances are checked cumulatively in batch order (so a sender can't
+        spend the same coins twice within the batch). The state is saved once and the accepted transactions are
+        sent to every peer as one message.
+        :argument transactions: Dictionaries with sender, recipient, signature, amount and an optional scheme and fee.
+        :argument is_receiving: A flag to prevent resending when receiving the batch.
+        :return: The result of every transaction, in the same order (one of the TX_* values).
+        """
+        results = [TX_MALFORMED] * len(transactions)
+        candidates = {}
+        sizes = {}
+        for position, data in enumerate(transactions):
+            try:
+                transaction = deserialize_transaction(data)
+                # Measured before the lock, so nothing below can fail half way through the batch
+                size = transaction_size(transaction=transaction)
+            except (KeyError, TypeError, ValueError):
+                continue
+            if not valid_amount(transaction.amount) or not valid_fee(transaction.fee):
+                continue
+            if transaction.id in self.__open_transactions or transaction.id in candidates:
+                results[position] = TX_DUPLICATE
+                continue
+            candidates[transaction.id] = (position, transaction)
+            sizes[transaction.id] = size
+        signatures = self.verifier.verify(transactions=[tx for _, tx in candidates.values()])
+        added = []
+        with self.__lock:
+            for (position, transaction), is_valid in zip(candidates.values(), signatures):
+                if not is_valid:
+                    results[position] = TX_INVALID_SIGNATURE
+                elif self.get_balance(sender=transaction.sender) < transaction.amount + transaction.fee:
+                    results[position] = TX_INSUFFICIENT_FUNDS
+                elif not self.__open_transactions.add(transaction=transaction, size=sizes[transaction.id]):
+                    # Added by another request since the duplicate check above
+                    results[position] = TX_DUPLICATE
+                else:
+                    # Booked right away, so the next transaction of the sender sees the reduced balance
+                    self.__ledger.add_pending(transaction=transaction)
+                    results[position] = TX_ADDED
+                    added.append(transaction)
+            if not added:
+                return results
+            self.__touch(mempool=True)
+            self.__save_open_transactions(transactions=added)
+            peer_nodes = self.__peer_nodes
+        if not is_receiving:
+            payload = [serialize_transaction(tx) for tx in added]
+            result = self.broadcaster.post(nodes=peer_nodes, path="/broadcast-transactions",
+                                           payload={"transactions": payload},
+                                           packed=codec.pack_transactions(transactions=payload))
+            for node in result.rejected:
+                logging.warning(f"Transaction batch rejected by node {node}, conflict resolution required.")
+        return results
+
     def mine_block(self) -> Optional[Block]:
         """ Creates a new block, mines it (Proof of Work) and broadcasts it over the network.
+        The block takes the open transactions with the highest fee per byte up to the block limits, the others
+        stay open for later blocks. The miner gets the mining reward plus the fees.
         :return: The created block if mining was successful, otherwise None.
         """
         if self.public_key is None:
             logging.warning("Miner public key missing.")
             return None
-        last_block = self.__chain[-1]
-        hashed_block = hash_block(block=last_block)
-        proof = self.proof_of_work()
+        if self.is_resolve_conflicts:
+            logging.warning("Resolve conflicts first, block not mined.")
+            return None
+        with self.__lock:
+            # A block accepted from now on cancels the search, even before it started
+            generation = self.pow_engine.generation
+            last_block = self.__chain[-1]
+            hashed_block = last_block.hash
+            difficulty = self.next_difficulty(parent=last_block)
+            # Copy open transactions to avoid changes during operation
+            copied_transactions = self.__select_transactions()
+        # Check the correctness of all transactions (as one batch, before spending time on the proof)
+        results = self.verifier.verify(transactions=copied_transactions)
+        if not all(results):
+            logging.warning(f"{results.count(False)} open transactions have not been verified.")
+            return None
+        proof = self.pow_engine.search(transactions=copied_transactions, last_hash=hashed_block,
+                                       difficulty=difficulty, generation=generation)
+        if proof is None:
+            logging.warning("Mining was interrupted (cancelled or a competing block arrived).")
+            return None
         # Create a reward transaction for mining
         reward_transaction = Transaction(
             sender="MINING",
             recipient=self.public_key,
             signature="",
-            amount=MINING_REWARD)
-        # Copy open transactions to avoid changes during operation
-        copied_transactions = copy.deepcopy(self.__open_transactions)
-        # Check the correctness of all transactions
-        if not all(Wallet.verify_transaction(tx) for tx in copied_transactions):
-            logging.warning("Open transactions have not been verified.")
-            return None
+            amount=MINING_REWARD + sum(tx.fee for tx in copied_transactions))
         # Adding a reward transaction
         copied_transactions.append(reward_transaction)
-        # Create and add a new block
-        block = Block(
-            index=len(self.__chain),
-            previous_hash=hashed_block,
-            transactions=copied_transactions,
-            proof=proof)
-        self.__chain.append(block)
-        self.__open_transactions = []
-        self.save_data()
+        with self.__lock:
+            if self.get_tip_hash() != hashed_block:
+                logging.warning("Mining was interrupted (cancelled or a competing block arrived).")
+                return None
+            # Create and add a new block
+            block = Block(
+                index=len(self.__chain),
+                previous_hash=hashed_block,
+                transactions=copied_transactions,
+                proof=proof,
+                merkle_root=Block.calculate_merkle_root(copied_transactions),
+                difficulty=difficulty)
+            self.__chain.append(block)
+            self.__index_transactions(block=block)
+            # Transactions received while mining are kept for the next block
+            for tx in self.__open_transactions.remove_many(transactions=copied_transactions):
+                self.__ledger.remove_pending(transaction=tx)
+            self.__ledger.apply_block(block=block)
+            self.__touch(chain=True, mempool=True)
+            self.save_data()
+            peer_nodes = self.__peer_nodes
         # Sending a block over the network
-        for node in self.__peer_nodes:
-            url = f"http://{node}:5000/broadcast-block"
-            converted_block = block.__dict__.copy()
-            converted_block["transactions"] = [tx.__dict__ for tx in converted_block["transactions"]]
-            try:
-                response = requests.post(url=url, json={
-                    "block": converted_block
-                })
-                if response.status_code >= 400:
-                    logging.warning(f"Block declined by node {node}, conflict resolution required.")
-                if response.status_code == 409:
-                    self.is_resolve_conflicts = True
-                    logging.info("Chain conflict detected, resolution started")
-            except requests.exceptions.ConnectionError:
-                logging.error(f"Failed to connect to node {node}. Skipping it.")
-                continue
+        block_data = serialize_block(block)
+        result = self.broadcaster.post(nodes=peer_nodes, path="/broadcast-block", payload={
+            "block": block_data
+        }, packed=codec.pack_block(data=block_data))
+        for node in result.rejected:
+            logging.warning(f"Block declined by node {node}, conflict resolution required.")
+        if result.conflicts:
+            self.is_resolve_conflicts = True
+            logging.info("Chain conflict detected, resolution started")
         return block
 
     def add_block(self, block: Dict) -> bool:
@@ -237,104 +601,211 @@ class Blockchain:
         :argument block: A dictionary containing the block data.
         :return: True if the block was successfully added, otherwise False.
         """
-        transactions = [Transaction(
-            sender=tx["sender"],
-            recipient=tx["recipient"],
-            signature=tx["signature"],
-            amount=tx["amount"]) for tx in block["transactions"]]
-        proof_is_valid = Verification.valid_of_proof(
-            transactions=transactions[:-1],
-            last_hash=block["previous_hash"],
-            proof=block["proof"])
-        hashes_match = hash_block(self.chain[-1]) == block["previous_hash"]
-        if not proof_is_valid or not hashes_match:
+        try:
+            new_block = deserialize_block(block)
+        except (KeyError, TypeError, ValueError) as ex:
+            logging.warning(f"The block is malformed ({ex}). Decline.")
+            return False
+        transactions = new_block.transactions
+        parent = self.__chain[-1]
+        if parent.hash != new_block.previous_hash or new_block.index != parent.index + 1:
             logging.warning("The block didn't pass the check. Decline.")
             return False
-        self.__chain.append(Block(
-            index=block["index"],
-            previous_hash=block["previous_hash"],
-            transactions=transactions,
-            proof=block["proof"],
-            timestamp=block["timestamp"]))
-        # If there are any open transactions that are already included in the block, we delete them
-        if self.__open_transactions:
-            stored_transactions = copy.deepcopy(self.__open_transactions)
-            for itx in block["transactions"]:
-                for open_tx in stored_transactions:
-                    if (open_tx.sender == itx["sender"] and
-                            open_tx.recipient == itx["recipient"] and
-                            open_tx.signature == itx["signature"] and
-                            open_tx.amount == itx["amount"]):
-                        if open_tx in self.__open_transactions:
-                            self.__open_transactions.remove(open_tx)
-        self.save_data()
+        # The difficulty is checked before the proof is checked against it
+        if not self.difficulty_rule.check(block=new_block, parent=parent, timestamp_at=self.__timestamp_at):
+            logging.warning("The block doesn't have the difficulty the chain requires. Decline.")
+            return False
+        if not Verification.valid_of_proof(transactions=transactions[:-1], last_hash=new_block.previous_hash,
+                                           proof=new_block.proof, difficulty=new_block.difficulty):
+            logging.warning("The block didn't pass the check. Decline.")
+            return False
+        # Checked before the limits, which measure the (encoded) fees
+        if not Verification.verify_block_fees(block=new_block):
+            logging.warning("The block has invalid fees or a wrong mining reward. Decline.")
+            return False
+        if not self.block_limits.check(block=new_block):
+            logging.warning("The block exceeds the block limits. Decline.")
+            return False
+        if new_block.timestamp > time() + MAX_FUTURE_SECONDS:
+            logging.warning("The block timestamp is too far in the future. Decline.")
+            return False
+        if not new_block.check_hash():
+            logging.warning("The block hash or Merkle root doesn't match the block. Decline.")
+            return False
+        if not Verification.verify_chain_transactions(blockchain=[new_block], verifier=self.verifier):
+            logging.warning("The block contains invalid signatures. Decline.")
+            return False
+        with self.__lock:
+            # Another block may have been added while this one was checked
+            if self.get_tip_hash() != block["previous_hash"]:
+                logging.warning("The block doesn't follow the chain tip anymore. Decline.")
+                return False
+            try:
+                self.__chain.append(new_block)
+            except ValueError as ex:
+                logging.warning(f"The block can't be stored ({ex}). Decline.")
+                return False
+            self.__index_transactions(block=new_block)
+            self.__ledger.apply_block(block=new_block)
+            # A competing block for the height we are mining was accepted, stop the search
+            self.pow_engine.cancel()
+            # If there are any open transactions that are already included in the block, we delete them
+            for open_tx in self.__open_transactions.remove_many(transactions=transactions):
+                self.__ledger.remove_pending(transaction=open_tx)
+            self.__touch(chain=True, mempool=True)
+            self.save_data()
         logging.info("The block has been successfully added to the chain.")
         return True
 
     def resolve_conflicts(self) -> bool:
         """ Resolves conflicts in the blockchain by choosing the longest valid chain.
+        Peers are synced headers-first: the tip of every peer is compared with the local one, the fork point
+        is found by comparing header hashes and only the blocks after it are downloaded and verified. The whole chain
+        is downloaded from peers which don't have the `/chain/tip` endpoint.
         :return: True if the local chain has been replaced, otherwise False.
         """
-        winner_chain = self.chain
-        replace = False
-        for node in self.__peer_nodes:
-            url = f"http://{node}:5000/chain"
-            try:
-                response = requests.get(url, timeout=5)
-                response.raise_for_status()
-                node_chain_data = response.json()
-                if not isinstance(node_chain_data, list):
-                    logging.warning(f"Invalid chain received from {node}. Skipping it.")
-                    continue
-                node_chain_length = len(node_chain_data)
-                local_chain_length = len(self.chain)
-                if node_chain_length <= local_chain_length:
-                    continue  # Discard the chain if it is shorter
-                node_chain = [
-                    Block(
-                        index=block["index"],
-                        previous_hash=block["previous_hash"],
-                        transactions=[
-                            Transaction(
-                                sender=tx["sender"],
-                                recipient=tx["recipient"],
-                                signature=tx["signature"],
-                                amount=tx["amount"]
-                            ) for tx in block["transactions"]
-                        ],
-                        proof=block["proof"],
-                        timestamp=block["timestamp"]) for block in node_chain_data
-                ]
-                if Verification.verify_chain(node_chain):
-                    winner_chain = node_chain
-                    replace = True
-            except requests.exceptions.RequestException as e:
-                logging.error(f"Error requesting {node}: {e}")
-            except (KeyError, TypeError, ValueError) as e:
-                logging.error(f"Error processing chain data from {node}: {e}")
-        self.is_resolve_conflicts = False
-        self.chain = winner_chain
+        with RESOLVE_SECONDS.time():
+            replace = self.__resolve_conflicts()
         if replace:
-            self.__open_transactions = []
-            logging.info("The chain was replaced with a longer one..")
-        else:
-            logging.info("The local chain remains unchanged.")
-        self.save_data()
+            CHAIN_REPLACEMENTS.inc()
         return replace
 
+    def __resolve_conflicts(self) -> bool:
+        winner = None
+        best_height = len(self.__chain)
+        try:
+            for node in self.__peer_nodes:
+                try:
+                    response = self.broadcaster.get(node=node, path="/chain/tip")
+                    if response.status_code == HTTPStatus.NOT_FOUND:
+                        # A peer without the headers endpoints only serves its whole chain
+                        fork = 0
+                    else:
+                        response.raise_for_status()
+                        node_height = response.json()["height"]
+                        if node_height <= best_height:
+                            continue  # Discard the chain if it is shorter
+                        fork = self.__find_fork_point(node=node, node_height=node_height)
+                    response = self.broadcaster.get(node=node, path="/chain", params={"from": fork},
+                                                    headers={"Accept": codec.ACCEPT})
+                    response.raise_for_status()
+                    if response.headers.get("Content-Type", "").startswith(codec.MEDIA_TYPE):
+                        suffix_data = codec.unpack_blocks(response.content)
+                    else:
+                        suffix_data = response.json()
+                    if not isinstance(suffix_data, list):
+                        logging.warning(f"Invalid chain received from {node}. Skipping it.")
+                        continue
+                    suffix = [deserialize_block(block) for block in suffix_data]
+                    if fork + len(suffix) <= best_height:
+                        continue
+                    if self.__verify_suffix(fork=fork, suffix=suffix):
+                        winner = (fork, suffix)
+                        best_height = fork + len(suffix)
+                except requests.exceptions.RequestException as e:
+                    logging.error(f"Error requesting {node}: {e}")
+                except (KeyError, TypeError, ValueError) as e:
+                    logging.error(f"Error processing chain data from {node}: {e}")
+        finally:
+            # Also reset if a peer sent data which failed in an unexpected way, so mining isn't blocked
+            self.is_resolve_conflicts = False
+        with self.__lock:
+            replace = winner is not None and self.__replace_suffix(fork=winner[0], suffix=winner[1])
+            if not replace:
+                logging.info("The local chain remains unchanged.")
+            self.save_data()
+        return replace
+
+    def __replace_suffix(self, fork: int, suffix: list) -> bool:
+        """ Replaces the blocks after the fork point (the caller holds the lock).
+        :return: False if the local chain changed since the suffix was verified and the suffix doesn't apply anymore,
+            or if the suffix can't be stored.
+        """
+        anchor_matches = fork == 0 or self.__chain[fork - 1].hash == suffix[0].previous_hash
+        if not anchor_matches or fork + len(suffix) <= len(self.__chain):
+            logging.warning("The local chain changed while the longer chain was verified.")
+            return False
+        replaced = self.__chain[fork:]
+        # Blocks after the fork point are rewritten by save_data
+        try:
+            self.__chain.replace(height=fork, blocks=suffix)
+        except ValueError as ex:
+            logging.warning(f"The longer chain can't be stored ({ex}).")
+            return False
+        except IOError as ex:
+            logging.error(f"Error truncating the block log, keeping the local chain: {ex}")
+            return False
+        # Only the blocks after the fork point change the balances
+        for block in reversed(replaced):
+            self.__ledger.revert_block(block=block)
+        for block in suffix:
+            self.__ledger.apply_block(block=block)
+        self.__ledger.clear_pending()
+        if self.__checkpoint_height is not None and fork < self.__checkpoint_height:
+            # The checkpoint contains replaced blocks, the next save writes a new one
+            self.__checkpoint_height = None
+        self.__reset_transaction_index()
+        self.__open_transactions.clear()
+        self.__touch(chain=True, mempool=True)
+        logging.info(f"The chain was replaced with a longer one from block {fork}.")
+        return True
+
+    def __find_fork_point(self, node: str, node_height: int) -> int:
+        """ Finds the number of leading blocks the local chain shares with the chain of a peer.
+        Headers are requested in a window below the shorter tip, the window doubles until a common hash is found.
+        :argument node: The peer node.
+        :argument node_height: The length of the chain of the peer.
+        :return: The height of the fork point (0 if even the genesis blocks differ).
+        """
+        local_height = len(self.__chain)
+        top = min(local_height, node_height)
+        window = HEADERS_WINDOW
+        while True:
+            start = max(0, top - window)
+            response = self.broadcaster.get(node=node, path="/chain/headers",
+                                            params={"from": start, "limit": top - start})
+            response.raise_for_status()
+            for header in reversed(response.json()):
+                height = header["index"]
+                if height < local_height and header["hash"] == self.get_block_hash(height=height):
+                    return height + 1
+            if start == 0:
+                return 0
+            window *= 2
+
+    def __verify_suffix(self, fork: int, suffix: list) -> bool:
+        """ Checks the blocks of a peer which follow the fork point.
+        :argument fork: The height of the fork point.
+        :argument suffix: The blocks of the peer starting at the fork point.
+        :return: True if the blocks form a valid continuation of the first `fork` local blocks.
+        """
+        if not suffix or any(block.index != fork + offset for offset, block in enumerate(suffix)):
+            logging.warning("The received blocks don't follow the fork point.")
+            return False
+        # The last common block anchors the suffix (its hash is checked by the first received block)
+        anchored = suffix if fork == 0 else [self.__chain[fork - 1]] + suffix
+        return (Verification.verify_chain(anchored, timestamp_at=self.__timestamp_at, rule=self.difficulty_rule,
+                                          limits=self.block_limits) and
+                Verification.verify_chain_transactions(blockchain=suffix, verifier=self.verifier))
+
     def add_peer_node(self, node):
         """ Adds new node in the peer node set.
         :argument node: The node URL which should be added.
         """
-        self.__peer_nodes.add(node)
-        self.save_data()
+        with self.__lock:
+            self.__peer_nodes = self.__peer_nodes | {node}
+            self.__touch(peers=True)
+            self.save_data()
 
     def remove_peer_node(self, node):
         """ Removes a node from the peer node set.
         :argument node: The node URL which should be removed.
         """
-        self.__peer_nodes.discard(node)
-        self.save_data()
+        with self.__lock:
+            self.__peer_nodes = self.__peer_nodes - {node}
+            self.__touch(peers=True)
+            self.save_data()
+        self.broadcaster.forget(node=node)
 
     def get_peer_nodes(self):
         """ Returns a list of all connected peer nodes. """
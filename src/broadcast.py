@@ -0,0 +1,138 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from http import HTTPStatus
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from src import codec
+from src.utils import metrics
+
+# The port every node listens on
+NODE_PORT = 5000
+# Seconds a peer has to answer before it is skipped
+PEER_TIMEOUT = 5.0
+
+BROADCAST_SECONDS = metrics.histogram("broadcast_seconds", "Latency of messages sent to a peer.", ["peer", "path"])
+BROADCAST_FAILURES = metrics.counter("broadcast_failures_total",
+                                     "Messages a peer didn't receive (connection errors and timeouts).",
+                                     ["peer", "reason"])
+
+
+class BroadcastResult:
+    """ The aggregate outcome of sending a message to all peers.
+    `status_codes` holds the HTTP status of every peer which answered, `failures` the error of every peer
+    which couldn't be reached or didn't answer in time.
+    """
+
+    def __init__(self):
+        self.status_codes = {}
+        self.failures = {}
+
+    @property
+    def rejected(self) -> list:
+        """ Returns the peers which answered with an error status. """
+        return [node for node, status in self.status_codes.items() if status >= HTTPStatus.BAD_REQUEST]
+
+    @property
+    def conflicts(self) -> list:
+        """ Returns the peers which reported a chain conflict (409). """
+        return [node for node, status in self.status_codes.items() if status == HTTPStatus.CONFLICT]
+
+
+class Broadcaster:
+    """ Sends messages to the peer nodes concurrently over a thread pool.
+    Every peer has its own session, so connections are kept alive and reused between messages.
+    Messages are sent in the binary encoding if one is given, peers which don't support it (415) get JSON from then on.
+    :argument workers: The number of threads which send messages.
+    :argument timeout: The seconds a peer has to answer.
+    """
+
+    def __init__(self, workers: int = 16, timeout: float = PEER_TIMEOUT):
+        self.timeout = timeout
+        self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="broadcast")
+        self.__sessions = {}
+        self.__sessions_lock = threading.Lock()
+        self.__json_only = set()
+
+    def session(self, node: str) -> requests.Session:
+        """ Returns the keep-alive session of a peer. """
+        with self.__sessions_lock:
+            session = self.__sessions.get(node)
+            if session is None:
+                session = requests.Session()
+                session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+                self.__sessions[node] = session
+            return session
+
+    def get(self, node: str, path: str, params: dict = None, headers: dict = None) -> requests.Response:
+        """ Sends a GET request to a peer over its session.
+        :argument node: The peer node.
+        :argument path: The path of the endpoint (e.g. "/chain").
+        :argument params: The query parameters.
+        :argument headers: Additional request headers (e.g. Accept).
+        :return: The response of the peer.
+        """
+        url = f"http://{node}:{NODE_PORT}{path}"
+        return self.session(node).get(url, params=params, headers=headers, timeout=self.timeout)
+
+    def post(self, nodes, path: str, payload: dict, packed: bytes = None) -> BroadcastResult:
+        """ Sends a message to all peers at the same time and waits at most `timeout` for the answers.
+        :argument nodes: The peer nodes.
+        :argument path: The path of the endpoint (e.g. "/broadcast-block").
+        :argument payload: The JSON message.
+        :argument packed: The same message in the binary encoding (optional).
+        :return: The aggregate result.
+        """
+        result = BroadcastResult()
+        futures = {
+            self.__executor.submit(self.__post, node, path, payload, packed): node for node in nodes
+        }
+        done, not_done = wait(futures, timeout=self.timeout)
+        for future in done:
+            node = futures[future]
+            try:
+                result.status_codes[node] = future.result()
+            except requests.exceptions.RequestException as ex:
+                logging.error(f"Failed to connect to node {node}. Skipping it.")
+                result.failures[node] = ex
+                BROADCAST_FAILURES.inc(peer=node, reason="connection")
+        for future in not_done:
+            node = futures[future]
+            logging.error(f"Node {node} didn't answer in time. Skipping it.")
+            result.failures[node] = TimeoutError(f"No answer within {self.timeout} seconds.")
+            BROADCAST_FAILURES.inc(peer=node, reason="timeout")
+        return result
+
+    def __post(self, node: str, path: str, payload: dict, packed: bytes = None) -> int:
+        with BROADCAST_SECONDS.time(peer=node, path=path):
+            return self.__send(node=node, path=path, payload=payload, packed=packed)
+
+    def __send(self, node: str, path: str, payload: dict, packed: bytes = None) -> int:
+        url = f"http://{node}:{NODE_PORT}{path}"
+        session = self.session(node)
+        if packed is not None and node not in self.__json_only:
+            response = session.post(url=url, data=packed, headers={"Content-Type": codec.MEDIA_TYPE},
+                                    timeout=self.timeout)
+            if response.status_code != HTTPStatus.UNSUPPORTED_MEDIA_TYPE:
+                return response.status_code
+            logging.info(f"Node {node} doesn't accept the binary encoding, falling back to JSON.")
+            self.__json_only.add(node)
+        return session.post(url=url, json=payload, timeout=self.timeout).status_code
+
+    def forget(self, node: str) -> None:
+        """ Closes the session of a peer which was removed. """
+        with self.__sessions_lock:
+            session = self.__sessions.pop(node, None)
+            self.__json_only.discard(node)
+        if session is not None:
+            session.close()
+
+    def shutdown(self) -> None:
+        """ Stops the threads and closes all sessions. """
+        self.__executor.shutdown(wait=False)
+        with self.__sessions_lock:
+            sessions, self.__sessions = self.__sessions, {}
+        for session in sessions.values():
+            session.close()
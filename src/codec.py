@@ -0,0 +1,345 @@
+import struct
+from collections import Counter
+from typing import Optional
+
+# The media type of the binary encoding, JSON stays the fallback for peers which don't accept it
+MEDIA_TYPE = "application/vnd.blockchain.binary"
+# Accept header of requests which can handle both encodings
+ACCEPT = f"{MEDIA_TYPE}, application/json;q=0.9"
+
+# Every document starts with the magic bytes, the format version and the document kind
+MAGIC = b"\xb7\xc1"
+# Version 2 added the Merkle root to the block header, version 3 the signature scheme of transactions,
+# version 4 the difficulty to the block header, version 5 the fee of transactions, older documents are still read
+VERSION = 5
+SUPPORTED_VERSIONS = (1, 2, 3, 4, 5)
+KIND_TRANSACTION = 1
+KIND_BLOCK = 2
+KIND_BLOCKS = 3
+KIND_TRANSACTIONS = 4
+
+# Field tags
+TAG_TEXT = 0
+TAG_HEX = 1
+TAG_KEY = 2
+TAG_INT = 3
+TAG_FLOAT = 4
+TAG_NONE = 5
+
+# Strings of at least this length which occur more than once in a document are stored once in its key table
+INTERN_MIN_LENGTH = 64
+
+_FLOAT = struct.Struct("<d")
+
+
+def _hex_bytes(value: str) -> Optional[bytes]:
+    """ Returns the bytes of a lowercase hex string, or None if the string wouldn't survive the round trip. """
+    if len(value) % 2:
+        return None
+    try:
+        raw = bytes.fromhex(value)
+    except ValueError:
+        return None
+    return raw if raw.hex() == value else None
+
+
+class _Writer:
+    """ Appends length-prefixed fields to a buffer. """
+
+    def __init__(self, keys: dict = None):
+        self.buffer = bytearray()
+        self.keys = {} if keys is None else keys
+
+    def varint(self, value: int) -> None:
+        while value >= 0x80:
+            self.buffer.append((value & 0x7f) | 0x80)
+            value >>= 7
+        self.buffer.append(value)
+
+    def raw(self, value: bytes) -> None:
+        self.varint(len(value))
+        self.buffer += value
+
+    def string(self, value: str) -> None:
+        key = self.keys.get(value)
+        if key is not None:
+            self.buffer.append(TAG_KEY)
+            self.varint(key)
+        else:
+            raw = _hex_bytes(value)
+            if raw is not None:
+                self.buffer.append(TAG_HEX)
+                self.raw(raw)
+            else:
+                self.buffer.append(TAG_TEXT)
+                self.raw(value.encode("utf-8"))
+
+    def number(self, value) -> None:
+        if value is None:
+            self.buffer.append(TAG_NONE)
+        elif isinstance(value, int) and not isinstance(value, bool):
+            self.buffer.append(TAG_INT)
+            # Zigzag encoding keeps small negative numbers short
+            self.varint(value << 1 if value >= 0 else (-value << 1) - 1)
+        elif isinstance(value, float):
+            self.buffer.append(TAG_FLOAT)
+            self.buffer += _FLOAT.pack(value)
+        else:
+            raise ValueError(f"Unsupported number {value!r}.")
+
+    def optional_string(self, value) -> None:
+        if value is None:
+            self.buffer.append(TAG_NONE)
+        else:
+            self.string(value)
+
+    def transaction(self, data: dict) -> None:
+        self.string(data["sender"])
+        self.string(data["recipient"])
+        self.number(data["amount"])
+        self.string(data["signature"])
+        self.optional_string(data.get("scheme"))
+        self.number(data.get("fee"))
+
+    def block(self, data: dict) -> None:
+        self.number(data["index"])
+        self.string(data["previous_hash"])
+        self.number(data["proof"])
+        self.number(data["timestamp"])
+        self.optional_string(data.get("hash"))
+        self.optional_string(data.get("merkle_root"))
+        self.number(data.get("difficulty"))
+        self.varint(len(data["transactions"]))
+        for tx in data["transactions"]:
+            self.transaction(tx)
+
+
+class _Reader:
+    """ Reads the fields written by `_Writer` from a buffer. """
+
+    def __init__(self, payload: bytes, position: int = 0, version: int = VERSION):
+        self.payload = memoryview(payload)
+        self.position = position
+        self.version = version
+        self.keys = []
+
+    def byte(self) -> int:
+        value = self.payload[self.position]
+        self.position += 1
+        return value
+
+    def varint(self) -> int:
+        value, shift = 0, 0
+        while True:
+            byte = self.byte()
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def raw(self) -> bytes:
+        length = self.varint()
+        end = self.position + length
+        if end > len(self.payload):
+            raise ValueError("Truncated field.")
+        value = self.payload[self.position:end].tobytes()
+        self.position = end
+        return value
+
+    def string(self):
+        tag = self.byte()
+        if tag == TAG_HEX:
+            return self.raw().hex()
+        if tag == TAG_TEXT:
+            return self.raw().decode("utf-8")
+        if tag == TAG_KEY:
+            return self.keys[self.varint()]
+        if tag == TAG_NONE:
+            return None
+        raise ValueError(f"Unexpected field tag {tag}.")
+
+    def number(self):
+        tag = self.byte()
+        if tag == TAG_INT:
+            value = self.varint()
+            return value >> 1 if not value & 1 else -((value + 1) >> 1)
+        if tag == TAG_FLOAT:
+            value, = _FLOAT.unpack_from(self.payload, self.position)
+            self.position += _FLOAT.size
+            return value
+        if tag == TAG_NONE:
+            return None
+        raise ValueError(f"Unexpected field tag {tag}.")
+
+    def key_table(self) -> None:
+        self.keys = [self.raw().hex() for _ in range(self.varint())]
+
+    def transaction(self) -> dict:
+        data = {
+            "sender": self.string(),
+            "recipient": self.string(),
+            "amount": self.number(),
+            "signature": self.string()
+        }
+        if self.version >= 3:
+            scheme = self.string()
+            if scheme is not None:
+                data["scheme"] = scheme
+        if self.version >= 5:
+            fee = self.number()
+            if fee is not None:
+                data["fee"] = fee
+        return data
+
+    def header(self) -> dict:
+        header = {
+            "index": self.number(),
+            "previous_hash": self.string(),
+            "proof": self.number(),
+            "timestamp": self.number()
+        }
+        block_hash = self.string()
+        if block_hash is not None:
+            header["hash"] = block_hash
+        if self.version >= 2:
+            header["merkle_root"] = self.string()
+        if self.version >= 4:
+            difficulty = self.number()
+            if difficulty is not None:
+                header["difficulty"] = difficulty
+        return header
+
+    def block(self) -> dict:
+        data = self.header()
+        data["transactions"] = [self.transaction() for _ in range(self.varint())]
+        return data
+
+
+def _document(kind: int, transactions: list, intern: bool) -> _Writer:
+    """ Starts a document: magic, version, kind and the key table of the strings used more than once. """
+    keys = []
+    if intern:
+        counts = Counter(value for tx in transactions for value in (tx["sender"], tx["recipient"])
+                         if len(value) >= INTERN_MIN_LENGTH)
+        keys = [(value, _hex_bytes(value)) for value, count in counts.items() if count > 1]
+        keys = [(value, raw) for value, raw in keys if raw is not None]
+    writer = _Writer(keys={value: number for number, (value, _) in enumerate(keys)})
+    writer.buffer += MAGIC
+    writer.buffer.append(VERSION)
+    writer.buffer.append(kind)
+    writer.varint(len(keys))
+    for _, raw in keys:
+        writer.raw(raw)
+    return writer
+
+
+def _open(payload: bytes, kind: int) -> _Reader:
+    """ Checks the magic, version and kind of a document and reads its key table. """
+    if not is_packed(payload):
+        raise ValueError("Not a binary document.")
+    if payload[2] not in SUPPORTED_VERSIONS:
+        raise ValueError(f"Unsupported binary format version {payload[2]}.")
+    if payload[3] != kind:
+        raise ValueError(f"Expected a document of kind {kind}, got {payload[3]}.")
+    reader = _Reader(payload=payload, position=4, version=payload[2])
+    reader.key_table()
+    return reader
+
+
+def is_packed(payload: bytes) -> bool:
+    """ Checks if a payload is a binary document (and not JSON). """
+    return payload[:2] == MAGIC and len(payload) >= 4
+
+
+def pack_transaction(data: dict) -> bytes:
+    """ Encodes a serialized transaction (see `serialize_transaction`). """
+    writer = _document(kind=KIND_TRANSACTION, transactions=[], intern=False)
+    writer.transaction(data)
+    return bytes(writer.buffer)
+
+
+def unpack_transaction(payload: bytes) -> dict:
+    """ Decodes a transaction encoded by `pack_transaction` into its dictionary representation. """
+    try:
+        return _open(payload=payload, kind=KIND_TRANSACTION).transaction()
+    except (IndexError, struct.error, UnicodeDecodeError) as ex:
+        raise ValueError(f"Malformed binary transaction: {ex}") from ex
+
+
+def pack_transactions(transactions: list, intern: bool = True) -> bytes:
+    """ Encodes a list of serialized transactions (e.g. a batch submission).
+    :argument transactions: The transaction dictionaries.
+    :argument intern: Store keys which are used more than once in the list only once.
+    """
+    writer = _document(kind=KIND_TRANSACTIONS, transactions=transactions, intern=intern)
+    writer.varint(len(transactions))
+    for tx in transactions:
+        writer.transaction(tx)
+    return bytes(writer.buffer)
+
+
+def unpack_transactions(payload: bytes) -> list:
+    """ Decodes a list of transactions encoded by `pack_transactions` into their dictionary representations. """
+    try:
+        reader = _open(payload=payload, kind=KIND_TRANSACTIONS)
+        return [reader.transaction() for _ in range(reader.varint())]
+    except (IndexError, struct.error, UnicodeDecodeError) as ex:
+        raise ValueError(f"Malformed binary transaction list: {ex}") from ex
+
+
+def pack_block(data: dict, intern: bool = True) -> bytes:
+    """ Encodes a serialized block (see `serialize_block`). The header precedes the transactions,
+    so that it can be read on its own.
+    :argument data: The block dictionary.
+    :argument intern: Store keys which are used more than once in the block only once.
+    """
+    writer = _document(kind=KIND_BLOCK, transactions=data["transactions"], intern=intern)
+    writer.block(data)
+    return bytes(writer.buffer)
+
+
+def unpack_block(payload: bytes) -> dict:
+    """ Decodes a block encoded by `pack_block` into its dictionary representation. """
+    try:
+        return _open(payload=payload, kind=KIND_BLOCK).block()
+    except (IndexError, struct.error, UnicodeDecodeError) as ex:
+        raise ValueError(f"Malformed binary block: {ex}") from ex
+
+
+def unpack_header(payload: bytes) -> dict:
+    """ Decodes the header fields (everything but the transactions) of a block encoded by `pack_block`. """
+    try:
+        return _open(payload=payload, kind=KIND_BLOCK).header()
+    except (IndexError, struct.error, UnicodeDecodeError) as ex:
+        raise ValueError(f"Malformed binary block: {ex}") from ex
+
+
+def pack_blocks_prefix(count: int) -> bytes:
+    """ Starts a list of blocks, followed by `count` length-prefixed documents created by `pack_block`.
+    The list can be streamed block by block.
+    """
+    writer = _document(kind=KIND_BLOCKS, transactions=[], intern=False)
+    writer.varint(count)
+    return bytes(writer.buffer)
+
+
+def pack_blocks_item(packed_block: bytes) -> bytes:
+    """ Prefixes a block encoded by `pack_block` with its length, as an item of a list of blocks. """
+    writer = _Writer()
+    writer.raw(packed_block)
+    return bytes(writer.buffer)
+
+
+def pack_blocks(blocks: list, intern: bool = True) -> bytes:
+    """ Encodes a list of serialized blocks. """
+    return pack_blocks_prefix(count=len(blocks)) + b"".join(
+        pack_blocks_item(pack_block(data=data, intern=intern)) for data in blocks)
+
+
+def unpack_blocks(payload: bytes) -> list:
+    """ Decodes a list of blocks encoded by `pack_blocks` into their dictionary representations. """
+    try:
+        reader = _open(payload=payload, kind=KIND_BLOCKS)
+        return [unpack_block(reader.raw()) for _ in range(reader.varint())]
+    except (IndexError, struct.error) as ex:
+        raise ValueError(f"Malformed binary block list: {ex}") from ex
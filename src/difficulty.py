@@ -0,0 +1,108 @@
+from typing import Callable
+
+# The difficulty of blocks without a difficulty field: four leading hexadecimal zeros (16 bits) take 2 ** 16
+# hashes on average. The difficulty of a block is the expected number of hashes to find its proof.
+LEGACY_DIFFICULTY = 2 ** 16
+# The block interval the difficulty is adjusted to (seconds)
+TARGET_BLOCK_SECONDS = 10.0
+# The difficulty is adjusted every this many blocks
+RETARGET_INTERVAL = 10
+# One adjustment changes the difficulty by at most this factor (in both directions)
+MAX_ADJUSTMENT = 4.0
+# Received blocks with a timestamp further ahead of the local clock are declined (seconds)
+MAX_FUTURE_SECONDS = 120.0
+# Blocks from this time on need a difficulty field (2026-11-01 00:00 UTC), older blocks may be legacy blocks
+DIFFICULTY_ACTIVATION_TIMESTAMP = 1_793_491_200
+
+
+def valid_difficulty(difficulty) -> bool:
+    """ Checks whether a difficulty is a positive integer below 2 ** 256 (floats, e.g. from JSON, are rejected). """
+    return isinstance(difficulty, int) and not isinstance(difficulty, bool) and 0 < difficulty < 2 ** 256
+
+
+def effective_difficulty(difficulty) -> int:
+    """ Returns the difficulty a proof has to meet (blocks without a difficulty field have the legacy one).
+    :raises ValueError: If the difficulty isn't valid (see `valid_difficulty`).
+    """
+    if difficulty is None:
+        return LEGACY_DIFFICULTY
+    if not valid_difficulty(difficulty):
+        raise ValueError(f"Invalid difficulty {difficulty!r}.")
+    return difficulty
+
+
+def target(difficulty: int) -> bytes:
+    """ Returns the largest valid proof of work digest for a difficulty.
+    Equal-length byte strings compare like big-endian numbers, so a digest is valid if `digest <= target`.
+    The legacy difficulty gives two zero bytes followed by 0xff bytes, the same as four leading hexadecimal zeros.
+    :raises ValueError: If the difficulty isn't valid (see `valid_difficulty`).
+    """
+    if not valid_difficulty(difficulty):
+        raise ValueError(f"Invalid difficulty {difficulty!r}.")
+    return ((1 << 256) // difficulty - 1).to_bytes(32, "big")
+
+
+class DifficultyRule:
+    """ Decides the difficulty of every block from the timestamps of the blocks before it.
+    Every `retarget_interval` blocks the difficulty of the parent is scaled by the ratio of the target time and the
+    observed time of the last `retarget_interval` blocks, all other blocks keep the difficulty of their parent.
+    Blocks created before difficulties were stored have no difficulty field and count as LEGACY_DIFFICULTY. They are
+    only valid before `activation_timestamp`, and once a block has the field all blocks after it need it.
+    :argument target_seconds: The block interval to adjust to.
+    :argument retarget_interval: The number of blocks between two adjustments.
+    :argument max_adjustment: The largest factor of one adjustment.
+    :argument min_difficulty: The lowest difficulty (the legacy one by default, so long pauses between blocks which
+        are mined on request don't make the proof of work trivial).
+    :argument activation_timestamp: The time from which on blocks need a difficulty field.
+    """
+
+    def __init__(self, target_seconds: float = TARGET_BLOCK_SECONDS, retarget_interval: int = RETARGET_INTERVAL,
+                 max_adjustment: float = MAX_ADJUSTMENT, min_difficulty: int = LEGACY_DIFFICULTY,
+                 activation_timestamp: float = DIFFICULTY_ACTIVATION_TIMESTAMP):
+        self.target_seconds = target_seconds
+        self.retarget_interval = retarget_interval
+        self.max_adjustment = max_adjustment
+        self.min_difficulty = max(1, min_difficulty)
+        self.activation_timestamp = activation_timestamp
+
+    def is_retarget_height(self, height: int) -> bool:
+        """ Checks whether the block at `height` adjusts the difficulty. The first window starts after the genesis
+        block, whose timestamp is fixed.
+        """
+        return height % self.retarget_interval == 0 and height >= 2 * self.retarget_interval
+
+    def next_difficulty(self, height: int, parent_difficulty, timestamp_at: Callable[[int], float]) -> int:
+        """ Returns the difficulty of the block at `height`.
+        :argument height: The index of the block.
+        :argument parent_difficulty: The difficulty field of the previous block (None for legacy blocks).
+        :argument timestamp_at: Returns the timestamp of an earlier block of the same chain by its index.
+        """
+        difficulty = effective_difficulty(parent_difficulty)
+        if not self.is_retarget_height(height):
+            return difficulty
+        expected = self.retarget_interval * self.target_seconds
+        observed = timestamp_at(height - 1) - timestamp_at(height - 1 - self.retarget_interval)
+        # Clamped, so a few blocks with wrong timestamps can't move the difficulty arbitrarily far
+        observed = min(max(observed, expected / self.max_adjustment), expected * self.max_adjustment)
+        # Block times are exponential, so expected / observed overestimates the hash rate by n / (n - 1) on average
+        # (the mean of the inverse of a sum of n of them), which would keep blocks slower than the target
+        correction = (self.retarget_interval - 1) / self.retarget_interval if self.retarget_interval > 1 else 1.0
+        return max(self.min_difficulty, round(difficulty * expected / observed * correction))
+
+    def check(self, block, parent, timestamp_at: Callable[[int], float]) -> bool:
+        """ Checks the difficulty field of a block (the proof is checked against it separately).
+        :argument block: The block.
+        :argument parent: The previous block.
+        :argument timestamp_at: Returns the timestamp of an earlier block of the same chain by its index.
+        :return: True if the block has the difficulty the chain before it requires.
+        """
+        if block.difficulty is None:
+            return parent.difficulty is None and block.timestamp < self.activation_timestamp
+        if not valid_difficulty(block.difficulty):
+            return False
+        return block.difficulty == self.next_difficulty(height=block.index, parent_difficulty=parent.difficulty,
+                                                        timestamp_at=timestamp_at)
+
+
+# The rule of the network (all nodes have to agree on it)
+DEFAULT_RULE = DifficultyRule()
@@ -0,0 +1,87 @@
+from src.block import Block
+from src.transaction import Transaction
+
+
+class Ledger:
+    """ Keeps the balance of every blockchain participant up to date, so that balance queries
+    don't have to scan the chain and the open transactions.
+    Received coins are counted from the blocks only, sent coins from the blocks and the open transactions.
+    Senders pay the amount plus the fee, the fees reach the miner with the mining reward.
+    """
+
+    def __init__(self):
+        self.__received = {}
+        self.__sent = {}
+        self.__pending_sent = {}
+
+    def rebuild(self, chain: list, open_transactions: list) -> None:
+        """ Recalculates all balances from scratch.
+        :argument chain: List of blocks in the chain.
+        :argument open_transactions: List of open transactions.
+        """
+        self.__received = {}
+        self.__sent = {}
+        self.__pending_sent = {}
+        for block in chain:
+            self.apply_block(block=block)
+        for tx in open_transactions:
+            self.add_pending(transaction=tx)
+
+    def snapshot(self) -> dict:
+        """ Returns the confirmed balances (without open transactions) as a JSON serializable dictionary. """
+        return {"received": dict(self.__received), "sent": dict(self.__sent)}
+
+    def restore(self, snapshot: dict) -> None:
+        """ Replaces the confirmed balances with a snapshot and drops the open transactions.
+        :argument snapshot: A dictionary created by `snapshot`.
+        """
+        self.__received = dict(snapshot["received"])
+        self.__sent = dict(snapshot["sent"])
+        self.__pending_sent = {}
+
+    def apply_block(self, block: Block) -> None:
+        """ Books the transactions of a block which was appended to the chain.
+        :argument block: The appended block.
+        """
+        for tx in block.transactions:
+            self.__sent[tx.sender] = self.__sent.get(tx.sender, 0) + tx.amount + tx.fee
+            self.__received[tx.recipient] = self.__received.get(tx.recipient, 0) + tx.amount
+
+    def revert_block(self, block: Block) -> None:
+        """ Cancels the transactions of a block which was removed from the chain.
+        :argument block: The removed block.
+        """
+        for tx in block.transactions:
+            self.__sent[tx.sender] = self.__sent.get(tx.sender, 0) - tx.amount - tx.fee
+            self.__received[tx.recipient] = self.__received.get(tx.recipient, 0) - tx.amount
+
+    def add_pending(self, transaction: Transaction) -> None:
+        """ Books an open transaction.
+        :argument transaction: The transaction added to the open transactions.
+        """
+        sender = transaction.sender
+        self.__pending_sent[sender] = self.__pending_sent.get(sender, 0) + transaction.amount + transaction.fee
+
+    def remove_pending(self, transaction: Transaction) -> None:
+        """ Cancels an open transaction (it was confirmed by a block or dropped).
+        :argument transaction: The transaction removed from the open transactions.
+        """
+        sender = transaction.sender
+        remaining = self.__pending_sent.get(sender, 0) - transaction.amount - transaction.fee
+        if remaining:
+            self.__pending_sent[sender] = remaining
+        else:
+            self.__pending_sent.pop(sender, None)
+
+    def clear_pending(self) -> None:
+        """ Cancels all open transactions. """
+        self.__pending_sent = {}
+
+    def balance(self, participant: str) -> float:
+        """ Returns the balance of a participant.
+        :argument participant: The user's address.
+        :return: Received coins minus sent coins (confirmed and open).
+        """
+        return (self.__received.get(participant, 0)
+                - self.__sent.get(participant, 0)
+                - self.__pending_sent.get(participant, 0))
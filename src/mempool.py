@@ -0,0 +1,121 @@
+import heapq
+import itertools
+import threading
+from typing import Iterator, Optional
+
+from src.block_limits import transaction_size
+from src.transaction import Transaction
+
+# The priority heap is rebuilt once it holds this many times more entries than open transactions
+HEAP_COMPACTION_FACTOR = 2
+
+
+class Mempool:
+    """ The open transactions, indexed by transaction id and kept in arrival order.
+    Inserting, looking up and removing a transaction costs O(1), duplicates are rejected.
+    A heap orders the transactions by fee per byte (then by arrival) for filling blocks, entries of removed
+    transactions are skipped when they come up and dropped when the heap is rebuilt.
+    Readers take the shared snapshot tuple without waiting, the lock only orders building it against changes.
+    :argument transactions: The initial open transactions.
+    """
+
+    def __init__(self, transactions=()):
+        self.__transactions = {}
+        # Heap entries (negated fee per byte, arrival number, size, id) by transaction id
+        self.__entries = {}
+        self.__heap = []
+        self.__arrivals = itertools.count()
+        self.__snapshot = None
+        self.__lock = threading.Lock()
+        for tx in transactions:
+            self.add(transaction=tx)
+
+    def __len__(self) -> int:
+        return len(self.__transactions)
+
+    def __iter__(self) -> Iterator[Transaction]:
+        return iter(self.snapshot())
+
+    def __contains__(self, transaction_id: str) -> bool:
+        return transaction_id in self.__transactions
+
+    def add(self, transaction: Transaction, size: int = None) -> bool:
+        """ Adds a transaction unless it is already open.
+        :argument transaction: The transaction to add.
+        :argument size: The size of the transaction if the caller measured it already (see `transaction_size`).
+        :return: True if the transaction was added, False if it is a duplicate.
+        """
+        if size is None:
+            size = transaction_size(transaction=transaction)
+        with self.__lock:
+            if transaction.id in self.__transactions:
+                return False
+            entry = (-transaction.fee / size, next(self.__arrivals), size, transaction.id)
+            self.__transactions[transaction.id] = transaction
+            self.__entries[transaction.id] = entry
+            heapq.heappush(self.__heap, entry)
+            self.__snapshot = None
+        return True
+
+    def get(self, transaction_id: str) -> Optional[Transaction]:
+        """ Returns the open transaction with the given id or None. """
+        return self.__transactions.get(transaction_id)
+
+    def remove_many(self, transactions) -> list[Transaction]:
+        """ Removes transactions (e.g. the ones confirmed by a block).
+        :argument transactions: The transactions to remove, ones which aren't open are ignored.
+        :return: The transactions which were removed.
+        """
+        removed = []
+        with self.__lock:
+            for tx in transactions:
+                open_tx = self.__transactions.pop(tx.id, None)
+                if open_tx is not None:
+                    del self.__entries[tx.id]
+                    removed.append(open_tx)
+            if removed:
+                self.__snapshot = None
+                if len(self.__heap) > HEAP_COMPACTION_FACTOR * len(self.__entries):
+                    self.__heap = list(self.__entries.values())
+                    heapq.heapify(self.__heap)
+        return removed
+
+    def clear(self) -> None:
+        """ Removes all open transactions. """
+        with self.__lock:
+            self.__transactions = {}
+            self.__entries = {}
+            self.__heap = []
+            self.__snapshot = None
+
+    def select(self, max_count: int, max_bytes: int) -> list[Transaction]:
+        """ Returns the open transactions with the highest fee per byte which fit into a block, best first.
+        A transaction which doesn't fit into the remaining bytes is skipped, smaller ones after it may still fit.
+        The transactions stay open until they are removed.
+        :argument max_count: The maximum number of transactions.
+        :argument max_bytes: The maximum sum of the transaction sizes (see `transaction_size`).
+        """
+        selected = []
+        remaining = max_bytes
+        with self.__lock:
+            heap = list(self.__heap)
+            entries = self.__entries
+            while heap and len(selected) < max_count:
+                entry = heapq.heappop(heap)
+                _, _, size, transaction_id = entry
+                # Entries of removed (or removed and re-added) transactions are stale
+                if entries.get(transaction_id) is not entry or size > remaining:
+                    continue
+                selected.append(self.__transactions[transaction_id])
+                remaining -= size
+        return selected
+
+    def snapshot(self) -> tuple:
+        """ Returns the open transactions in arrival order. The tuple is shared until the next change. """
+        snapshot = self.__snapshot
+        if snapshot is None:
+            with self.__lock:
+                if self.__snapshot is None:
+                    self.__snapshot = tuple(self.__transactions.values())
+                snapshot = self.__snapshot
+        return snapshot
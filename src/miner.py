@@ -0,0 +1,243 @@
+import logging
+import threading
+import uuid
+from collections import OrderedDict, deque
+from time import time
+from typing import Optional
+
+from src.proof_of_work import ProofOfWork
+from src.storage import serialize_block
+
+# The number of finished jobs which can still be looked up
+MAX_FINISHED_JOBS = 100
+# The number of jobs which may wait for the miner
+MAX_QUEUED_JOBS = 16
+# Seconds a continuous job waits before looking at the open transactions again (if nothing notified it)
+IDLE_INTERVAL = 5.0
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+
+class MiningJob:
+    """ A request to mine a block, or blocks until it's stopped (continuous mode).
+    A continuous job mines whenever there are open transactions and restarts its search when new transactions
+    or a block of a peer arrive.
+    :argument continuous: Keep mining until the job is stopped.
+    """
+
+    def __init__(self, continuous: bool = False):
+        self.id = uuid.uuid4().hex
+        self.continuous = continuous
+        self.status = JOB_QUEUED
+        self.created = time()
+        self.started = None
+        self.finished = None
+        self.message = None
+        # Proof of work searches started by the job (restarts included)
+        self.attempts = 0
+        # Hashes of the finished searches
+        self.hashes = 0
+        # The serialized blocks mined by the job
+        self.blocks = []
+        self.stop_requested = False
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in (JOB_DONE, JOB_FAILED, JOB_CANCELLED)
+
+    def to_dict(self, progress: dict = None) -> dict:
+        """ Returns the state of the job.
+        :argument progress: The statistics of the running search, if the job is the running one.
+        """
+        hashes = self.hashes + (progress["hashes"] if progress else 0)
+        end = self.finished if self.finished is not None else time()
+        seconds = end - self.started if self.started is not None else 0.0
+        return {
+            "id": self.id,
+            "status": self.status,
+            "continuous": self.continuous,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "message": self.message,
+            "attempts": self.attempts,
+            "hashes": hashes,
+            "seconds": round(seconds, 6),
+            "hash_rate": round(hashes / seconds, 2) if seconds > 0 else 0.0,
+            "search": progress,
+            "blocks": len(self.blocks),
+            "block": self.blocks[-1] if self.blocks else None
+        }
+
+
+class Miner:
+    """ Runs mining jobs one after another in a background thread, so requests don't wait for the proof of work.
+    The miner listens to the changes of the attached blockchain: a new chain tip restarts the search on top of it,
+    new open transactions restart the search of a continuous job, so they make it into the block.
+    :argument pow_engine: The engine of the attached blockchains (its searches are cancelled on restarts).
+    """
+
+    def __init__(self, pow_engine: ProofOfWork):
+        self.pow_engine = pow_engine
+        self.__blockchain = None
+        self.__jobs = OrderedDict()
+        self.__queue = deque()
+        self.__current = None
+        # Set when the search of the current job is outdated
+        self.__interrupted = False
+        self.__condition = threading.Condition()
+        self.__thread = None
+        self.__stopped = False
+
+    def attach(self, blockchain) -> None:
+        """ Mines on the given blockchain from now on (e.g. when the wallet changes). """
+        with self.__condition:
+            if self.__blockchain is not None and self.__on_change in self.__blockchain.listeners:
+                self.__blockchain.listeners.remove(self.__on_change)
+            blockchain.listeners.append(self.__on_change)
+            self.__blockchain = blockchain
+            self.__interrupt()
+
+    def submit(self, continuous: bool = False) -> Optional[MiningJob]:
+        """ Queues a mining job. There is at most one continuous job, submitting another one returns it.
+        :argument continuous: Keep mining until the job is stopped.
+        :return: The job or None if the queue is full.
+        """
+        with self.__condition:
+            if continuous:
+                for job in self.__jobs.values():
+                    if job.continuous and not job.is_finished:
+                        return job
+            if len(self.__queue) >= MAX_QUEUED_JOBS:
+                return None
+            job = MiningJob(continuous=continuous)
+            self.__jobs[job.id] = job
+            self.__queue.append(job)
+            self.__forget_finished()
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, name="miner", daemon=True)
+                self.__thread.start()
+            self.__condition.notify_all()
+            return job
+
+    def get(self, job_id: str) -> Optional[dict]:
+        """ Returns the state of a job (with the progress of the running search) or None if it's unknown. """
+        with self.__condition:
+            job = self.__jobs.get(job_id)
+            if job is None:
+                return None
+            progress = self.pow_engine.progress() if job is self.__current else None
+            if progress is not None and not progress["running"]:
+                progress = None
+            return job.to_dict(progress=progress)
+
+    def stop(self, job_id: str) -> bool:
+        """ Stops a queued or running job.
+        :return: True if the job was stopped, False if it's unknown or already finished.
+        """
+        with self.__condition:
+            job = self.__jobs.get(job_id)
+            if job is None or job.is_finished:
+                return False
+            job.stop_requested = True
+            if job is self.__current:
+                self.__interrupt()
+            else:
+                self.__queue.remove(job)
+                self.__finish(job=job, status=JOB_CANCELLED, message="Stopped before it started.")
+            return True
+
+    def shutdown(self) -> None:
+        """ Stops the background thread (the running search is cancelled). """
+        with self.__condition:
+            self.__stopped = True
+            self.__interrupt()
+        if self.__thread is not None:
+            self.__thread.join()
+
+    def __interrupt(self) -> None:
+        """ Cancels the running search and wakes up an idle continuous job (the caller holds the condition). """
+        self.__interrupted = True
+        self.pow_engine.cancel()
+        self.__condition.notify_all()
+
+    def __on_change(self, chain: bool, mempool: bool) -> None:
+        with self.__condition:
+            job = self.__current
+            if job is not None and (chain or (mempool and job.continuous)):
+                self.__interrupt()
+
+    def __finish(self, job: MiningJob, status: str, message: str) -> None:
+        job.status = status
+        job.message = message
+        job.finished = time()
+        self.__forget_finished()
+
+    def __forget_finished(self) -> None:
+        finished = [job_id for job_id, job in self.__jobs.items() if job.is_finished]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.__jobs[job_id]
+
+    def __run(self) -> None:
+        while True:
+            with self.__condition:
+                while not self.__queue and not self.__stopped:
+                    self.__condition.wait()
+                if self.__stopped:
+                    return
+                job = self.__current = self.__queue.popleft()
+                job.status = JOB_RUNNING
+                job.started = time()
+            try:
+                self.__mine(job=job)
+            except Exception as ex:
+                logging.exception("Mining job failed.")
+                with self.__condition:
+                    self.__finish(job=job, status=JOB_FAILED, message=f"Mining failed: {ex}")
+            finally:
+                with self.__condition:
+                    self.__current = None
+
+    def __mine(self, job: MiningJob) -> None:
+        """ Runs the searches of a job until it has its block (or is stopped, if it's continuous). """
+        while True:
+            with self.__condition:
+                if job.stop_requested or self.__stopped:
+                    self.__finish(job=job, status=JOB_CANCELLED, message="Mining was stopped.")
+                    return
+                blockchain = self.__blockchain
+                if blockchain.is_resolve_conflicts:
+                    if not job.continuous:
+                        self.__finish(job=job, status=JOB_FAILED, message="Resolve conflicts first, block not added.")
+                        return
+                    # Blocks mined on a chain which is about to be replaced would be lost, wait for the resolution
+                    self.__interrupted = False
+                    self.__condition.wait(timeout=IDLE_INTERVAL)
+                    continue
+                if job.continuous and len(blockchain.get_open_transactions()) == 0:
+                    # Nothing to mine, wait for transactions (or a stop)
+                    self.__interrupted = False
+                    self.__condition.wait(timeout=IDLE_INTERVAL)
+                    continue
+                self.__interrupted = False
+                job.attempts += 1
+            # mine_block may return before searching (e.g. the tip moved), then no hashes are counted
+            hashes_before = self.pow_engine.total_hashes
+            block = blockchain.mine_block()
+            with self.__condition:
+                job.hashes += self.pow_engine.total_hashes - hashes_before
+                if block is not None:
+                    job.blocks.append(serialize_block(block))
+                    if not job.continuous:
+                        self.__finish(job=job, status=JOB_DONE, message="Block added successfully")
+                        return
+                elif not self.__interrupted and not job.continuous:
+                    self.__finish(job=job, status=JOB_FAILED, message="Adding new block failed.")
+                    return
+                elif not self.__interrupted:
+                    # A continuous job waits for the next change instead of failing over and over
+                    self.__condition.wait(timeout=IDLE_INTERVAL)
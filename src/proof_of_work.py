@@ -0,0 +1,202 @@
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from time import perf_counter
+from typing import Optional
+
+from src.difficulty import LEGACY_DIFFICULTY
+from src.utils import metrics
+from src.utils.verification import PreparedProof
+
+# The number of nonces a worker checks between two looks at the stop flag
+BATCH_SIZE = 2000
+
+POW_SEARCH_SECONDS = metrics.histogram("pow_search_seconds", "Time spent in proof of work searches.", ["result"],
+                                       buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+POW_HASHES = metrics.counter("pow_hashes_total", "Proof of work hashes computed.")
+POW_HASH_RATE = metrics.gauge("pow_hash_rate", "Hashes per second of the last proof of work search.")
+
+# Stop flag and hash counter shared with the worker processes (set by the pool initializer)
+_stop_event = None
+_hash_counter = None
+
+
+def _init_worker(stop_event, hash_counter) -> None:
+    """ Stores the shared stop flag and hash counter in the worker process. """
+    global _stop_event, _hash_counter
+    _stop_event = stop_event
+    _hash_counter = hash_counter
+
+
+def _search_partition(transactions: list, last_hash: str, start: int, step: int,
+                      difficulty: int = LEGACY_DIFFICULTY) -> tuple[Optional[int], int]:
+    """ Checks the nonces start, start + step, start + 2 * step, ... until a valid proof is found
+    or the search is stopped.
+    :argument transactions: List of transactions.
+    :argument last_hash: Hash of the previous block.
+    :argument start: The first nonce of the partition.
+    :argument step: The distance between two nonces of the partition.
+    :argument difficulty: The difficulty the proof has to meet.
+    :return: Tuple of (the proof or None if stopped, number of hashes computed).
+    """
+    is_valid = PreparedProof(transactions=transactions, last_hash=last_hash, difficulty=difficulty).is_valid
+    proof = start
+    hashes = 0
+    while not _stop_event.is_set():
+        for _ in range(BATCH_SIZE):
+            hashes += 1
+            if is_valid(proof):
+                return proof, hashes
+            proof += step
+        # Progress of the running search, counted once per batch
+        with _hash_counter.get_lock():
+            _hash_counter.value += BATCH_SIZE
+    return None, hashes
+
+
+class ProofOfWork:
+    """ Searches proof of work values, splitting the nonce space across a pool of processes.
+    Worker `i` of `n` checks the nonces i, i + n, i + 2n, ... and the first valid proof found wins.
+    :argument workers: The number of processes (defaults to the number of CPUs, 1 searches in-process).
+    """
+
+    def __init__(self, workers: int = None):
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        # Forking a server process with other threads running can copy a held lock (logging, metrics) into the
+        # workers and deadlock them, spawned workers start clean
+        self.__context = multiprocessing.get_context("spawn")
+        self.__stop_event = self.__context.Event()
+        self.__hash_counter = self.__context.Value("Q", 0)
+        self.__search_lock = threading.Lock()
+        # Bumped by every cancel, searches started for an older generation return None right away
+        self.__generation = 0
+        self.__generation_lock = threading.Lock()
+        self.__pool = None
+        self.__started = None
+        self.last_hashes = 0
+        self.last_elapsed = 0.0
+        # The hashes of all searches, callers read the difference to count only the searches they caused
+        self.total_hashes = 0
+
+    @property
+    def generation(self) -> int:
+        """ Returns the number of cancels so far. A caller captures it together with the data it searches a proof
+        for and passes it to `search`, so a cancel which arrives before the search starts isn't lost.
+        """
+        return self.__generation
+
+    @property
+    def hash_rate(self) -> float:
+        """ Returns the hashes per second of the last search. """
+        if self.last_elapsed <= 0:
+            return 0.0
+        return self.last_hashes / self.last_elapsed
+
+    def stats(self) -> dict:
+        """ Returns the statistics of the last search. """
+        return {
+            "workers": self.workers,
+            "hashes": self.last_hashes,
+            "seconds": round(self.last_elapsed, 6),
+            "hash_rate": round(self.hash_rate, 2)
+        }
+
+    def progress(self) -> dict:
+        """ Returns the statistics of the running search (the hashes are counted in batches of BATCH_SIZE),
+        or of the last search if none is running.
+        """
+        started = self.__started
+        if started is None:
+            return dict(self.stats(), running=False)
+        elapsed = perf_counter() - started
+        hashes = self.__hash_counter.value
+        return {
+            "workers": self.workers,
+            "hashes": hashes,
+            "seconds": round(elapsed, 6),
+            "hash_rate": round(hashes / elapsed, 2) if elapsed > 0 else 0.0,
+            "running": True
+        }
+
+    def search(self, transactions: list, last_hash: str, difficulty: int = LEGACY_DIFFICULTY,
+               generation: int = None) -> Optional[int]:
+        """ Finds a proof that makes the hash meet the difficulty requirements.
+        :argument transactions: List of transactions which will be included in the block.
+        :argument last_hash: Hash of the previous block.
+        :argument difficulty: The expected number of hashes (see `src.difficulty`).
+        :argument generation: The `generation` when the transactions were selected (the current one by default).
+        :return: The found proof or None if the search was cancelled.
+        """
+        with self.__search_lock:
+            self.__stop_event.clear()
+            # Checked after clearing the flag: an earlier cancel changed the generation, a later one sets the flag
+            if generation is not None and generation != self.__generation:
+                logging.info("Proof of work search was cancelled before it started.")
+                return None
+            self.__hash_counter.value = 0
+            started = self.__started = perf_counter()
+            try:
+                if self.workers == 1:
+                    _init_worker(self.__stop_event, self.__hash_counter)
+                    proof, hashes = _search_partition(transactions, last_hash, 0, 1, difficulty)
+                else:
+                    proof, hashes = self.__search_parallel(transactions, last_hash, difficulty)
+            finally:
+                self.__started = None
+            self.last_elapsed = perf_counter() - started
+            self.last_hashes = hashes
+            self.total_hashes += hashes
+        POW_SEARCH_SECONDS.observe(self.last_elapsed, result="cancelled" if proof is None else "found")
+        POW_HASHES.inc(hashes)
+        POW_HASH_RATE.set(self.hash_rate)
+        if proof is None:
+            logging.info("Proof of work search was cancelled.")
+        else:
+            logging.info(f"Proof of work found: {proof} ({self.hash_rate:.0f} H/s, {self.workers} workers).")
+        return proof
+
+    def cancel(self) -> None:
+        """ Stops the running search and the searches for the current generation which haven't started yet
+        (e.g. a competing block for the same height was accepted).
+        """
+        with self.__generation_lock:
+            self.__generation += 1
+        self.__stop_event.set()
+
+    def shutdown(self) -> None:
+        """ Stops the worker processes. """
+        self.cancel()
+        if self.__pool is not None:
+            self.__pool.shutdown(wait=True)
+            self.__pool = None
+
+    def __search_parallel(self, transactions: list, last_hash: str, difficulty: int) -> tuple[Optional[int], int]:
+        if self.__pool is None:
+            self.__pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=self.__context,
+                initializer=_init_worker,
+                initargs=(self.__stop_event, self.__hash_counter))
+        pending = {
+            self.__pool.submit(_search_partition, transactions, last_hash, start, self.workers, difficulty)
+            for start in range(self.workers)
+        }
+        proof = None
+        hashes = 0
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    found, counted = future.result()
+                except Exception as ex:
+                    logging.error(f"Proof of work worker failed: {ex}")
+                    self.__stop_event.set()
+                    continue
+                hashes += counted
+                if found is not None and proof is None:
+                    proof = found
+                    # Let the other workers stop at their next batch boundary
+                    self.__stop_event.set()
+        return proof, hashes
@@ -0,0 +1,156 @@
+import binascii
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from typing import Callable
+
+from Cryptodome import Random
+from Cryptodome.Hash import SHA256
+from Cryptodome.PublicKey import ECC, RSA
+from Cryptodome.Signature import PKCS1_v1_5, eddsa
+
+from src.transaction import DEFAULT_SCHEME
+
+# The number of parsed public keys which are kept (per scheme)
+PUBLIC_KEY_CACHE_SIZE = 256
+
+
+class SignatureScheme(ABC):
+    """ Creates key pairs, signs and verifies with one signature algorithm.
+    Keys and signatures are exchanged as HEX strings, the signed data as bytes.
+    """
+
+    name = None
+
+    @abstractmethod
+    def generate_keys(self) -> tuple[str, str]:
+        """ Generates a key pair.
+        :return: Tuple of (private_key, public_key) as HEX strings.
+        """
+
+    @abstractmethod
+    def signer(self, private_key: str) -> Callable[[bytes], bytes]:
+        """ Parses a private key once and returns a function which signs data with it. """
+
+    @abstractmethod
+    def verify(self, public_key: str, data: bytes, signature: bytes) -> bool:
+        """ Checks a signature.
+        :argument public_key: The public key of the signer (HEX).
+        :argument data: The signed data.
+        :argument signature: The signature.
+        :return: True if the signature is valid, otherwise False.
+        :raises ValueError: If the public key can't be parsed.
+        """
+
+    def clear_cache(self) -> None:
+        """ Forgets the parsed public keys. """
+
+    def cache_info(self) -> dict:
+        """ Returns the hit/miss counters of the parsed public key cache. """
+        return {}
+
+
+@lru_cache(maxsize=PUBLIC_KEY_CACHE_SIZE)
+def _import_rsa_key(public_key_hex: str) -> RSA.RsaKey:
+    """ Parses a public key in HEX (DER) format, the same few senders are parsed only once. """
+    return RSA.import_key(binascii.unhexlify(public_key_hex))
+
+
+@lru_cache(maxsize=PUBLIC_KEY_CACHE_SIZE)
+def _import_ed25519_key(public_key_hex: str) -> ECC.EccKey:
+    """ Parses a raw 32-byte Ed25519 public key in HEX format. """
+    return eddsa.import_public_key(binascii.unhexlify(public_key_hex))
+
+
+def _cache_info(cached_function) -> dict:
+    info = cached_function.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "size": info.currsize}
+
+
+class RsaScheme(SignatureScheme):
+    """ RSA-3072 with PKCS#1 v1.5 signatures over SHA-256 (the scheme of all transactions without a tag).
+    Keys are DER encoded (PKCS#8 for the private key).
+    """
+
+    name = "rsa"
+
+    def __init__(self, bits: int = 3072):
+        self.bits = bits
+
+    def generate_keys(self) -> tuple[str, str]:
+        private_key = RSA.generate(bits=self.bits, randfunc=Random.new().read)
+        public_key = private_key.publickey()
+        private_key_hex = binascii.hexlify(private_key.exportKey(format="DER", pkcs=8)).decode("ascii")
+        public_key_hex = binascii.hexlify(public_key.exportKey(format="DER")).decode("ascii")
+        return private_key_hex, public_key_hex
+
+    def signer(self, private_key: str) -> Callable[[bytes], bytes]:
+        signer = PKCS1_v1_5.new(RSA.import_key(binascii.unhexlify(private_key)))
+        return lambda data: signer.sign(SHA256.new(data))
+
+    def verify(self, public_key: str, data: bytes, signature: bytes) -> bool:
+        return PKCS1_v1_5.new(_import_rsa_key(public_key)).verify(SHA256.new(data), signature)
+
+    def clear_cache(self) -> None:
+        _import_rsa_key.cache_clear()
+
+    def cache_info(self) -> dict:
+        return _cache_info(_import_rsa_key)
+
+
+class Ed25519Scheme(SignatureScheme):
+    """ Ed25519 (RFC 8032): 32-byte public keys, 64-byte signatures, key generation and signing in microseconds.
+    The public key is the raw point, the private key is DER encoded (PKCS#8).
+    """
+
+    name = "ed25519"
+
+    def generate_keys(self) -> tuple[str, str]:
+        private_key = ECC.generate(curve="ed25519")
+        private_key_hex = private_key.export_key(format="DER").hex()
+        public_key_hex = private_key.public_key().export_key(format="raw").hex()
+        return private_key_hex, public_key_hex
+
+    def signer(self, private_key: str) -> Callable[[bytes], bytes]:
+        signer = eddsa.new(ECC.import_key(binascii.unhexlify(private_key)), "rfc8032")
+        return signer.sign
+
+    def verify(self, public_key: str, data: bytes, signature: bytes) -> bool:
+        verifier = eddsa.new(_import_ed25519_key(public_key), "rfc8032")
+        try:
+            verifier.verify(data, signature)
+            return True
+        except ValueError:
+            # The signature doesn't match
+            return False
+
+    def clear_cache(self) -> None:
+        _import_ed25519_key.cache_clear()
+
+    def cache_info(self) -> dict:
+        return _cache_info(_import_ed25519_key)
+
+
+SCHEMES = {scheme.name: scheme for scheme in (RsaScheme(), Ed25519Scheme())}
+
+
+def get_scheme(name: str) -> SignatureScheme:
+    """ Returns the signature scheme with the given name.
+    :raises ValueError: If the scheme is unknown.
+    """
+    scheme = SCHEMES.get(name)
+    if scheme is None:
+        raise ValueError(f"Unknown signature scheme {name!r}, expected one of {sorted(SCHEMES)}.")
+    return scheme
+
+
+def signed_data(sender: str, recipient: str, amount, scheme: str = DEFAULT_SCHEME, fee=0) -> bytes:
+    """ Returns the bytes a transaction signature covers. Tagged schemes prefix their name, so a signature
+    can't be reused under another scheme. RSA signatures cover the untagged data, as they always did.
+    A fee is appended, so it can't be changed without the key of the sender.
+    """
+    data = f"{sender}{recipient}{amount}"
+    if fee:
+        data = f"{data};fee={fee}"
+    if scheme != DEFAULT_SCHEME:
+        data = f"{scheme}:{data}"
+    return data.encode("utf-8")
@@ -0,0 +1,622 @@
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from collections.abc import Sequence
+from typing import Iterator, Optional
+
+from src import codec
+from src.block import Block
+from src.difficulty import valid_difficulty
+from src.transaction import DEFAULT_SCHEME, Transaction
+from src.utils import metrics
+
+# A new segment file is started once the current one reaches this size (in bytes)
+SEGMENT_SIZE = 16 * 1024 * 1024
+
+# Record header: payload length and CRC-32 of the payload
+RECORD_HEADER = struct.Struct("<II")
+# Index entry: segment number, offset of the record in the segment and payload length
+INDEX_ENTRY = struct.Struct("<IQI")
+# The number of materialized blocks a lazy chain keeps
+BLOCK_CACHE_SIZE = 256
+
+STORAGE_BYTES = metrics.counter("storage_bytes_total", "Bytes read from and written to the node storage.",
+                                ["operation", "file"])
+
+
+def _is_int(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def _is_string(value) -> bool:
+    if not isinstance(value, str):
+        return False
+    if value.isascii():
+        return True
+    # JSON can carry lone surrogates, which can't be encoded
+    try:
+        value.encode("utf-8")
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+def _field(data: dict, key: str, is_valid, default=None, optional: bool = False):
+    """ Returns a field of a received or stored dictionary.
+    :raises KeyError: If a required field is missing.
+    :raises ValueError: If the field has the wrong type (the binary encoding and the checks rely on the types).
+    """
+    if optional and data.get(key) is None:
+        return default
+    value = data[key]
+    if not is_valid(value):
+        raise ValueError(f"Invalid {key} {value!r}.")
+    return value
+
+
+def serialize_transaction(transaction: Transaction) -> dict:
+    """ Converts a transaction into a JSON serializable dictionary (the scheme only if it isn't the default one,
+    the fee only if there is one).
+    """
+    data = {
+        "sender": transaction.sender,
+        "recipient": transaction.recipient,
+        "amount": transaction.amount,
+        "signature": transaction.signature
+    }
+    if transaction.is_tagged:
+        data["scheme"] = transaction.scheme
+    if transaction.fee:
+        data["fee"] = transaction.fee
+    return data
+
+
+def deserialize_transaction(data: dict) -> Transaction:
+    """ Creates a transaction from its dictionary representation.
+    :raises ValueError: If a field has the wrong type.
+    """
+    return Transaction(
+        sender=_field(data, "sender", _is_string),
+        recipient=_field(data, "recipient", _is_string),
+        signature=_field(data, "signature", _is_string),
+        amount=_field(data, "amount", _is_number),
+        scheme=_field(data, "scheme", _is_string, default=DEFAULT_SCHEME, optional=True),
+        fee=_field(data, "fee", _is_number, default=0, optional=True))
+
+
+def serialize_block(block: Block) -> dict:
+    """ Converts a block into a JSON serializable dictionary (the difficulty only if the block has one). """
+    data = {
+        "index": block.index,
+        "previous_hash": block.previous_hash,
+        "transactions": [serialize_transaction(tx) for tx in block.transactions],
+        "proof": block.proof,
+        "timestamp": block.timestamp,
+        "merkle_root": block.merkle_root,
+        "hash": block.hash
+    }
+    if block.difficulty is not None:
+        data["difficulty"] = block.difficulty
+    return data
+
+
+def deserialize_block(data: dict) -> Block:
+    """ Creates a block from its dictionary representation.
+    :raises ValueError: If a field has the wrong type or the block has an invalid difficulty.
+    """
+    transactions = _field(data, "transactions", lambda value: isinstance(value, list))
+    return Block(
+        index=_field(data, "index", _is_int),
+        previous_hash=_field(data, "previous_hash", _is_string),
+        transactions=[deserialize_transaction(tx) for tx in transactions],
+        proof=_field(data, "proof", _is_int),
+        timestamp=_field(data, "timestamp", _is_number),
+        block_hash=_field(data, "hash", _is_string, optional=True),
+        merkle_root=_field(data, "merkle_root", _is_string, optional=True),
+        difficulty=_field(data, "difficulty", valid_difficulty, optional=True))
+
+
+def encode_block(block: Block) -> bytes:
+    """ Converts a block into a block log record (the binary encoding, which starts with the header,
+    so that the header can be read without decoding the transactions).
+    """
+    return codec.pack_block(data=serialize_block(block))
+
+
+def decode_header(payload: bytes) -> dict:
+    """ Reads the header fields (everything but the transactions) of a block log record. """
+    if codec.is_packed(payload):
+        return codec.unpack_header(payload)
+    separator = payload.find(b"\n")
+    if separator < 0:
+        # A record which holds the whole block as one JSON document
+        header = json.loads(payload)
+        header.pop("transactions")
+        return header
+    return json.loads(payload[:separator])
+
+
+def decode_block(payload: bytes) -> Block:
+    """ Creates a block from a block log record. """
+    if codec.is_packed(payload):
+        return deserialize_block(codec.unpack_block(payload))
+    separator = payload.find(b"\n")
+    if separator < 0:
+        return deserialize_block(json.loads(payload))
+    # A record which holds the header as a JSON line followed by the transactions
+    data = json.loads(payload[:separator])
+    data["transactions"] = json.loads(payload[separator + 1:])
+    return deserialize_block(data)
+
+
+class BlockLog:
+    """ Append-only log of serialized blocks, split into segment files, with an offset index.
+    Every record is `<length><crc32><payload>`, so a torn write at the tail is detected and cut off on open.
+    The index stores `<segment><offset><length>` per block and is rebuilt from the segments if it lags behind.
+    Reads may run in several threads next to one writer.
+    :argument directory: The directory which holds the segment and index files.
+    :argument segment_size: The size after which a new segment file is started.
+    """
+
+    def __init__(self, directory: str, segment_size: int = SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.__entries = []
+        self.__maps = {}
+        # A reader must not slice a memory map another reader is replacing
+        self.__maps_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.__recover()
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def __iter__(self) -> Iterator[bytes]:
+        for height in range(len(self.__entries)):
+            yield self.read(height=height)
+
+    def __segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"blocks-{segment:06d}.log")
+
+    def __index_path(self) -> str:
+        return os.path.join(self.directory, "blocks.idx")
+
+    def read(self, height: int) -> bytes:
+        """ Reads the payload of a block.
+        :argument height: The index of the block.
+        :return: The serialized block.
+        """
+        segment, offset, length = self.__entries[height]
+        start = offset + RECORD_HEADER.size
+        STORAGE_BYTES.inc(length, operation="read", file="block_log")
+        with self.__maps_lock:
+            return self.__map(segment=segment, size=start + length)[start:start + length]
+
+    def __map(self, segment: int, size: int) -> mmap.mmap:
+        """ Returns a read-only memory map of a segment which covers at least `size` bytes. """
+        mapped = self.__maps.get(segment)
+        if mapped is None or len(mapped) < size:
+            # The segment grew since it was mapped
+            if mapped is not None:
+                mapped.close()
+            with open(self.__segment_path(segment), mode="rb") as file:
+                mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.__maps[segment] = mapped
+        return mapped
+
+    def close(self) -> None:
+        """ Releases the memory maps of the segments. """
+        with self.__maps_lock:
+            for mapped in self.__maps.values():
+                mapped.close()
+            self.__maps = {}
+
+    def append(self, payload: bytes) -> None:
+        """ Appends a serialized block to the last segment and the index.
+        :argument payload: The serialized block.
+        """
+        if self.__entries:
+            segment, offset, length = self.__entries[-1]
+            end = offset + RECORD_HEADER.size + length
+            if end >= self.segment_size:
+                segment, end = segment + 1, 0
+        else:
+            segment, end = 0, 0
+        with open(self.__segment_path(segment), mode="ab") as file:
+            file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+            file.flush()
+            os.fsync(file.fileno())
+        entry = (segment, end, len(payload))
+        with open(self.__index_path(), mode="ab") as file:
+            file.write(INDEX_ENTRY.pack(*entry))
+        self.__entries.append(entry)
+        STORAGE_BYTES.inc(RECORD_HEADER.size + len(payload), operation="write", file="block_log")
+        STORAGE_BYTES.inc(INDEX_ENTRY.size, operation="write", file="block_index")
+
+    def truncate(self, height: int) -> None:
+        """ Removes all blocks starting at the given height (e.g. when the chain is replaced).
+        :argument height: The number of blocks which are kept.
+        """
+        if height >= len(self.__entries):
+            return
+        segment, offset, _ = self.__entries[height]
+        last_segment = self.__entries[-1][0]
+        self.close()
+        with open(self.__segment_path(segment), mode="r+b") as file:
+            file.truncate(offset)
+        for later_segment in range(segment + 1, last_segment + 1):
+            os.remove(self.__segment_path(later_segment))
+        with open(self.__index_path(), mode="r+b") as file:
+            file.truncate(height * INDEX_ENTRY.size)
+        del self.__entries[height:]
+
+    def __recover(self) -> None:
+        """ Loads the index, drops entries that point to missing or broken records,
+        indexes complete records that were written after the index and cuts off a torn tail. """
+        index_path = self.__index_path()
+        entries = []
+        if os.path.exists(index_path):
+            with open(index_path, mode="rb") as file:
+                raw_index = file.read()
+            STORAGE_BYTES.inc(len(raw_index), operation="read", file="block_index")
+            usable = len(raw_index) - len(raw_index) % INDEX_ENTRY.size
+            entries = [entry for entry in INDEX_ENTRY.iter_unpack(raw_index[:usable])]
+        # The tail of the index may point to records which never reached the disk
+        while entries and not self.__is_valid_record(*entries[-1]):
+            entries.pop()
+        # Scan the segments for complete records after the last indexed one
+        if entries:
+            segment, offset, length = entries[-1]
+            position = offset + RECORD_HEADER.size + length
+        else:
+            segment, position = 0, 0
+        recovered = 0
+        while os.path.exists(self.__segment_path(segment)):
+            with open(self.__segment_path(segment), mode="r+b") as file:
+                file.seek(position)
+                while True:
+                    header = file.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        break
+                    length, checksum = RECORD_HEADER.unpack(header)
+                    payload = file.read(length)
+                    if len(payload) < length or zlib.crc32(payload) != checksum:
+                        break
+                    entries.append((segment, position, length))
+                    position += RECORD_HEADER.size + length
+                    recovered += 1
+                torn = file.seek(0, os.SEEK_END) > position
+                if torn:
+                    logging.warning(f"Truncating a torn record in block log segment {segment}.")
+                    file.truncate(position)
+            segment, position = segment + 1, 0
+            if torn:
+                # Nothing after a torn record belongs to the chain
+                while os.path.exists(self.__segment_path(segment)):
+                    os.remove(self.__segment_path(segment))
+                    segment += 1
+        with open(index_path, mode="wb") as file:
+            file.write(b"".join(INDEX_ENTRY.pack(*entry) for entry in entries))
+        if recovered:
+            logging.info(f"Recovered {recovered} blocks which were missing from the block log index.")
+        self.__entries = entries
+
+    def __is_valid_record(self, segment: int, offset: int, length: int) -> bool:
+        try:
+            with open(self.__segment_path(segment), mode="rb") as file:
+                file.seek(offset)
+                header = file.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return False
+                stored_length, checksum = RECORD_HEADER.unpack(header)
+                payload = file.read(length)
+                return stored_length == length and len(payload) == length and zlib.crc32(payload) == checksum
+        except IOError:
+            return False
+
+
+class LazyChain:
+    """ The chain of blocks backed by a block log. Only the offset index is loaded up front: headers are
+    parsed on first access and kept, blocks are materialized on access and kept in a bounded cache.
+    Appended blocks stay in memory until `flush` writes them to the log.
+    Changes are made by one writer at a time, readers don't need a lock: the number of persisted blocks and
+    the unsaved blocks are published together as one tuple, so a reader never sees a block twice or not at all.
+    :argument block_log: The block log which holds the persisted blocks.
+    :argument cache_size: The number of materialized blocks which are kept.
+    """
+
+    def __init__(self, block_log: BlockLog, cache_size: int = BLOCK_CACHE_SIZE):
+        self.block_log = block_log
+        self.cache_size = cache_size
+        self.__headers = {}
+        self.__cache = OrderedDict()
+        self.__cache_lock = threading.Lock()
+        # (number of persisted blocks, blocks which aren't written yet)
+        self.__state = (len(block_log), ())
+        # The encoded records of the unsaved blocks (only used by the writer)
+        self.__payloads = ()
+        # The view snapshots read through, replaced whenever blocks are removed
+        self.__view = _ChainView(chain=self)
+
+    def __len__(self) -> int:
+        persisted, unsaved = self.__state
+        return persisted + len(unsaved)
+
+    def __iter__(self) -> Iterator[Block]:
+        for height in range(len(self)):
+            yield self[height]
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[height] for height in range(*item.indices(len(self)))]
+        persisted, unsaved = self.__state
+        length = persisted + len(unsaved)
+        height = item + length if item < 0 else item
+        if not 0 <= height < length:
+            raise IndexError("chain index out of range")
+        if height >= persisted:
+            return unsaved[height - persisted]
+        with self.__cache_lock:
+            block = self.__cache.get(height)
+            if block is not None:
+                self.__cache.move_to_end(height)
+                return block
+        # Decoded outside the lock, two readers of the same block just decode it twice
+        block = decode_block(self.block_log.read(height=height))
+        with self.__cache_lock:
+            self.__cache[height] = block
+            if len(self.__cache) > self.cache_size:
+                self.__cache.popitem(last=False)
+        return block
+
+    def header(self, height: int) -> dict:
+        """ Returns the header fields of a block without materializing its transactions.
+        :argument height: The index of the block.
+        """
+        header = self.__headers.get(height)
+        if header is None:
+            if height >= self.__state[0]:
+                block = self[height]
+                header = {"index": block.index, "previous_hash": block.previous_hash,
+                          "proof": block.proof, "timestamp": block.timestamp, "merkle_root": block.merkle_root}
+                if block.difficulty is not None:
+                    header["difficulty"] = block.difficulty
+                return header
+            header = decode_header(self.block_log.read(height=height))
+            self.__headers[height] = header
+        return header
+
+    def append(self, block: Block) -> None:
+        """ Appends a block (it is written to the log by the next `flush`). """
+        self.extend(blocks=(block,))
+
+    def extend(self, blocks: list) -> None:
+        """ Appends several blocks. They are encoded right away, so a block which can't be written to the log
+        raises here instead of staying in the chain and failing every later flush.
+        :raises ValueError: If a block can't be encoded.
+        """
+        blocks = tuple(blocks)
+        self.__extend_encoded(blocks=blocks, payloads=tuple(encode_block(block) for block in blocks))
+
+    def replace(self, height: int, blocks: list) -> None:
+        """ Replaces all blocks starting at the given height. The new blocks are encoded before anything is removed.
+        :argument height: The number of blocks which are kept.
+        :argument blocks: The blocks which follow them.
+        :raises ValueError: If a block can't be encoded, the chain is unchanged then.
+        :raises IOError: If the block log can't be truncated, the chain is unchanged then.
+        """
+        blocks = tuple(blocks)
+        payloads = tuple(encode_block(block) for block in blocks)
+        self.truncate(height=height)
+        self.__extend_encoded(blocks=blocks, payloads=payloads)
+
+    def __extend_encoded(self, blocks: tuple, payloads: tuple) -> None:
+        persisted, unsaved = self.__state
+        self.__payloads += payloads
+        self.__state = (persisted, unsaved + blocks)
+
+    def truncate(self, height: int) -> None:
+        """ Removes all blocks starting at the given height.
+        :argument height: The number of blocks which are kept.
+        :raises IOError: If the block log can't be truncated.
+        """
+        persisted, unsaved = self.__state
+        if height >= persisted + len(unsaved):
+            return
+        removed = tuple(self[height:])
+        if height < persisted:
+            # Truncated first, so the chain stays unchanged if the log can't be truncated
+            self.block_log.truncate(height=height)
+        # The removed blocks stay readable for the snapshots taken before, which may still be iterated
+        view, self.__view = self.__view, _ChainView(chain=self)
+        view.freeze(height=height, removed=removed, successor=self.__view)
+        if height >= persisted:
+            self.__payloads = self.__payloads[:height - persisted]
+            self.__state = (persisted, unsaved[:height - persisted])
+            return
+        self.__payloads = ()
+        self.__state = (height, ())
+        self.__headers = {key: value for key, value in self.__headers.items() if key < height}
+        with self.__cache_lock:
+            self.__cache = OrderedDict((key, value) for key, value in self.__cache.items() if key < height)
+
+    def snapshot(self) -> "ChainSnapshot":
+        """ Returns a read-only view of the current blocks which doesn't copy them. """
+        return ChainSnapshot(view=self.__view, length=len(self))
+
+    def flush(self) -> int:
+        """ Writes the appended blocks to the block log.
+        :return: The number of written blocks.
+        """
+        persisted, unsaved = self.__state
+        written = 0
+        try:
+            for payload in self.__payloads:
+                self.block_log.append(payload=payload)
+                written += 1
+        finally:
+            # Written blocks are read from the log from now on, the rest stays unsaved
+            self.__payloads = self.__payloads[written:]
+            self.__state = (persisted + written, unsaved[written:])
+            with self.__cache_lock:
+                for offset, block in enumerate(unsaved[:written]):
+                    self.__cache[persisted + offset] = block
+                while len(self.__cache) > self.cache_size:
+                    self.__cache.popitem(last=False)
+        return written
+
+
+class _ChainView:
+    """ The blocks of a chain between two removals. While the chain only grows, blocks are read from the chain.
+    Removing blocks freezes the view first: the removed blocks are kept, the ones below the removal are read
+    through the view which follows.
+    """
+
+    def __init__(self, chain: LazyChain):
+        self.__chain = chain
+        # (height of the removal, removed blocks, following view), set once
+        self.__frozen = None
+
+    def freeze(self, height: int, removed: tuple, successor: "_ChainView") -> None:
+        self.__frozen = (height, removed, successor)
+
+    def block(self, height: int) -> Block:
+        frozen = self.__frozen
+        if frozen is None:
+            try:
+                block = self.__chain[height]
+            except IndexError:
+                block = None
+            # The view is frozen before the chain changes, so the block was read before any removal
+            frozen = self.__frozen
+            if frozen is None:
+                if block is None:
+                    raise IndexError("chain index out of range")
+                return block
+        start, removed, successor = frozen
+        if height >= start:
+            return removed[height - start]
+        return successor.block(height=height)
+
+
+class ChainSnapshot(Sequence):
+    """ A read-only view of the first `length` blocks of a chain. Blocks are immutable, so the view shares them
+    with the chain instead of copying. Appending to the chain doesn't change the view, blocks which are replaced
+    afterwards stay readable through it.
+    :argument view: The view of the chain when the snapshot was taken.
+    :argument length: The number of blocks in the view.
+    """
+
+    def __init__(self, view: _ChainView, length: int):
+        self.__view = view
+        self.__length = length
+
+    def __len__(self) -> int:
+        return self.__length
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return tuple(self[height] for height in range(*item.indices(self.__length)))
+        height = item + self.__length if item < 0 else item
+        if not 0 <= height < self.__length:
+            raise IndexError("chain index out of range")
+        return self.__view.block(height=height)
+
+
+class StateFile:
+    """ A small JSON file which is replaced atomically (write to a temporary file, then rename).
+    :argument path: The path of the file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.name = os.path.basename(path)
+
+    def load(self) -> Optional[dict]:
+        """ Reads the file.
+        :return: The stored dictionary or None if the file doesn't exist.
+        """
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, mode="rb") as file:
+            content = file.read()
+        STORAGE_BYTES.inc(len(content), operation="read", file=self.name)
+        return json.loads(content)
+
+    def save(self, data: dict) -> None:
+        """ Replaces the file content.
+        :argument data: The dictionary which should be stored.
+        """
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, mode="w") as file:
+            json.dump(data, file, ensure_ascii=False)
+            file.flush()
+            os.fsync(file.fileno())
+            size = file.tell()
+        os.replace(temporary_path, self.path)
+        STORAGE_BYTES.inc(size, operation="write", file=self.name)
+
+
+class Journal:
+    """ An append-only file of JSON records (one per line) which extends one version of a state file, so small
+    changes don't rewrite the whole state. The first line names the version, the records of a journal with another
+    version were already saved in the state file and are ignored. A torn last line is ignored too.
+    :argument path: The path of the file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.name = os.path.basename(path)
+
+    def load(self, version: int) -> list:
+        """ Reads the records.
+        :argument version: The version of the state file the records have to belong to.
+        :return: The records or an empty list if the file doesn't exist or belongs to another version.
+        """
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, mode="rb") as file:
+            content = file.read()
+        STORAGE_BYTES.inc(len(content), operation="read", file=self.name)
+        # Everything after the last line break is a record which wasn't written completely
+        lines = content.split(b"\n")[:-1]
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                logging.warning(f"Ignoring the {self.name} records after a broken one.")
+                break
+        if not records or not isinstance(records[0], dict) or records[0].get("version") != version:
+            return []
+        return records[1:]
+
+    def reset(self, version: int) -> None:
+        """ Starts an empty journal (after the state file of the version was saved).
+        :argument version: The version of the state file.
+        """
+        self.__write(mode="w", lines=[{"version": version}])
+
+    def append(self, records: list) -> None:
+        """ Appends records with one write.
+        :argument records: The records (dictionaries) which should be stored.
+        """
+        self.__write(mode="a", lines=records)
+
+    def __write(self, mode: str, lines: list) -> None:
+        content = "".join(json.dumps(line, ensure_ascii=False) + "\n" for line in lines).encode("utf-8")
+        with open(self.path, mode=mode + "b") as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+        STORAGE_BYTES.inc(len(content), operation="write", file=self.name)
@@ -1,26 +1,65 @@
+import sys
 from collections import OrderedDict
 
+from src.utils.hash_util import hash_transaction
+from src.utils.immutable import Immutable
 from src.utils.printable import Printable
 
+# The signature scheme of transactions without a scheme tag (all transactions before schemes were added)
+DEFAULT_SCHEME = "rsa"
+# The reward we give to miners for creating a new block (the fees of the block are added to it)
+MINING_REWARD = 2
 
-class Transaction(Printable):
-    """ A transaction witch can be added to a block in the blockchain.
+
+class Transaction(Printable, Immutable):
+    """ An immutable transaction witch can be added to a block in the blockchain.
     :argument sender: The sender of the coins.
     :argument recipient: The recipient of the coins.
     :argument signature: The signature of the transaction.
     :argument amount: The amount of coins sent.
+    :argument scheme: The signature scheme of the sender's key (see `src.signature_schemes`).
+    :argument fee: The fee the sender pays to the miner on top of the amount (prioritizes the transaction).
     """
 
-    def __init__(self, sender, recipient, signature, amount):
-        self.sender = sender
-        self.recipient = recipient
-        self.amount = amount
-        self.signature = signature
+    # The slot order is the field order of the printed transaction (which is part of the proof of work)
+    __slots__ = ("sender", "recipient", "amount", "signature", "scheme", "fee", "__id")
+
+    # RSA transactions without a fee print (and hash) exactly like the ones created before the scheme tag and the fee
+    _print_defaults = {"scheme": DEFAULT_SCHEME, "fee": 0}
+
+    def __init__(self, sender, recipient, signature, amount, scheme=DEFAULT_SCHEME, fee=0):
+        # A few wallets send most transactions, all of them share one copy of each key
+        object.__setattr__(self, "sender", sys.intern(sender) if isinstance(sender, str) else sender)
+        object.__setattr__(self, "recipient", sys.intern(recipient) if isinstance(recipient, str) else recipient)
+        object.__setattr__(self, "amount", amount)
+        object.__setattr__(self, "signature", signature)
+        object.__setattr__(self, "scheme", scheme)
+        object.__setattr__(self, "fee", fee)
+        object.__setattr__(self, "_Transaction__id", None)
+
+    @property
+    def id(self) -> str:
+        """ Returns the transaction id (hash of the signed payload), calculated once and cached. """
+        if self.__id is None:
+            object.__setattr__(self, "_Transaction__id", hash_transaction(transaction=self))
+        return self.__id
+
+    @property
+    def is_tagged(self) -> bool:
+        """ Returns True if the transaction uses another scheme than the default one (the tag is then part of
+        the printed state, the id and the signed data).
+        """
+        return self.scheme != DEFAULT_SCHEME
 
     def to_ordered_dict(self):
         """ Return ordered dictionary for fields of transaction. """
-        return OrderedDict([
+        fields = OrderedDict([
             ("sender", self.sender),
             ("recipient", self.recipient),
             ("amount", self.amount)
         ])
+        if self.is_tagged:
+            fields["scheme"] = self.scheme
+        if self.fee:
+            fields["fee"] = self.fee
+        return fields
@@ -1,7 +1,12 @@
+from __future__ import annotations
+
 import hashlib as hl
 import json
+from typing import TYPE_CHECKING
 
-import src.block
+if TYPE_CHECKING:
+    import src.block
+    import src.transaction
 
 
 def hash_string_256(string: str) -> str:
@@ -12,11 +17,44 @@ def hash_string_256(string: str) -> str:
     return hl.sha256(string.encode("utf-8")).hexdigest()
 
 
+def hash_transaction(transaction: src.transaction.Transaction) -> str:
+    """ Calculates the SHA-256 hash of the signed payload of a transaction (used as the transaction id).
+    :argument transaction: The transaction that should be hashed.
+    :return: SHA-256 hash of the transaction as a hexadecimal string.
+    """
+    payload = [transaction.sender, transaction.recipient, transaction.amount, transaction.signature]
+    # Only tagged schemes are part of the id, RSA transactions keep the ids they always had
+    if transaction.is_tagged:
+        payload.append(transaction.scheme)
+    # The same for the fee, transactions without one keep their ids
+    if transaction.fee:
+        payload += ["fee", transaction.fee]
+    return hash_string_256(json.dumps(payload))
+
+
 def hash_block(block: src.block.Block) -> str:
     """ Calculates the SHA-256 hash for the given block.
+    Blocks with a Merkle root commit to their header and the root, older blocks to all of their transactions.
+    The difficulty is part of the hash of the blocks which have one.
     :argument block: The block that should be hashed.
     :return: SHA-256 hash of the block as a hexadecimal string.
     """
-    hashable_block = block.__dict__.copy()
-    hashable_block["transactions"] = [tx.to_ordered_dict() for tx in hashable_block["transactions"]]
+    if block.merkle_root is not None:
+        hashable_block = {
+            "index": block.index,
+            "previous_hash": block.previous_hash,
+            "merkle_root": block.merkle_root,
+            "proof": block.proof,
+            "timestamp": block.timestamp
+        }
+    else:
+        hashable_block = {
+            "index": block.index,
+            "previous_hash": block.previous_hash,
+            "transactions": [tx.to_ordered_dict() for tx in block.transactions],
+            "proof": block.proof,
+            "timestamp": block.timestamp
+        }
+    if block.difficulty is not None:
+        hashable_block["difficulty"] = block.difficulty
     return hash_string_256(json.dumps(hashable_block, sort_keys=True))
@@ -0,0 +1,24 @@
+class Immutable:
+    """ A base class for value objects which can't be changed after creation.
+    Fields are set in `__init__` with `object.__setattr__`, copies return the object itself.
+    """
+
+    __slots__ = ()
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f"{type(self).__name__} is immutable.")
+
+    def __delattr__(self, key):
+        raise AttributeError(f"{type(self).__name__} is immutable.")
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __setstate__(self, state):
+        # Unpickling (e.g. in a worker process) sets the fields the same way `__init__` does
+        dict_state, slot_state = state if isinstance(state, tuple) else (state, None)
+        for key, value in {**(dict_state or {}), **(slot_state or {})}.items():
+            object.__setattr__(self, key, value)
@@ -0,0 +1,60 @@
+import hashlib as hl
+
+# Prefix of inner nodes, so that an inner node can never be passed off as a leaf (a transaction id)
+NODE_PREFIX = b"\x01"
+
+
+def _parent(left: bytes, right: bytes) -> bytes:
+    return hl.sha256(NODE_PREFIX + left + right).digest()
+
+
+def _levels(leaves: list) -> list:
+    """ Builds the tree bottom-up. A node without a sibling is carried up to the next level unchanged
+    (instead of being paired with a copy of itself, which would allow two transaction lists with the same root).
+    """
+    level = [bytes.fromhex(leaf) for leaf in leaves]
+    levels = [level]
+    while len(level) > 1:
+        level = [_parent(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+                 for i in range(0, len(level), 2)]
+        levels.append(level)
+    return levels
+
+
+def merkle_root(leaves: list) -> str:
+    """ Calculates the Merkle root over transaction ids.
+    :argument leaves: The transaction ids (SHA-256 hex strings) in block order.
+    :return: The root as a hexadecimal string (the hash of nothing for an empty list).
+    """
+    if not leaves:
+        return hl.sha256(b"").hexdigest()
+    return _levels(leaves)[-1][0].hex()
+
+
+def merkle_path(leaves: list, index: int) -> list:
+    """ Returns the inclusion proof of a leaf: the sibling of every node on the way to the root.
+    :argument leaves: The transaction ids in block order.
+    :argument index: The position of the proven transaction.
+    :return: List of {"hash": sibling, "position": "left" | "right"}, from the leaf up (O(log n) entries).
+    """
+    path = []
+    for level in _levels(leaves)[:-1]:
+        sibling = index ^ 1
+        if sibling < len(level):
+            path.append({"hash": level[sibling].hex(), "position": "left" if sibling < index else "right"})
+        index //= 2
+    return path
+
+
+def verify_merkle_path(leaf: str, path: list, root: str) -> bool:
+    """ Checks an inclusion proof created by `merkle_path`.
+    :argument leaf: The transaction id.
+    :argument path: The siblings from the leaf up.
+    :argument root: The Merkle root the block commits to.
+    :return: True if the path leads from the leaf to the root.
+    """
+    node = bytes.fromhex(leaf)
+    for step in path:
+        sibling = bytes.fromhex(step["hash"])
+        node = _parent(sibling, node) if step["position"] == "left" else _parent(node, sibling)
+    return node.hex() == root
@@ -0,0 +1,229 @@
+import bisect
+import math
+import threading
+from abc import ABC, abstractmethod
+from time import perf_counter
+from typing import Callable, Iterable
+
+# Prefix of all metric names
+NAMESPACE = "blockchain"
+# Default histogram buckets (seconds), from sub-millisecond signature checks up to minutes of proof of work
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")
+
+
+def _format_labels(names: Iterable[str], values: Iterable) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric(ABC):
+    """ A named metric with optional labels. Values are kept per combination of label values.
+    Recording costs a dictionary lookup and an addition, the text format is only built when it's scraped.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str] = ()):
+        self.name = f"{NAMESPACE}_{name}"
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if len(labels) != len(self.label_names):
+            raise ValueError(f"Metric {self.name} expects the labels {self.label_names}.")
+        return tuple(labels[name] for name in self.label_names)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {_escape(self.documentation)}", f"# TYPE {self.name} {self.kind}"]
+
+    @abstractmethod
+    def samples(self) -> list[str]:
+        """ Returns the sample lines of the metric in the text format. """
+
+    def _read(self, function: Callable) -> list:
+        """ Returns the (label values, value) pairs of a metric which is read by a function on every scrape.
+        A function of a metric with labels returns a dictionary from label value tuples to values.
+        """
+        if not self.label_names:
+            return [((), function())]
+        return list(function().items())
+
+    def _lines(self, values: list) -> list[str]:
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}" for key, value in values]
+
+
+class Counter(_Metric):
+    """ A value which only goes up (e.g. the number of failed requests). It is either incremented here or read by
+    a function on every scrape (e.g. the hits of a cache which counts them itself).
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str] = (),
+                 function: Callable[[], float] = None):
+        super().__init__(name=name, documentation=documentation, label_names=label_names)
+        self.function = function
+        self.__values = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self.__values[key] = self.__values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        if self.function is not None:
+            return self._lines(self._read(self.function))
+        with self._lock:
+            values = list(self.__values.items())
+        return self._lines(values)
+
+
+class Gauge(_Metric):
+    """ A value which goes up and down. It is either set when it changes or read by a function on every scrape,
+    which costs nothing between scrapes (e.g. the chain height).
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str] = (),
+                 function: Callable[[], float] = None):
+        super().__init__(name=name, documentation=documentation, label_names=label_names)
+        self.function = function
+        self.__values = {}
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self.__values[key] = value
+
+    def samples(self) -> list[str]:
+        if self.function is not None:
+            return self._lines(self._read(self.function))
+        with self._lock:
+            values = list(self.__values.items())
+        return self._lines(values)
+
+
+class _Timer:
+    """ Observes the seconds spent in a `with` block. """
+
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram: "Histogram", labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(perf_counter() - self.started, **self.labels)
+        return False
+
+
+class Histogram(_Metric):
+    """ Counts observations (e.g. latencies) in buckets, plus their sum and number.
+    :argument buckets: The upper bounds of the buckets (an implicit +Inf bucket is added).
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name=name, documentation=documentation, label_names=label_names)
+        self.buckets = tuple(sorted(buckets))
+        self.__values = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self.__values.get(key)
+            if entry is None:
+                # Bucket counts (the last one is +Inf), sum, count
+                entry = self.__values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][position] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, **labels) -> _Timer:
+        """ Returns a context manager which observes the seconds spent in it. """
+        return _Timer(histogram=self, labels=labels)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = [(key, list(entry[0]), entry[1], entry[2]) for key, entry in self.__values.items()]
+        lines = []
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.label_names + ("le",), key + (_format_value(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """ Holds the metrics of the process and renders them in the Prometheus text format. """
+
+    def __init__(self):
+        self.__metrics = {}
+        self.__lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        """ Adds a metric, a metric with the same name is replaced (e.g. a gauge reading a new object). """
+        with self.__lock:
+            self.__metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """ Returns all metrics in the Prometheus text exposition format (version 0.0.4). """
+        with self.__lock:
+            metrics = sorted(self.__metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.header())
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+# The registry of the process, served at /metrics
+REGISTRY = MetricsRegistry()
+
+
+def counter(name: str, documentation: str, label_names: Iterable[str] = (),
+            function: Callable[[], float] = None) -> Counter:
+    """ Creates a counter in the process registry. """
+    return REGISTRY.register(Counter(name=name, documentation=documentation, label_names=label_names,
+                                     function=function))
+
+
+def gauge(name: str, documentation: str, label_names: Iterable[str] = (),
+          function: Callable[[], float] = None) -> Gauge:
+    """ Creates a gauge in the process registry. """
+    return REGISTRY.register(Gauge(name=name, documentation=documentation, label_names=label_names,
+                                   function=function))
+
+
+def histogram(name: str, documentation: str, label_names: Iterable[str] = (),
+              buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+    """ Creates a histogram in the process registry. """
+    return REGISTRY.register(Histogram(name=name, documentation=documentation, label_names=label_names,
+                                       buckets=buckets))
@@ -2,7 +2,21 @@ from abc import ABC
 
 
 class Printable(ABC):
-    """ An abstract base class that implements printing functionality. """
+    """ An abstract base class that implements printing functionality.
+    Works for dict-backed classes as well as for classes with `__slots__` (fields are printed in slot order).
+    Fields listed in `_print_defaults` are left out while they have their default value, so a field added later
+    doesn't change how the objects which don't use it print (the printed state is hashed).
+    """
+
+    __slots__ = ()
+
+    _print_defaults = {}
 
     def __repr__(self):
-        return str(self.__dict__)
+        # Private fields (e.g. cached values) are not part of the printed state
+        if hasattr(self, "__dict__"):
+            return str({key: value for key, value in self.__dict__.items() if not key.startswith("_")})
+        defaults = self._print_defaults
+        return str({name: getattr(self, name) for cls in reversed(type(self).__mro__)
+                    for name in cls.__dict__.get("__slots__", ()) if not name.startswith("_")
+                    and not (name in defaults and getattr(self, name) == defaults[name])})
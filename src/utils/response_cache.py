@@ -0,0 +1,40 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+# The number of serialized responses which are kept
+RESPONSE_CACHE_SIZE = 256
+
+
+class ResponseCache:
+    """ A bounded LRU cache of serialized responses. Keys contain the state versions a response was built from,
+    so a response is never served for a state which changed since (stale entries just age out).
+    :argument size: The number of responses which are kept.
+    """
+
+    def __init__(self, size: int = RESPONSE_CACHE_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get_or_build(self, key: Hashable, build: Callable[[], bytes]) -> bytes:
+        """ Returns the cached response for a key, building and storing it on a miss.
+        :argument key: The request and the state versions it depends on.
+        :argument build: Serializes the response.
+        :return: The serialized response.
+        """
+        with self.__lock:
+            body = self.__entries.get(key)
+            if body is not None:
+                self.__entries.move_to_end(key)
+                self.hits += 1
+                return body
+            self.misses += 1
+        body = build()
+        with self.__lock:
+            self.__entries[key] = body
+            if len(self.__entries) > self.size:
+                self.__entries.popitem(last=False)
+        return body
@@ -1,45 +1,218 @@
+import hashlib as hl
 import logging
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+from typing import Callable
 
-from src.utils.hash_util import hash_string_256, hash_block
+from src.block_limits import DEFAULT_LIMITS, BlockLimits
+from src.difficulty import DEFAULT_RULE, LEGACY_DIFFICULTY, MAX_FUTURE_SECONDS, DifficultyRule, effective_difficulty, \
+    target
+from src.transaction import MINING_REWARD
+from src.utils import metrics
 from src.wallet import Wallet
 
+# Batches smaller than this are verified in-process, a round trip to the pool costs more
+PARALLEL_BATCH_SIZE = 16
+
+SIGNATURE_BATCH_SECONDS = metrics.histogram("signature_batch_seconds",
+                                            "Time to verify a batch of transaction signatures.")
+SIGNATURE_BATCH_SIZE = metrics.histogram("signature_batch_size", "Transactions per verified signature batch.",
+                                         buckets=(1, 4, 16, 64, 256, 1024, 4096))
+CHAIN_VERIFICATION_SECONDS = metrics.histogram("chain_verification_seconds",
+                                               "Time to check the hashes and proofs of a chain.")
+
+
+def valid_amount(amount) -> bool:
+    """ Checks whether a transaction amount is a positive finite number (NaN would poison the balances). """
+    return not isinstance(amount, bool) and isinstance(amount, (int, float)) and math.isfinite(amount) and amount > 0
+
+
+def valid_fee(fee) -> bool:
+    """ Checks whether a transaction fee is a non-negative finite number. """
+    return not isinstance(fee, bool) and isinstance(fee, (int, float)) and math.isfinite(fee) and fee >= 0
+
+
+def _verify_chunk(transactions: list) -> list[bool]:
+    """ Verifies the signatures of a chunk of transactions (runs in a worker process). """
+    return [Wallet.verify_transaction(transaction=tx) for tx in transactions]
+
+
+class PreparedProof:
+    """ Proof of work checks for a fixed list of transactions and previous hash.
+    The transactions/last hash prefix is serialized and hashed once, every attempt only feeds the proof
+    into a copy of that SHA-256 state. The hashes are the same as the ones of `Verification.valid_of_proof`.
+    :argument transactions: List of transactions.
+    :argument last_hash: Hash of the previous block.
+    :argument difficulty: The difficulty the proof has to meet (the legacy one by default).
+    """
+
+    def __init__(self, transactions: list, last_hash: str, difficulty: int = LEGACY_DIFFICULTY):
+        prefix = f"{[tx.to_ordered_dict for tx in transactions]}{last_hash}"
+        self.__midstate = hl.sha256(prefix.encode("utf-8"))
+        self.__target = target(difficulty=difficulty)
+
+    def guess_hash(self, proof: int) -> str:
+        """ Calculates the SHA-256 hash of the prepared prefix followed by the proof.
+        :argument proof: Numerical value of the proof.
+        :return: SHA-256 hash as a hexadecimal string.
+        """
+        guess = self.__midstate.copy()
+        guess.update(f"{proof}".encode("utf-8"))
+        return guess.hexdigest()
+
+    def is_valid(self, proof: int) -> bool:
+        """ Checks whether a proof meets the difficulty (four leading 0s for the legacy one).
+        :argument proof: Numerical value of the proof.
+        :return: True if the proof is correct, False otherwise.
+        """
+        guess = self.__midstate.copy()
+        guess.update(f"{proof}".encode("utf-8"))
+        # Digests compare like big-endian numbers, the comparison stops at the first differing byte
+        return guess.digest() <= self.__target
+
+
+class SignatureVerifier:
+    """ Verifies the signatures of transaction batches, spreading them across a pool of processes.
+    :argument workers: The number of processes (defaults to the number of CPUs, 1 verifies in-process).
+    """
+
+    def __init__(self, workers: int = None):
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.__pool = None
+
+    def verify(self, transactions) -> list[bool]:
+        """ Verifies the signatures of several transactions.
+        :argument transactions: The transactions to verify.
+        :return: The verification result of every transaction, in the same order.
+        """
+        transactions = list(transactions)
+        SIGNATURE_BATCH_SIZE.observe(len(transactions))
+        with SIGNATURE_BATCH_SECONDS.time():
+            return self.__verify(transactions=transactions)
+
+    def __verify(self, transactions: list) -> list[bool]:
+        if self.workers == 1 or len(transactions) < PARALLEL_BATCH_SIZE:
+            return _verify_chunk(transactions)
+        # Transactions which were verified before (e.g. on receipt) don't go to the pool
+        results = [Wallet.verified_signatures.contains(tx) for tx in transactions]
+        pending = [index for index, verified in enumerate(results) if not verified]
+        if len(pending) < PARALLEL_BATCH_SIZE:
+            for index in pending:
+                results[index] = Wallet.verify_transaction(transaction=transactions[index])
+            return results
+        if self.__pool is None:
+            # Spawned, not forked: the pool is created from server threads, a fork could copy a held lock
+            self.__pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        chunk_size = -(-len(pending) // self.workers)
+        chunks = [[transactions[index] for index in pending[start:start + chunk_size]]
+                  for start in range(0, len(pending), chunk_size)]
+        pool_results = [result for chunk_results in self.__pool.map(_verify_chunk, chunks)
+                        for result in chunk_results]
+        for index, is_valid in zip(pending, pool_results):
+            results[index] = is_valid
+            if is_valid:
+                # The worker processes have their own caches, remember the result here
+                Wallet.verified_signatures.add(transactions[index])
+        return results
+
+    def shutdown(self) -> None:
+        """ Stops the worker processes. """
+        if self.__pool is not None:
+            self.__pool.shutdown(wait=True)
+            self.__pool = None
+
 
 class Verification:
     """ Provides verification helper methods. """
 
     @staticmethod
-    def valid_of_proof(transactions: list, last_hash: str, proof: int) -> bool:
-        """ Checks whether a proof is correct (four leading 0s).
+    def valid_of_proof(transactions: list, last_hash: str, proof: int, difficulty: int = None) -> bool:
+        """ Checks whether a proof meets the difficulty (four leading 0s for the legacy one).
         :argument transactions: List of transactions.
         :argument last_hash: Hash of the previous block.
         :argument proof: Numerical value of the proof.
+        :argument difficulty: The difficulty field of the block (None for the legacy difficulty).
         :return: True if the proof is correct, False otherwise.
         """
-        guess_hash = hash_string_256(f"{[tx.to_ordered_dict for tx in transactions]}{last_hash}{proof}")
+        guess_hash = PreparedProof(transactions=transactions, last_hash=last_hash).guess_hash(proof=proof)
         logging.debug(guess_hash)
-        return guess_hash[0:4] == "0000"
+        return bytes.fromhex(guess_hash) <= target(difficulty=effective_difficulty(difficulty))
 
     @classmethod
-    def verify_chain(cls, blockchain) -> bool:
-        """ Checks the integrity of the blockchain by checking block hashes and proofs of work.
-        :argument blockchain: List of blocks in the chain.
+    def verify_chain(cls, blockchain, timestamp_at: Callable[[int], float] = None,
+                     rule: DifficultyRule = DEFAULT_RULE, limits: BlockLimits = DEFAULT_LIMITS) -> bool:
+        """ Checks the integrity of the blockchain by checking block hashes, difficulties, timestamps, block limits
+        and proofs of work.
+        Stored block hashes are checked against the block contents, once per block.
+        :argument blockchain: List of blocks in the chain (the first one is trusted, e.g. the genesis block).
+        :argument timestamp_at: Returns the timestamp of a block before the list by its index (needed to check
+            the difficulty of a list which doesn't start at the genesis block).
+        :argument rule: The difficulty rule of the network.
+        :argument limits: The block limits of the network.
         :return: True if the blockchain is correct, otherwise False.
         """
+        with CHAIN_VERIFICATION_SECONDS.time():
+            return cls.__verify_chain(blockchain=blockchain, timestamp_at=timestamp_at, rule=rule, limits=limits)
+
+    @classmethod
+    def __verify_chain(cls, blockchain, timestamp_at, rule: DifficultyRule, limits: BlockLimits) -> bool:
+        first = blockchain[0].index if len(blockchain) else 0
+
+        def timestamp(height: int) -> float:
+            if height >= first:
+                return blockchain[height - first].timestamp
+            return timestamp_at(height)
+
         for (index, block) in enumerate(blockchain):
+            if not block.check_hash():
+                logging.error(f"Stored hash doesn't match block: {index}")
+                return False
             if index == 0:
                 # Genesis block
                 continue
-            if block.previous_hash != hash_block(block=blockchain[index - 1]):
+            if block.previous_hash != blockchain[index - 1].hash or block.index != blockchain[index - 1].index + 1:
                 logging.error(f"Blockchain corrupted at block: {index}")
                 return False
+            if not rule.check(block=block, parent=blockchain[index - 1], timestamp_at=timestamp):
+                logging.error(f"Wrong difficulty at block: {index}")
+                return False
+            if block.timestamp > time() + MAX_FUTURE_SECONDS:
+                logging.error(f"Timestamp too far in the future at block: {index}")
+                return False
+            if not cls.verify_block_fees(block=block):
+                logging.error(f"Invalid fees or mining reward at block: {index}")
+                return False
+            if not limits.check(block=block):
+                logging.error(f"Block limits exceeded at block: {index}")
+                return False
             if not cls.valid_of_proof(
                     transactions=block.transactions[:-1],
                     last_hash=block.previous_hash,
-                    proof=block.proof):
+                    proof=block.proof,
+                    difficulty=block.difficulty):
                 logging.error(f"Invalid Proof of Work at block: {index}")
                 return False
         return True
 
+    @staticmethod
+    def verify_block_fees(block) -> bool:
+        """ Checks the fees of the transactions of a block and its mining reward (the last transaction), which has
+        to be MINING_REWARD plus the fees.
+        :argument block: The block.
+        :return: True if the fees and the reward are correct, otherwise False.
+        """
+        if not block.transactions:
+            return False
+        *transactions, reward = block.transactions
+        if not all(valid_fee(tx.fee) for tx in transactions):
+            return False
+        # Summed in block order, like the miner does, so the float sum is the same
+        return (reward.sender == "MINING" and reward.fee == 0
+                and reward.amount == MINING_REWARD + sum(tx.fee for tx in transactions))
+
     @staticmethod
     def verify_transaction(transaction, get_balance, check_funds=True) -> bool:
         """ Checks the correctness of the transaction.
@@ -48,23 +221,34 @@ class Verification:
         :argument check_funds: Flag indicating whether the sender's balance should be checked.
         :return: True if the transaction is valid, otherwise False.
         """
+        if not valid_amount(transaction.amount):
+            logging.warning("The transaction amount is invalid.")
+            return False
+        if not valid_fee(transaction.fee):
+            logging.warning("The transaction fee is invalid.")
+            return False
         if check_funds:
-            # Check sender's balance
+            # Check sender's balance (the fee is paid on top of the amount)
             sender_balance = get_balance(sender=transaction.sender)
-            if sender_balance < transaction.amount:
+            if sender_balance < transaction.amount + transaction.fee:
                 logging.warning("The sender doesn't have sufficient funds.")
                 return False
         # Verify transaction
         return Wallet.verify_transaction(transaction=transaction)
 
-    @classmethod
-    def verify_transactions(cls, open_transactions, get_balance) -> bool:
-        """ Check all open transactions.
-        :argument open_transactions: List of open transactions.
-        :argument get_balance: Function to get the sender's balance.
-        :return: True if all transactions are valid, otherwise False.
+    @staticmethod
+    def verify_chain_transactions(blockchain, verifier: SignatureVerifier = None) -> bool:
+        """ Checks the signatures of all transactions in the blocks (except the mining rewards) as one batch.
+        :argument blockchain: List of blocks in the chain.
+        :argument verifier: The batch signature verifier (verifies in-process by default).
+        :return: True if all signatures are valid, otherwise False.
         """
-        return all([cls.verify_transaction(
-            transaction=tx,
-            get_balance=get_balance,
-            check_funds=False) for tx in open_transactions])
+        if verifier is None:
+            verifier = SignatureVerifier(workers=1)
+        # The last transaction of every block is the mining reward, which isn't signed
+        transactions = [tx for block in blockchain for tx in block.transactions[:-1]]
+        results = verifier.verify(transactions=transactions)
+        if not all(results):
+            logging.error(f"{results.count(False)} transactions in the chain have invalid signatures.")
+            return False
+        return True
@@ -1,36 +1,104 @@
 import binascii
+import hashlib as hl
 import logging
+import threading
+from collections import OrderedDict
 
-from Cryptodome import Random
-from Cryptodome.Hash import SHA256
-from Cryptodome.PublicKey import RSA
-from Cryptodome.Signature import PKCS1_v1_5
+from src.signature_schemes import SCHEMES, get_scheme, signed_data
+from src.transaction import DEFAULT_SCHEME
+from src.utils import metrics
+
+# The number of verified signatures which are remembered
+VERIFIED_CACHE_SIZE = 16384
+
+SIGNATURE_VERIFICATION_SECONDS = metrics.histogram("signature_verification_seconds",
+                                                   "Time to verify one transaction signature (cache misses).",
+                                                   ["scheme"])
+SIGNATURE_VERIFICATIONS = metrics.counter("signature_verifications_total",
+                                          "Transaction signature checks by result (valid, invalid, cached).",
+                                          ["result"])
+
+
+class _VerifiedSignatures:
+    """ A bounded LRU set of transactions whose signature was already verified.
+    Entries are SHA-256 digests of (sender, signed data, signature), so a cached result never applies
+    to a transaction which signs different data (the signed data of tagged schemes contains the scheme).
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def key(transaction) -> bytes:
+        data = signed_data(sender=transaction.sender, recipient=transaction.recipient, amount=transaction.amount,
+                           scheme=transaction.scheme, fee=transaction.fee).decode("utf-8")
+        return hl.sha256(repr((transaction.sender, data, transaction.signature)).encode("utf-8")).digest()
+
+    def contains(self, transaction) -> bool:
+        key = self.key(transaction)
+        with self.__lock:
+            if key in self.__entries:
+                self.__entries.move_to_end(key)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, transaction) -> None:
+        key = self.key(transaction)
+        with self.__lock:
+            self.__entries[key] = True
+            self.__entries.move_to_end(key)
+            if len(self.__entries) > self.size:
+                self.__entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.__entries)
 
 
 class Wallet:
     """ Manages private and public keys. Manages transaction signing and verification.
     :argument node_id: The port witch runs the node.
+    :argument scheme: The signature scheme of new keys (see `src.signature_schemes`, RSA by default).
     """
 
-    def __init__(self, node_id):
+    # Transactions which passed verification (shared by all wallets of the process)
+    verified_signatures = _VerifiedSignatures(size=VERIFIED_CACHE_SIZE)
+
+    def __init__(self, node_id, scheme: str = DEFAULT_SCHEME):
         self.private_key = None
         self.public_key = None
+        self.scheme = get_scheme(scheme).name
         self.node_id = node_id
+        self.__signer = None
+        self.__signer_key = None
 
-    def create_keys(self) -> None:
-        """ Create a new pair of public and private keys. """
-        self.private_key, self.public_key = Wallet.generate_keys()
+    def create_keys(self, scheme: str = None) -> None:
+        """ Create a new pair of public and private keys.
+        :argument scheme: The signature scheme of the keys (the scheme of the wallet by default).
+        """
+        scheme = self.scheme if scheme is None else get_scheme(scheme).name
+        self.private_key, self.public_key = Wallet.generate_keys(scheme=scheme)
+        self.scheme = scheme
         logging.info("New keys have been created and saved.")
 
     def save_keys(self) -> bool:
-        """ Saves RSA keys to local file.
+        """ Saves the keys and their scheme to local file.
         :return: `True` if saving is successful, `False` otherwise """
         if not self.public_key or not self.private_key:
             logging.error("Keys missing, saving impossible.")
             return False
         try:
             with open(f"wallet-{self.node_id}.txt", mode="w") as f:
-                f.write(f"{self.public_key}\n{self.private_key}")
+                f.write(f"{self.public_key}\n{self.private_key}\n{self.scheme}")
             return True
         except IOError as ex:
             logging.error(f"Error saving keys: {ex}")
@@ -46,56 +114,56 @@ class Wallet:
             if len(keys) < 2:
                 logging.error("The key file is corrupted or empty.")
                 return False
+            # Key files without a scheme line hold RSA keys
+            scheme = get_scheme(keys[2]).name if len(keys) > 2 and keys[2] else DEFAULT_SCHEME
             self.public_key = keys[0]
             self.private_key = keys[1]
+            self.scheme = scheme
             return True
-        except (IOError, IndexError) as ex:
+        except (IOError, IndexError, ValueError) as ex:
             logging.error(f"Error loading keys: {ex}")
             return False
 
     @staticmethod
-    def generate_keys() -> tuple[str, str]:
-        """ Generates a pair of RSA keys (private and public) in HEX format.
+    def generate_keys(scheme: str = DEFAULT_SCHEME) -> tuple[str, str]:
+        """ Generates a pair of keys (private and public) in HEX format.
+        :argument scheme: The signature scheme (RSA-3072 by default).
         :return: Tuple of (private_key, public_key) as HEX strings.
         """
         try:
-            # Generate RSA key
-            private_key = RSA.generate(bits=3072, randfunc=Random.new().read)
-            public_key = private_key.publickey()
-            # Exporting keys in DER format (PKCS#8 for private)
-            private_key_hex = binascii.hexlify(private_key.exportKey(format="DER", pkcs=8)).decode("ascii")
-            public_key_hex = binascii.hexlify(public_key.exportKey(format="DER")).decode("ascii")
-            return private_key_hex, public_key_hex
+            return get_scheme(scheme).generate_keys()
         except Exception as e:
             logging.error(f"Error generating keys: {e}")
             return "", ""
 
-    def sign_transaction(self, sender: str, recipient: str, amount: float) -> str:
+    def sign_transaction(self, sender: str, recipient: str, amount: float, fee: float = 0) -> str:
         """ Signs a transaction using a private key.
         :argument sender: The sender of the transaction.
         :argument recipient: The recipient of the transaction.
         :argument amount: The amount of the transaction.
+        :argument fee: The fee of the transaction.
         :return: The signature in HEX string format.
         """
         if not self.private_key:
             logging.error("Private key missing. Signature not possible.")
             return ""
         try:
-            # Upload the private key and create a subscriber
-            private_key = RSA.import_key(binascii.unhexlify(self.private_key))
-            signer = PKCS1_v1_5.new(private_key)
-            # Create a hash of the transaction data
-            data = f"{sender}{recipient}{amount}".encode("utf-8")
-            signature = signer.sign(SHA256.new(data))
+            # Upload the private key and create a signer (once per key)
+            if self.__signer_key != (self.private_key, self.scheme):
+                self.__signer = get_scheme(self.scheme).signer(private_key=self.private_key)
+                self.__signer_key = (self.private_key, self.scheme)
+            signer = self.__signer
+            data = signed_data(sender=sender, recipient=recipient, amount=amount, scheme=self.scheme, fee=fee)
             # Return the signature in hex format
-            return binascii.hexlify(signature).decode("ascii")
+            return binascii.hexlify(signer(data)).decode("ascii")
         except (ValueError, TypeError, binascii.Error) as ex:
             logging.error(f"Error signing transaction: {ex}")
             return ""
 
     @staticmethod
     def verify_transaction(transaction) -> bool:
-        """ Verifies the digital signature of a transaction using the RSA and SHA-256 algorithms.
+        """ Verifies the digital signature of a transaction with the signature scheme it is tagged with.
+        A transaction which was already verified (e.g. on receipt) isn't verified again.
         :argument transaction: The transaction to verify (must contain sender, recipient, amount, and signature).
         :return: `True` if the signature is valid, otherwise `False`.
         """
@@ -103,15 +171,57 @@ class Wallet:
                    ["sender", "recipient", "amount", "signature"]):
             logging.error("Required fields are missing from the transaction.")
             return False
+        if Wallet.verified_signatures.contains(transaction):
+            SIGNATURE_VERIFICATIONS.inc(result="cached")
+            return True
         try:
-            # Decode the sender's public key
-            public_key = RSA.import_key(binascii.unhexlify(transaction.sender))
-            verifier = PKCS1_v1_5.new(public_key)
-            # Create a transaction hash (without signature)
-            data = f"{transaction.sender}{transaction.recipient}{transaction.amount}".encode("utf-8")
-            h = SHA256.new(data)
-            # Check signature
-            return verifier.verify(h, binascii.unhexlify(transaction.signature))
+            scheme = get_scheme(transaction.scheme)
+            with SIGNATURE_VERIFICATION_SECONDS.time(scheme=scheme.name):
+                data = signed_data(sender=transaction.sender, recipient=transaction.recipient,
+                                   amount=transaction.amount, scheme=scheme.name, fee=transaction.fee)
+                is_valid = scheme.verify(public_key=transaction.sender, data=data,
+                                         signature=binascii.unhexlify(transaction.signature))
         except (ValueError, TypeError, binascii.Error) as ex:
             logging.error(f"Signature verification error: {ex}")
+            SIGNATURE_VERIFICATIONS.inc(result="invalid")
             return False
+        SIGNATURE_VERIFICATIONS.inc(result="valid" if is_valid else "invalid")
+        if is_valid:
+            Wallet.verified_signatures.add(transaction)
+        return is_valid
+
+    @staticmethod
+    def clear_caches() -> None:
+        """ Forgets all parsed public keys and verified signatures (e.g. to measure cold verification). """
+        for scheme in SCHEMES.values():
+            scheme.clear_cache()
+        Wallet.verified_signatures.clear()
+
+    @staticmethod
+    def cache_stats() -> dict:
+        """ Returns the hit/miss counters of the public key and verified signature caches. """
+        return {
+            "public_keys": {name: scheme.cache_info() for name, scheme in SCHEMES.items()},
+            "verified_signatures": {
+                "hits": Wallet.verified_signatures.hits,
+                "misses": Wallet.verified_signatures.misses,
+                "size": len(Wallet.verified_signatures)
+            }
+        }
+
+
+def _cache_values(field: str) -> dict:
+    """ Returns one field of `Wallet.cache_stats` by cache, as metric samples. """
+    stats = Wallet.cache_stats()
+    values = {(f"public_keys_{name}",): info[field] for name, info in stats["public_keys"].items() if field in info}
+    values[("verified_signatures",)] = stats["verified_signatures"][field]
+    return values
+
+
+# Read from the caches when /metrics is scraped
+metrics.counter("wallet_cache_hits_total", "Lookups answered by the public key and verified signature caches.",
+                ["cache"], function=lambda: _cache_values("hits"))
+metrics.counter("wallet_cache_misses_total", "Lookups the public key and verified signature caches couldn't answer.",
+                ["cache"], function=lambda: _cache_values("misses"))
+metrics.gauge("wallet_cache_entries", "Entries in the public key and verified signature caches.",
+              ["cache"], function=lambda: _cache_values("size"))